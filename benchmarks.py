@@ -0,0 +1,274 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from search import ProductSearchIndex
+from storage import InsufficientStock, PostgresStorage, SQLiteStorage
+
+# Standalone benchmarks, not run by the bot:
+#   python benchmarks.py search [--products 10000]
+#   python benchmarks.py stock [--checkouts 300] [--database-url postgresql://...]
+#   python benchmarks.py db [--sizes 1000,100000,1000000] [--output results.json] [--baseline baseline.json]
+
+_PRODUCE = ["Obuoliai", "Kriaušės", "Slyvos", "Vyšnios", "Braškės", "Avietės", "Mėlynės", "Serbentai", "Agurkai",
+            "Pomidorai", "Bulvės", "Morkos", "Burokėliai", "Svogūnai", "Česnakai", "Kopūstai", "Žiediniai kopūstai",
+            "Brokoliai", "Cukinijos", "Moliūgai", "Paprikos", "Ridikėliai", "Salotos", "Špinatai", "Krapai", "Petražolės"]
+_VARIETIES = ["raudoni", "geltoni", "žali", "ekologiški", "lenkiški", "vyšniniai", "saldūs", "jauni", "ankstyvieji",
+              "žieminiai", "dideli", "maži", "rinktiniai", "šviežūs", "Ligol", "Šampion", "Gala", "Jonagold", "Antonovka"]
+_SEARCH_QUERIES = ["obuol", "pomidor", "zali", "cesnak", "braškės", "ekolog", "kop", "sp", "gala", "zieminiai kop", "nerasta"]
+
+def synthetic_products(count: int, seed: int = 7) -> list:
+    rng = random.Random(seed)
+    products, seen_names = [], set()
+    while len(products) < count:
+        name = f"{rng.choice(_PRODUCE)} {rng.choice(_VARIETIES)} {rng.randint(1, 999)}"
+        if name in seen_names: continue
+        seen_names.add(name)
+        products.append((len(products) + 1, name, round(rng.uniform(0.5, 15.0), 2), 1))
+    return products
+
+def _timed_us(func, repeat: int) -> list:
+    samples = []
+    for _ in range(repeat):
+        started_at = time.perf_counter_ns()
+        func()
+        samples.append((time.perf_counter_ns() - started_at) / 1000)
+    return samples
+
+def bench_search(args) -> None:
+    products = synthetic_products(args.products)
+    started_at = time.perf_counter()
+    index = ProductSearchIndex(products)
+    print(f"Index build: {len(index)} products in {(time.perf_counter() - started_at) * 1000:.1f} ms")
+    print(f"{'query':<16}{'hits':>6}{'cold p50 us':>14}{'cold max us':>14}{'warm p50 us':>14}")
+    for query in _SEARCH_QUERIES:
+        # Cold: a fresh index per sample so the result cache is empty; warm: repeated identical query
+        cold = []
+        for _ in range(args.repeat):
+            fresh_index = ProductSearchIndex.__new__(ProductSearchIndex)
+            fresh_index.__dict__.update(index.__dict__)
+            fresh_index._cached_search = fresh_index._search
+            cold.extend(_timed_us(lambda: fresh_index.search(query), 1))
+        warm = _timed_us(lambda: index.search(query), args.repeat)
+        print(f"{query:<16}{len(index.search(query)):>6}{statistics.median(cold):>14.1f}{max(cold):>14.1f}{statistics.median(warm):>14.1f}")
+
+async def _stock_stress(args) -> None:
+    # Many checkouts race for one product with tracked stock; afterwards the stock, the saved order items and the
+    # accepted orders must agree and the stock must not be negative
+    if args.database_url:
+        storage = PostgresStorage(args.database_url)
+    else:
+        temp_dir = tempfile.TemporaryDirectory()
+        storage = SQLiteStorage(os.path.join(temp_dir.name, "stock.db"))
+    await storage.open()
+    product_name = f"Stress test {time.time_ns()}"
+    await storage.add_product(product_name, 2.5)
+    product_id = next(product[0] for product in await storage.get_products(available_only=False) if product[1] == product_name)
+    await storage.set_product_stock(product_id, args.stock)
+
+    rng = random.Random(args.seed)
+    quantities = [rng.choice((0.5, 1.0, 1.5, 2.0, 3.0)) for _ in range(args.checkouts)]
+    async def checkout(index: int, quantity: float) -> str:
+        cart = [{'id': product_id, 'name': product_name, 'price': 2.5, 'quantity': quantity}]
+        try: order_id, _created = await storage.save_order(index, f"user {index}", cart, quantity * 2.5, idempotency_key=f"{product_name}:{index}")
+        except InsufficientStock: return "rejected"
+        return "accepted" if order_id else "error"
+
+    started_at = time.perf_counter()
+    if isinstance(storage, SQLiteStorage):
+        # SQLite calls block, so each checkout gets its own thread and connection and they contend for the write lock
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(max_workers=args.checkouts) as pool:
+            outcomes = await asyncio.gather(*(loop.run_in_executor(pool, asyncio.run, checkout(i, q)) for i, q in enumerate(quantities, start=1)))
+    else:
+        outcomes = await asyncio.gather(*(checkout(i, q) for i, q in enumerate(quantities, start=1)))
+    elapsed = time.perf_counter() - started_at
+
+    sold = sum(quantity for quantity, outcome in zip(quantities, outcomes) if outcome == "accepted")
+    remaining = (await storage.get_product(product_id))[4]
+    saved = sum(quantity for _name, quantity in await storage.get_shopping_list() if _name == product_name)
+    print(f"{args.checkouts} concurrent checkouts in {elapsed * 1000:.0f} ms: {outcomes.count('accepted')} accepted, "
+          f"{outcomes.count('rejected')} rejected for stock, {outcomes.count('error')} errors")
+    print(f"Stock {args.stock:g} kg, asked {sum(quantities):g} kg, sold {sold:g} kg, saved in orders {saved:g} kg, left {remaining:g} kg")
+    consistent = remaining >= 0 and abs(args.stock - sold - remaining) < 1e-6 and abs(saved - sold) < 1e-6
+    print("OK: no oversell" if consistent else "FAIL: stock and orders disagree")
+    await storage.delete_product(product_id)
+    await storage.close()
+    if not consistent: raise SystemExit(1)
+
+def bench_stock(args) -> None:
+    asyncio.run(_stock_stress(args))
+
+# Synthetic shop history for the db benchmark: weights roughly follow the production order mix
+_ORDER_STATUSES = (("pending", 8), ("confirmed", 7), ("completed", 75), ("cancelled", 10))
+_ITEMS_PER_ORDER = ((1, 20), (2, 25), (3, 20), (4, 15), (5, 10), (6, 6), (8, 4))
+_ORDER_QUANTITIES = (0.5, 1.0, 1.5, 2.0, 3.0, 5.0)
+_DB_BENCH_PRODUCTS = 300
+_DB_BENCH_HISTORY_DAYS = 730
+_DB_BENCH_BATCH = 10_000
+
+def build_order_database(path: str, order_count: int, seed: int) -> None:
+    # Schema from SQLiteStorage itself, rows bulk-inserted directly; written under a temporary name so an
+    # interrupted build is never reused
+    part_path = path + ".part"
+    if os.path.exists(part_path): os.remove(part_path)
+    storage = SQLiteStorage(part_path)
+    asyncio.run(storage.open())
+    rng = random.Random(seed)
+    products = synthetic_products(_DB_BENCH_PRODUCTS, seed)
+    user_count = max(20, order_count // 10) # About ten orders per customer
+    statuses, status_weights = zip(*_ORDER_STATUSES)
+    line_counts, line_weights = zip(*_ITEMS_PER_ORDER)
+    history_start = datetime.now() - timedelta(days=_DB_BENCH_HISTORY_DAYS)
+    conn = sqlite3.connect(part_path)
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.executemany("INSERT INTO products (id, name, price_per_kg, is_available) VALUES (?, ?, ?, ?)", products)
+    conn.executemany("INSERT INTO users (telegram_id, first_name, username, language_code) VALUES (?, ?, ?, 'lt')",
+                     ((user_id, f"User {user_id}", f"user{user_id}") for user_id in range(1, user_count + 1)))
+    for batch_start in range(1, order_count + 1, _DB_BENCH_BATCH):
+        orders, items = [], []
+        for order_id in range(batch_start, min(batch_start + _DB_BENCH_BATCH, order_count + 1)):
+            # Ids follow order_date, as they do for real orders
+            order_date = history_start + timedelta(seconds=order_id * _DB_BENCH_HISTORY_DAYS * 86400 // (order_count + 1))
+            total = 0.0
+            for product in rng.sample(products, rng.choices(line_counts, line_weights)[0]):
+                quantity = rng.choice(_ORDER_QUANTITIES)
+                total += quantity * product[2]
+                items.append((order_id, product[0], quantity, product[2]))
+            user_id = rng.randint(1, user_count)
+            orders.append((order_id, user_id, f"User {user_id}", order_date.strftime("%Y-%m-%d %H:%M:%S"), round(total, 2), rng.choices(statuses, status_weights)[0]))
+        conn.executemany("INSERT INTO orders (id, user_id, user_name, order_date, total_price, status) VALUES (?, ?, ?, ?, ?, ?)", orders)
+        conn.executemany("INSERT INTO order_items (order_id, product_id, quantity_kg, price_at_order) VALUES (?, ?, ?, ?)", items)
+    # The rollups were created empty; let the storage fold the history in as it would for an upgraded database
+    conn.execute("UPDATE daily_sales_backfill SET max_order_id = ?", (order_count,))
+    conn.commit()
+    conn.close()
+    asyncio.run(storage.backfill_daily_sales())
+    asyncio.run(storage.optimize()) # The bot analyzes its database nightly; plans should match that
+    os.replace(part_path, path)
+
+def _db_operations(report_from: str, report_to: str) -> list:
+    # (name, coroutine factory taking (storage, sample index)); mutating operations come last so the read-only
+    # ones all see the generated data
+    bench_user = 1
+    bench_cart = [{'id': 1, 'name': "", 'price': 2.5, 'quantity': 1.0}, {'id': 2, 'name': "", 'price': 4.0, 'quantity': 0.5}]
+    return [
+        ("get_all_orders", lambda storage, _i: storage.get_all_orders()),
+        ("get_shopping_list", lambda storage, _i: storage.get_shopping_list()),
+        ("get_user_orders", lambda storage, _i: storage.get_user_orders(bench_user)),
+        ("get_last_order_items", lambda storage, _i: storage.get_last_order_items(bench_user)),
+        ("get_daily_sales_totals", lambda storage, _i: storage.get_daily_sales_totals(report_from, report_to)),
+        ("get_product_sales", lambda storage, _i: storage.get_product_sales(report_from, report_to)),
+        ("save_order", lambda storage, i: storage.save_order(bench_user, "Bench", bench_cart, 4.5, idempotency_key=f"bench:{time.time_ns()}:{i}")),
+        ("delete_completed_orders", lambda storage, _i: storage.delete_completed_orders()),
+    ]
+
+_DB_RUN_ONCE = {"delete_completed_orders"} # Nothing left to delete after the first call
+
+async def _time_db_operations(storage, operations: list, repeat: int) -> dict:
+    results = {}
+    for name, operation in operations:
+        # Cold: first call on a freshly copied file; warm: the repeats after it, with SQLite's and the OS's caches filled
+        samples = []
+        for i in range(1 if name in _DB_RUN_ONCE else repeat + 1):
+            started_at = time.perf_counter()
+            result = await operation(storage, i)
+            samples.append((time.perf_counter() - started_at) * 1000)
+        cold, warm = samples[0], samples[1:] or samples
+        results[name] = {"cold_ms": round(cold, 3), "warm_ms": round(statistics.median(warm), 3), "warm_min_ms": round(min(warm), 3),
+                         "rows": len(result) if isinstance(result, list) else result if isinstance(result, int) else None}
+    return results
+
+def _compare_db_results(results: dict, baseline: dict, threshold: float) -> int:
+    # Prints warm-time changes against the baseline; returns how many exceed the threshold in the slow direction
+    regressions = 0
+    print(f"\nAgainst baseline ({baseline.get('meta', {}).get('created', 'unknown date')}), warm median:")
+    print(f"{'orders':>9}  {'operation':<24}{'baseline ms':>13}{'now ms':>11}{'change':>9}")
+    for size, operations in results.items():
+        for name, timing in operations.items():
+            before = baseline.get("results", {}).get(size, {}).get(name)
+            if not before: continue
+            change = (timing["warm_ms"] - before["warm_ms"]) / before["warm_ms"] * 100 if before["warm_ms"] else 0.0
+            flag = ""
+            if change > threshold: regressions += 1; flag = "  SLOWER"
+            elif change < -threshold: flag = "  faster"
+            print(f"{size:>9}  {name:<24}{before['warm_ms']:>13.2f}{timing['warm_ms']:>11.2f}{change:>+8.1f}%{flag}")
+    return regressions
+
+def bench_db(args) -> None:
+    sizes = [int(size) for size in args.sizes.split(",")]
+    os.makedirs(args.data_dir, exist_ok=True)
+    report_to = datetime.now() + timedelta(days=1)
+    operations = _db_operations((report_to - timedelta(days=31)).strftime("%Y-%m-%d"), report_to.strftime("%Y-%m-%d"))
+    if args.operations:
+        wanted = set(args.operations.split(","))
+        operations = [operation for operation in operations if operation[0] in wanted]
+    results = {}
+    for size in sizes:
+        base_path = os.path.join(args.data_dir, f"bench_orders_{size}_{args.seed}.db")
+        if not os.path.exists(base_path):
+            started_at = time.perf_counter()
+            build_order_database(base_path, size, args.seed)
+            print(f"Built {base_path} in {time.perf_counter() - started_at:.1f} s ({os.path.getsize(base_path) / 1e6:.1f} MB)")
+        # Every run works on a copy, so save_order and delete_completed_orders never change the cached data
+        work_path = base_path + ".run"
+        shutil.copyfile(base_path, work_path)
+        storage = SQLiteStorage(work_path)
+        try: results[str(size)] = asyncio.run(_time_db_operations(storage, operations, args.repeat))
+        finally:
+            for path in (work_path, storage.report_snapshot_path):
+                if os.path.exists(path): os.remove(path)
+        print(f"\n{size} orders:")
+        print(f"{'operation':<24}{'rows':>9}{'cold ms':>11}{'warm ms':>11}{'min ms':>11}")
+        for name, timing in results[str(size)].items():
+            print(f"{name:<24}{timing['rows'] if timing['rows'] is not None else '-':>9}{timing['cold_ms']:>11.2f}{timing['warm_ms']:>11.2f}{timing['warm_min_ms']:>11.2f}")
+
+    report = {"meta": {"created": datetime.now().isoformat(timespec="seconds"), "python": platform.python_version(), "sqlite": sqlite3.sqlite_version,
+                       "machine": platform.machine(), "repeat": args.repeat, "seed": args.seed}, "results": results}
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f: json.dump(report, f, indent=2)
+        print(f"\nResults written to {args.output}")
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f: baseline = json.load(f)
+        regressions = _compare_db_results(results, baseline, args.threshold)
+        print(f"{regressions} operations more than {args.threshold:g}% slower than the baseline")
+        if regressions and args.fail_on_regression: raise SystemExit(1)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmarks for the bot's in-process components")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    search_parser = subparsers.add_parser("search", help="Inline product search index")
+    search_parser.add_argument("--products", type=int, default=10_000)
+    search_parser.add_argument("--repeat", type=int, default=200)
+    search_parser.set_defaults(func=bench_search)
+    stock_parser = subparsers.add_parser("stock", help="Concurrent checkouts against limited stock (oversell check)")
+    stock_parser.add_argument("--checkouts", type=int, default=300)
+    stock_parser.add_argument("--stock", type=float, default=100.0)
+    stock_parser.add_argument("--seed", type=int, default=7)
+    stock_parser.add_argument("--database-url", help="PostgreSQL DSN; a temporary SQLite file when unset")
+    stock_parser.set_defaults(func=bench_stock)
+    db_parser = subparsers.add_parser("db", help="Storage helpers on synthetic order histories of several sizes, cold and warm")
+    db_parser.add_argument("--sizes", default="1000,100000,1000000", help="Comma-separated order counts")
+    db_parser.add_argument("--repeat", type=int, default=5, help="Warm calls per operation")
+    db_parser.add_argument("--seed", type=int, default=7)
+    db_parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "bot-db-bench"), help="Where generated databases are kept between runs")
+    db_parser.add_argument("--operations", help="Comma-separated subset of operations to time")
+    db_parser.add_argument("--output", help="Write results as JSON, e.g. to keep as a baseline")
+    db_parser.add_argument("--baseline", help="Earlier --output file to compare against")
+    db_parser.add_argument("--threshold", type=float, default=10.0, help="Percent change reported as slower or faster")
+    db_parser.add_argument("--fail-on-regression", action="store_true", help="Exit with status 1 if anything is slower than the threshold")
+    db_parser.set_defaults(func=bench_db)
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__": main()
@@ -1,11 +1,38 @@
+import time
+_process_started_at = time.perf_counter() # Start of the "imports" startup phase
 import logging
-import sqlite3
+import logging.handlers
 import os
 import json
-from datetime import datetime
+import queue
+import asyncio
+import bisect
+import hashlib
+import multiprocessing
+import signal
+import sys
+import random
+import atexit
+import contextlib
+import functools
+import contextvars
+import csv
+import gzip
+import io
+import importlib.util
+import itertools
+import tempfile
+import uuid
+import httpx
+import weakref
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
 from dotenv import load_dotenv
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove, Message
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove, InlineQueryResultArticle, InputTextMessageContent, InputFile
+from telegram.error import Forbidden, RetryAfter, TelegramError, TimedOut
+from telegram.request import BaseRequest, HTTPXRequest
+from telegram.constants import MessageLimit
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -14,15 +41,27 @@ from telegram.ext import (
     ContextTypes,
     CallbackQueryHandler,
     ConversationHandler,
+    InlineQueryHandler,
+    TypeHandler,
+    ApplicationHandlerStop,
+    ApplicationBuilder,
 )
 
 load_dotenv()
+from storage import create_storage, InsufficientStock, ORDER_STATUS_TRANSITIONS, REPORT_SNAPSHOT_MAX_AGE_SECONDS # Imported after load_dotenv() so storage settings in .env are seen
+from search import ProductSearchIndex
+import i18n
+
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 ADMIN_TELEGRAM_ID = os.getenv("ADMIN_TELEGRAM_ID")
 DEFAULT_LANGUAGE = os.getenv("DEFAULT_LANGUAGE", "lt")
 RENDER_DISK_MOUNT_PATH = os.getenv("RENDER_DISK_MOUNT_PATH")
+LOCALE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "locales")
+LOCALE_CACHE_PATH = os.getenv("LOCALE_CACHE_PATH", os.path.join(LOCALE_DIR, ".bundle.cache"))
+LOCALE_RELOAD_SECONDS = float(os.getenv("LOCALE_RELOAD_SECONDS", "10")) # How often locale files are checked for edits; 0 disables
 
 translations = {}
+translation_stamps = {} # i18n.source_stamps() of the files the live translations were built from
 ADMIN_IDS = []
 
 # --- Database Path Setup ---
@@ -40,47 +79,144 @@ if RENDER_DISK_MOUNT_PATH:
 else:
     DB_FILE_PATH = "bot.db"
 DB_NAME = DB_FILE_PATH
+# SQLite by default; DATABASE_URL=postgresql://... switches to PostgreSQL (see storage.py)
+storage = create_storage(DB_NAME, DEFAULT_LANGUAGE)
+
+# --- Logging Pipeline ---
+# Handlers on the event loop only enqueue records; a background QueueListener thread formats and writes them.
+# LOG_FORMAT=json (default) emits one JSON object per line, LOG_FORMAT=text keeps the classic format.
+# INFO lines logged with extra=SAMPLED are kept with probability LOG_INFO_SAMPLE_RATE.
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_INFO_SAMPLE_RATE = float(os.getenv("LOG_INFO_SAMPLE_RATE", "0.1"))
+SAMPLED = {"sampled": True} # Pass as extra= on high-volume INFO lines
+
+_log_user_id = contextvars.ContextVar("log_user_id", default=None)
+_log_handler_name = contextvars.ContextVar("log_handler_name", default=None)
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(), # Deferred %-formatting happens here, on the listener thread
+        }
+        for field in ("user_id", "handler", "duration_ms"):
+            value = getattr(record, field, None)
+            if value is not None: payload[field] = value
+        if record.exc_info: payload["exc"] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+class LogContextFilter(logging.Filter):
+    # Runs on the calling thread, so the context variables of the current handler are still visible
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, "user_id", None) is None: record.user_id = _log_user_id.get()
+        if getattr(record, "handler", None) is None: record.handler = _log_handler_name.get()
+        return True
+
+class InfoSamplingFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno == logging.INFO and getattr(record, "sampled", False):
+            return random.random() < LOG_INFO_SAMPLE_RATE
+        return True
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    # The stock prepare() formats the message on the caller's thread; leave that to the listener instead
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
 
-# Enable logging (configure before first use)
-logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+def setup_logging() -> logging.handlers.QueueListener:
+    stream_handler = logging.StreamHandler()
+    if LOG_FORMAT == "text":
+        stream_handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+    else:
+        stream_handler.setFormatter(JsonLogFormatter())
+    log_queue = queue.SimpleQueue()
+    queue_handler = LazyQueueHandler(log_queue)
+    queue_handler.addFilter(InfoSamplingFilter())
+    queue_handler.addFilter(LogContextFilter())
+    root_logger = logging.getLogger()
+    root_logger.handlers[:] = [queue_handler]
+    root_logger.setLevel(LOG_LEVEL)
+    logging.getLogger("httpx").setLevel(logging.WARNING) # One INFO line per Bot API request otherwise
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop) # Flush whatever is still queued on shutdown
+    return listener
+
+def log_handler(func):
+    # Tags every record logged while the handler runs with user_id/handler and logs its duration (sampled)
+    @functools.wraps(func)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
+        user = update.effective_user if update else None
+        user_token = _log_user_id.set(user.id if user else None)
+        handler_token = _log_handler_name.set(func.__name__)
+        started_at = time.perf_counter()
+        try:
+            return await func(update, context, *args, **kwargs)
+        finally:
+            duration_ms = round((time.perf_counter() - started_at) * 1000, 2)
+            logger.info("Handler %s finished in %.2f ms", func.__name__, duration_ms, extra={**SAMPLED, "duration_ms": duration_ms})
+            _log_handler_name.reset(handler_token)
+            _log_user_id.reset(user_token)
+    return wrapper
+
+_log_listener = setup_logging()
 logger = logging.getLogger(__name__)
 
+# --- Startup Timing ---
+# Seconds spent in each cold start phase; logged once when the bot is about to start polling
+startup_phases = {"imports": time.perf_counter() - _process_started_at}
+
+@contextlib.contextmanager
+def startup_phase(name: str):
+    started_at = time.perf_counter()
+    try: yield
+    finally: startup_phases[name] = startup_phases.get(name, 0.0) + time.perf_counter() - started_at
+
+def log_startup_timing() -> None:
+    breakdown = ", ".join(f"{name} {seconds * 1000:.0f} ms" for name, seconds in startup_phases.items())
+    logger.info("Startup finished in %.0f ms (%s)", (time.perf_counter() - _process_started_at) * 1000, breakdown)
+
 
 def load_translations():
-    global translations
-    translations = {}
-    for lang_code in ["en", "lt"]:
-        try:
-            script_dir = os.path.dirname(os.path.abspath(__file__))
-            file_path = os.path.join(script_dir, "locales", f"{lang_code}.json")
-            with open(file_path, "r", encoding="utf-8") as f:
-                translations[lang_code] = json.load(f)
-            logger.info(f"Successfully loaded translation file: {file_path}")
-        except FileNotFoundError:
-            logger.error(f"Translation file for {lang_code}.json not found at {file_path}")
-        except json.JSONDecodeError as e:
-            logger.error(f"Error decoding JSON from {lang_code}.json at {file_path}: {e}")
-    if not translations.get("en") or not translations.get("lt"):
-        logger.error("Essential English or Lithuanian translation files are missing or failed to load.")
+    # Uses the compiled bundle cache while locales/*.json are unchanged, otherwise parses and validates them
+    global translations, translation_stamps
+    try:
+        bundle, stamps, from_cache = i18n.load_bundle(LOCALE_DIR, LOCALE_CACHE_PATH)
+    except i18n.LocaleError as e:
+        logger.error("Could not load translations: %s", e)
+        return
+    translations, translation_stamps = bundle, stamps
+    logger.info("Loaded translations for %s (%s)", ", ".join(sorted(bundle)), "cached bundle" if from_cache else "compiled from locales/*.json")
+
+_rejected_locale_stamps = None # Stamps of an edit that failed validation, so it is not recompiled on every poll
+
+async def reload_translations_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Picks up edited locale files without a restart. The new bundle is compiled and validated off the event loop
+    # and swapped in with one assignment, so _() keeps reading a complete dict without locking; a bad file is
+    # rejected and the live translations stay as they were.
+    global translations, translation_stamps, _rejected_locale_stamps
+    stamps = i18n.source_stamps(LOCALE_DIR)
+    if stamps == translation_stamps or stamps == _rejected_locale_stamps: return
+    try:
+        bundle, stamps, _from_cache = await asyncio.to_thread(i18n.load_bundle, LOCALE_DIR, LOCALE_CACHE_PATH)
+    except i18n.LocaleError as e:
+        _rejected_locale_stamps = stamps
+        logger.error("Edited locale files rejected, keeping the current translations: %s", e)
+        return
+    translations, translation_stamps = bundle, stamps
+    logger.info("Reloaded translations for %s", ", ".join(sorted(bundle)))
 
 async def get_user_language(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> str:
     if 'language_code' in context.user_data:
         return context.user_data['language_code']
 
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    result = None
-    try:
-        cursor.execute("SELECT language_code FROM users WHERE telegram_id = ?", (user_id,))
-        result = cursor.fetchone()
-    except sqlite3.Error as e:
-        logger.error(f"DB error in get_user_language for user {user_id}: {e}")
-    finally:
-        conn.close()
-
-    if result and result[0]:
-        context.user_data['language_code'] = result[0]
-        return result[0]
+    stored_lang = await storage.get_user_language(user_id)
+    if stored_lang:
+        context.user_data['language_code'] = stored_lang
+        return stored_lang
 
     context.user_data['language_code'] = DEFAULT_LANGUAGE
     return DEFAULT_LANGUAGE
@@ -96,273 +232,43 @@ async def _(context: ContextTypes.DEFAULT_TYPE, key: str, user_id: int = None, *
     lang_code = DEFAULT_LANGUAGE
     if actual_user_id_for_lang:
         lang_code = await get_user_language(context, actual_user_id_for_lang)
+    return translate(lang_code, key, **kwargs)
 
+def translation_template(lang_code: str, key: str, default: str = None) -> str:
+    # The unformatted text translate() would use: the language, then DEFAULT_LANGUAGE, then English, then default
     text_to_return = translations.get(lang_code, {}).get(key)
     if text_to_return is None and lang_code != DEFAULT_LANGUAGE:
         text_to_return = translations.get(DEFAULT_LANGUAGE, {}).get(key)
     if text_to_return is None and lang_code != "en" and DEFAULT_LANGUAGE != "en":
          text_to_return = translations.get("en", {}).get(key) # Fallback to English
     if text_to_return is None:
-        default_text = kwargs.pop("default", key)
         # logger.warning(f"Translation key '{key}' not found. Using default/key: '{default_text}'") # Can be noisy
-        text_to_return = default_text
+        text_to_return = key if default is None else default
+    return text_to_return
 
+def translate(lang_code: str, key: str, **kwargs) -> str:
+    # Synchronous lookup for an already known language, with the same fallbacks as _()
+    text_to_return = translation_template(lang_code, key, kwargs.pop("default", None))
     try:
         # Ensure formatting is attempted only if placeholders likely exist or kwargs are provided
         if isinstance(text_to_return, str) and (("{" in text_to_return and "}" in text_to_return) or kwargs):
             return text_to_return.format(**kwargs)
         return str(text_to_return) # Convert to string if not already (e.g. from JSON numbers)
     except KeyError as e:
-        logger.warning(f"Missing placeholder {e} for key '{key}' (lang '{lang_code}'). String: '{text_to_return}'. Kwargs: {kwargs}")
+        logger.warning("Missing placeholder %s for key '%s' (lang '%s'). String: '%s'. Kwargs: %s", e, key, lang_code, text_to_return, kwargs)
         return text_to_return # Return unformatted string
     except Exception as e:
-        logger.error(f"Error formatting string for key '{key}': {e}")
+        logger.error("Error formatting string for key '%s': %s", key, e)
         return key
 
 
-def init_db():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    sql_create_users_table = f"""
-    CREATE TABLE IF NOT EXISTS users (
-        telegram_id INTEGER PRIMARY KEY, first_name TEXT, username TEXT,
-        is_admin INTEGER DEFAULT 0, language_code TEXT DEFAULT '{DEFAULT_LANGUAGE}'
-    )"""
-    cursor.execute(sql_create_users_table)
-    cursor.execute("CREATE TABLE IF NOT EXISTS products (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE NOT NULL, price_per_kg REAL NOT NULL, is_available INTEGER DEFAULT 1)")
-    cursor.execute("CREATE TABLE IF NOT EXISTS orders (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, user_name TEXT, order_date TEXT NOT NULL, total_price REAL NOT NULL, status TEXT DEFAULT 'pending', FOREIGN KEY (user_id) REFERENCES users (telegram_id))")
-    cursor.execute("CREATE TABLE IF NOT EXISTS order_items (id INTEGER PRIMARY KEY AUTOINCREMENT, order_id INTEGER NOT NULL, product_id INTEGER NOT NULL, quantity_kg REAL NOT NULL, price_at_order REAL NOT NULL, FOREIGN KEY (order_id) REFERENCES orders (id), FOREIGN KEY (product_id) REFERENCES products (id))")
-    conn.commit()
-    conn.close()
-
 async def ensure_user_exists(user_id: int, first_name: str, username: str, context: ContextTypes.DEFAULT_TYPE):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    is_admin_user = 1 if ADMIN_IDS and user_id in ADMIN_IDS else 0
-    current_lang = DEFAULT_LANGUAGE # Default if no record or no lang in record
-    try:
-        cursor.execute("SELECT language_code FROM users WHERE telegram_id = ?", (user_id,))
-        user_record = cursor.fetchone()
-        if user_record and user_record[0]: # If user exists and has a language set
-            current_lang = user_record[0]
-
-        # Set language in context_data immediately
-        context.user_data['language_code'] = current_lang
-
-        # Insert or update user. If user exists, update names and admin status.
-        # Crucially, preserve existing language_code if it's already set, otherwise use current_lang.
-        cursor.execute("""
-            INSERT INTO users (telegram_id, first_name, username, language_code, is_admin)
-            VALUES (?, ?, ?, ?, ?)
-            ON CONFLICT(telegram_id) DO UPDATE SET
-                first_name = excluded.first_name,
-                username = excluded.username,
-                is_admin = excluded.is_admin,
-                language_code = COALESCE(users.language_code, excluded.language_code)
-        """, (user_id, first_name, username, current_lang, is_admin_user))
-        conn.commit()
-    except sqlite3.Error as e:
-        logger.error(f"DB error in ensure_user_exists for user {user_id}: {e}")
-        context.user_data['language_code'] = DEFAULT_LANGUAGE # Fallback on error
-    finally:
-        conn.close()
+    is_admin_user = bool(ADMIN_IDS and user_id in ADMIN_IDS)
+    current_lang = await storage.ensure_user(user_id, first_name, username, is_admin_user, DEFAULT_LANGUAGE)
+    if current_lang is None: current_lang = DEFAULT_LANGUAGE # Fallback on error
+    context.user_data['language_code'] = current_lang
     return current_lang # Returns the language determined (either existing or default)
 
-async def set_user_language_db(user_id: int, lang_code: str):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    try:
-        cursor.execute("UPDATE users SET language_code = ? WHERE telegram_id = ?", (lang_code, user_id))
-        conn.commit()
-    except sqlite3.Error as e: logger.error(f"DB error in set_user_language_db for user {user_id}: {e}")
-    finally: conn.close()
-
-# --- Database Functions (Full versions) ---
-def add_product_to_db(name: str, price: float) -> bool:
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    try:
-        cursor.execute("INSERT INTO products (name, price_per_kg) VALUES (?, ?)", (name, price))
-        conn.commit()
-        return True
-    except sqlite3.IntegrityError:
-        logger.warning(f"Attempted to add duplicate product name: {name}")
-        return False
-    except sqlite3.Error as e:
-        logger.error(f"DB error adding product {name}: {e}")
-        return False
-    finally:
-        conn.close()
-
-def get_products_from_db(available_only: bool = True) -> list:
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    products = []
-    try:
-        query = "SELECT id, name, price_per_kg, is_available FROM products"
-        if available_only:
-            query += " WHERE is_available = 1"
-        query += " ORDER BY name"
-        cursor.execute(query)
-        products = cursor.fetchall()
-    except sqlite3.Error as e:
-        logger.error(f"DB error getting products: {e}")
-    finally:
-        conn.close()
-    return products
-
-def get_product_by_id(product_id: int):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    product = None
-    try:
-        cursor.execute("SELECT id, name, price_per_kg, is_available FROM products WHERE id = ?", (product_id,))
-        product = cursor.fetchone()
-    except sqlite3.Error as e:
-        logger.error(f"DB error getting product by ID {product_id}: {e}")
-    finally:
-        conn.close()
-    return product
-
-def update_product_in_db(product_id: int, name: str = None, price: float = None, is_available: int = None) -> bool:
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    success = False
-    fields, params = [], []
-    if name is not None: fields.append("name = ?"); params.append(name)
-    if price is not None: fields.append("price_per_kg = ?"); params.append(price)
-    if is_available is not None: fields.append("is_available = ?"); params.append(is_available)
-
-    if not fields: conn.close(); return False
-
-    params.append(product_id)
-    query = f"UPDATE products SET {', '.join(fields)} WHERE id = ?"
-    try:
-        cursor.execute(query, tuple(params))
-        conn.commit()
-        if cursor.rowcount > 0: # Check if any row was actually updated
-            success = True
-    except sqlite3.Error as e:
-        logger.error(f"DB error updating product {product_id}: {e}")
-    finally:
-        conn.close()
-    return success
-
-def delete_product_from_db(product_id: int) -> bool:
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    success = False
-    try:
-        cursor.execute("DELETE FROM products WHERE id = ?", (product_id,))
-        conn.commit()
-        if cursor.rowcount > 0:
-            success = True
-    except sqlite3.Error as e:
-        logger.error(f"DB error deleting product {product_id}: {e}")
-    finally:
-        conn.close()
-    return success
-
-def save_order_to_db(user_id: int, user_name: str, cart: list, total_price: float) -> int | None:
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    order_id = None
-    order_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    try:
-        conn.execute("BEGIN TRANSACTION")
-        cursor.execute("INSERT INTO orders (user_id, user_name, order_date, total_price, status) VALUES (?, ?, ?, ?, ?)",
-                       (user_id, user_name, order_date, total_price, 'pending'))
-        order_id = cursor.lastrowid
-        for item in cart:
-            cursor.execute("INSERT INTO order_items (order_id, product_id, quantity_kg, price_at_order) VALUES (?, ?, ?, ?)",
-                           (order_id, item['id'], item['quantity'], item['price']))
-        conn.commit()
-    except sqlite3.Error as e:
-        logger.error(f"Error saving order for user {user_id}: {e}")
-        if conn: conn.rollback()
-        order_id = None
-    finally:
-        if conn: conn.close()
-    return order_id
-
-def get_user_orders_from_db(user_id: int) -> list:
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    orders = []
-    try:
-        # Using CHAR(10) for newline in group_concat for better readability if needed directly
-        cursor.execute("SELECT o.id, o.order_date, o.total_price, o.status, group_concat(p.name || ' (' || oi.quantity_kg || 'kg)', CHAR(10)) FROM orders o JOIN order_items oi ON o.id = oi.order_id JOIN products p ON oi.product_id = p.id WHERE o.user_id = ? GROUP BY o.id ORDER BY o.order_date DESC", (user_id,))
-        orders = cursor.fetchall()
-    except sqlite3.Error as e:
-        logger.error(f"DB error getting orders for user {user_id}: {e}")
-    finally:
-        conn.close()
-    return orders
-
-def get_all_orders_from_db() -> list:
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    orders = []
-    try:
-        cursor.execute("SELECT o.id, o.user_id, o.user_name, o.order_date, o.total_price, o.status, GROUP_CONCAT(p.name || ' (' || oi.quantity_kg || 'kg @ ' || oi.price_at_order || ' EUR)', CHAR(10)) as items_details FROM orders o JOIN order_items oi ON o.id = oi.order_id JOIN products p ON oi.product_id = p.id GROUP BY o.id ORDER BY o.order_date DESC")
-        orders = cursor.fetchall()
-    except sqlite3.Error as e:
-        logger.error(f"DB error getting all orders: {e}")
-    finally:
-        conn.close()
-    return orders
-
-def get_shopping_list_from_db() -> list:
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    shopping_list = []
-    try:
-        cursor.execute("SELECT p.name, SUM(oi.quantity_kg) as total_quantity FROM order_items oi JOIN products p ON oi.product_id = p.id JOIN orders o ON oi.order_id = o.id WHERE o.status IN ('pending','confirmed') GROUP BY p.name ORDER BY p.name")
-        shopping_list = cursor.fetchall()
-    except sqlite3.Error as e:
-        logger.error(f"DB error getting shopping list: {e}")
-    finally:
-        conn.close()
-    return shopping_list
-
-def delete_completed_orders_from_db() -> int:
-    conn = sqlite3.connect(DB_NAME); cursor = conn.cursor(); deleted_count = 0
-    try:
-        cursor.execute("SELECT id FROM orders WHERE status = ?", ('completed',))
-        completed_order_ids = [row[0] for row in cursor.fetchall()]
-        if not completed_order_ids: conn.close(); return 0
-
-        conn.execute("BEGIN TRANSACTION")
-        for order_id_val in completed_order_ids:
-            cursor.execute("DELETE FROM order_items WHERE order_id = ?", (order_id_val,))
-            # Make sure to delete from orders table as well
-            cursor.execute("DELETE FROM orders WHERE id = ? AND status = ?", (order_id_val, 'completed'))
-            deleted_count += cursor.rowcount # counts rows deleted from 'orders' table
-        conn.commit()
-    except sqlite3.Error as e:
-        logger.error(f"DB error deleting completed orders: {e}")
-        if conn: conn.rollback()
-        deleted_count = -1 # Indicate error
-    finally:
-        if conn: conn.close()
-    return deleted_count
-
-def mark_order_as_completed_in_db(order_id_to_mark: int) -> bool:
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    success = False
-    try:
-        cursor.execute("UPDATE orders SET status = ? WHERE id = ?", ('completed', order_id_to_mark))
-        conn.commit()
-        if cursor.rowcount > 0:
-            success = True
-    except sqlite3.Error as e:
-        logger.error(f"DB error marking order {order_id_to_mark} as completed: {e}")
-    finally:
-        conn.close()
-    return success
-# --- End Database Functions ---
-
 
 # --- Conversation States ---
 (SELECT_LANGUAGE_STATE,
@@ -370,42 +276,120 @@ def mark_order_as_completed_in_db(order_id_to_mark: int) -> bool:
  ADMIN_MAIN_PANEL_STATE,
  ADMIN_ADD_PROD_NAME, ADMIN_ADD_PROD_PRICE,
  ADMIN_MANAGE_PROD_LIST, ADMIN_MANAGE_PROD_OPTIONS, ADMIN_MANAGE_PROD_EDIT_PRICE, ADMIN_MANAGE_PROD_DELETE_CONFIRM,
- ADMIN_CLEAR_ORDERS_CONFIRM
-) = range(12)
+ ADMIN_CLEAR_ORDERS_CONFIRM,
+ ADMIN_IMPORT_CATALOG_UPLOAD,
+ ADMIN_SALES_REPORT_MENU, ADMIN_SALES_REPORT_RANGE,
+ ADMIN_BROADCAST_TEXT, ADMIN_BROADCAST_CONFIRM,
+ ADMIN_ORDER_STATUS_ACTION, ADMIN_ORDER_STATUS_SELECTION,
+ ADMIN_MANAGE_PROD_EDIT_STOCK
+) = range(20)
+
+# --- Views ---
+# Screens that depend only on the language and a few small inputs are rendered by pure functions returning
+# (text, InlineKeyboardMarkup) or just the markup, built with translate() and nothing awaited. @view memoizes
+# each one in an LRU of VIEW_CACHE_SIZE entries keyed on its arguments; the cache remembers the translations dict
+# it was rendered from and starts over when a locale reload swaps it. Handlers pick a view and send it.
+VIEW_CACHE_SIZE = int(os.getenv("VIEW_CACHE_SIZE", "256"))
+
+def view(render):
+    cached_render = functools.lru_cache(maxsize=VIEW_CACHE_SIZE)(render)
+    rendered_from = None
+    @functools.wraps(render)
+    def cached_view(*args):
+        nonlocal rendered_from
+        if rendered_from is not translations:
+            cached_render.cache_clear(); rendered_from = translations
+        return cached_render(*args)
+    cached_view.cache_info = cached_render.cache_info
+    return cached_view
+
+@view
+def main_menu_markup(lang_code: str) -> InlineKeyboardMarkup:
+    # The welcome text carries the user's mention, so only the keyboard is shared
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(translate(lang_code,"browse_products_button"),callback_data="order_flow_browse_entry")],
+        [InlineKeyboardButton(translate(lang_code,"search_products_button",default="🔍 Search Products"),switch_inline_query_current_chat="")],
+        [InlineKeyboardButton(translate(lang_code,"view_cart_button"),callback_data="order_flow_view_cart_direct_entry")],
+        [InlineKeyboardButton(translate(lang_code,"repeat_last_order_button",default="🔁 Repeat Last Order"),callback_data="order_flow_repeat_last_entry")],
+        [InlineKeyboardButton(translate(lang_code,"my_orders_button"),callback_data="my_orders_direct_cb")],
+        [InlineKeyboardButton(translate(lang_code,"set_language_button"),callback_data="select_language_entry")]
+    ])
+
+@view
+def language_menu_view(lang_code: str) -> tuple[str, InlineKeyboardMarkup]:
+    return translate(lang_code,"choose_language"),InlineKeyboardMarkup([
+        [InlineKeyboardButton("English 🇬🇧",callback_data="lang_select_en")],[InlineKeyboardButton("Lietuvių 🇱🇹",callback_data="lang_select_lt")],
+        [InlineKeyboardButton(translate(lang_code,"back_button",default="⬅️ Back"),callback_data="main_menu_direct_cb_ender")]])
+
+@view
+def admin_panel_view(lang_code: str) -> tuple[str, InlineKeyboardMarkup]:
+    return translate(lang_code,"admin_panel_title"),InlineKeyboardMarkup([
+        [InlineKeyboardButton(translate(lang_code,"admin_add_product_button"),callback_data="admin_add_prod_entry_cb")],
+        [InlineKeyboardButton(translate(lang_code,"admin_manage_products_button"),callback_data="admin_manage_prod_list_entry_cb")],
+        [InlineKeyboardButton(translate(lang_code,"admin_import_catalog_button",default="📥 Import Catalog (CSV/JSON)"),callback_data="admin_import_catalog_entry_cb"),
+         InlineKeyboardButton(translate(lang_code,"admin_export_catalog_button",default="📤 Export Catalog"),callback_data="admin_export_catalog_direct_cb")],
+        [InlineKeyboardButton(translate(lang_code,"admin_view_orders_button"),callback_data="admin_view_orders_direct_cb")],
+        [InlineKeyboardButton(translate(lang_code,"admin_order_status_button",default="🔄 Update Order Status"),callback_data="admin_order_status_entry_cb")],
+        [InlineKeyboardButton(translate(lang_code,"admin_export_orders_button",default="📤 Export Orders (CSV)"),callback_data="admin_export_orders_direct_cb")],
+        [InlineKeyboardButton(translate(lang_code,"admin_shopping_list_button"),callback_data="admin_shop_list_direct_cb")],
+        [InlineKeyboardButton(translate(lang_code,"admin_sales_report_button",default="📈 Sales Report"),callback_data="admin_sales_report_entry_cb")],
+        [InlineKeyboardButton(translate(lang_code,"admin_broadcast_button",default="📢 Broadcast"),callback_data="admin_broadcast_entry_cb")],
+        [InlineKeyboardButton(translate(lang_code,"admin_clear_orders_button",default="🧹 Clear Completed Orders"),callback_data="admin_clear_orders_entry_cb")],
+        [InlineKeyboardButton(translate(lang_code,"admin_exit_button"),callback_data="main_menu_direct_cb_ender")]
+    ])
+
+@view
+def admin_back_markup(lang_code: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[InlineKeyboardButton(translate(lang_code,"admin_back_to_admin_panel_button"),callback_data="admin_panel_return_direct_cb")]])
+
+@view
+def admin_prompt_view(lang_code: str, key: str, default: str) -> tuple[str, InlineKeyboardMarkup]:
+    # An admin prompt whose only button leads back to the admin panel
+    return translate(lang_code,key,default=default),admin_back_markup(lang_code)
+
+@view
+def admin_product_options_view(lang_code: str, prod: tuple) -> tuple[str, InlineKeyboardMarkup]:
+    # prod: the storage row; an edited product is a new row and so a new cache entry
+    pname,pprice,pavail,pstock=prod[1],prod[2],prod[3],prod[4]
+    avail_key="admin_set_unavailable_button" if pavail else "admin_set_available_button"
+    stock_txt=f"{pstock:g} kg" if pstock is not None else translate(lang_code,"admin_stock_not_tracked",default="not tracked")
+    return translate(lang_code,"admin_managing_product",product_name=pname),InlineKeyboardMarkup([
+        [InlineKeyboardButton(translate(lang_code,"admin_change_price_button",price=pprice),callback_data="admin_manage_edit_price_entry_cb")],
+        [InlineKeyboardButton(translate(lang_code,"admin_set_stock_button",stock=stock_txt,default=f"Set Stock ({stock_txt})"),callback_data="admin_manage_edit_stock_entry_cb")],
+        [InlineKeyboardButton(translate(lang_code,avail_key),callback_data=f"admin_manage_toggle_avail_cb_{1-pavail}")], # Toggle 0 to 1, 1 to 0
+        [InlineKeyboardButton(translate(lang_code,"admin_delete_product_button"),callback_data="admin_manage_delete_confirm_cb")],
+        [InlineKeyboardButton(translate(lang_code,"admin_back_to_product_list_button"),callback_data="admin_manage_prod_list_refresh_cb")]
+    ])
 
 # --- Helper: Display Main Menu ---
 async def display_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, edit_message: bool = False):
     user = update.effective_user
     if not user: logger.error("display_main_menu called without effective_user"); return
     user_id = user.id
-    if 'language_code' not in context.user_data: context.user_data['language_code'] = await get_user_language(context, user_id)
+    lang_code = await get_user_language(context, user_id)
 
-    kb = [
-        [InlineKeyboardButton(await _(context,"browse_products_button",user_id=user_id),callback_data="order_flow_browse_entry")],
-        [InlineKeyboardButton(await _(context,"view_cart_button",user_id=user_id),callback_data="order_flow_view_cart_direct_entry")],
-        [InlineKeyboardButton(await _(context,"my_orders_button",user_id=user_id),callback_data="my_orders_direct_cb")],
-        [InlineKeyboardButton(await _(context,"set_language_button",user_id=user_id),callback_data="select_language_entry")]
-    ]
-    welcome = await _(context,"welcome_message",user_id=user_id,user_mention=user.mention_html())
+    reply_markup = main_menu_markup(lang_code)
+    welcome = translate(lang_code,"welcome_message",user_mention=user.mention_html())
     target_message_obj = update.callback_query.message if edit_message and update.callback_query else update.message
 
     try:
         if edit_message and target_message_obj:
-            await target_message_obj.edit_text(welcome,reply_markup=InlineKeyboardMarkup(kb),parse_mode='HTML')
+            await target_message_obj.edit_text(welcome,reply_markup=reply_markup,parse_mode='HTML')
         elif update.message: # From a command, so update.message is the command message
-            await update.message.reply_html(welcome,reply_markup=InlineKeyboardMarkup(kb))
+            await update.message.reply_html(welcome,reply_markup=reply_markup)
         elif user_id : # Fallback, e.g. after an action that doesn't have a direct message to reply to/edit
-            await context.bot.send_message(chat_id=user_id,text=welcome,reply_markup=InlineKeyboardMarkup(kb),parse_mode='HTML')
+            await context.bot.send_message(chat_id=user_id,text=welcome,reply_markup=reply_markup,parse_mode='HTML')
     except Exception as e:
-        logger.warning(f"Display main menu error (edit={edit_message}, target_message_obj exists: {bool(target_message_obj)}): {e}")
+        logger.warning("Display main menu error (edit=%s, target_message_obj exists: %s): %s", edit_message, bool(target_message_obj), e)
         # Try sending as a new message if edit/reply failed but user_id is known
         if user_id and not (edit_message and target_message_obj) and not update.message :
             try:
-                await context.bot.send_message(chat_id=user_id,text=welcome,reply_markup=InlineKeyboardMarkup(kb),parse_mode='HTML')
+                await context.bot.send_message(chat_id=user_id,text=welcome,reply_markup=reply_markup,parse_mode='HTML')
             except Exception as send_e:
-                logger.error(f"Fallback display_main_menu send error: {send_e}")
+                logger.error("Fallback display_main_menu send error: %s", send_e)
 
 # --- Start Command & General Back to Main Menu ---
+@log_handler
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     if not user: logger.error("start_command: effective_user is None"); return
@@ -415,7 +399,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     lang_code = context.user_data.get('language_code')
     cart_data = context.user_data.get('cart')
     # More robust clearing to avoid unintentionally removing PTB internal keys
-    keys_to_clear = [k for k in context.user_data if k not in ['language_code', 'cart'] and not k.startswith('_')]
+    keys_to_clear = [k for k in context.user_data if k not in ['language_code', 'cart', 'cart_token'] and not k.startswith('_')]
     for key_to_clear in keys_to_clear:
         context.user_data.pop(key_to_clear, None)
 
@@ -427,13 +411,14 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     await display_main_menu(update, context, edit_message=False) # edit_message=False as it's from a command
 
+@log_handler
 async def back_to_main_menu_cb_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if update.callback_query: await update.callback_query.answer()
 
     lang_code = context.user_data.get('language_code')
     cart_data = context.user_data.get('cart')
     # Clear transient data, preserving language and cart
-    keys_to_clear = [k for k in context.user_data if k not in ['language_code', 'cart'] and not k.startswith('_')]
+    keys_to_clear = [k for k in context.user_data if k not in ['language_code', 'cart', 'cart_token'] and not k.startswith('_')]
     for key_to_clear in keys_to_clear:
         context.user_data.pop(key_to_clear, None)
 
@@ -447,33 +432,39 @@ async def back_to_main_menu_cb_handler(update: Update, context: ContextTypes.DEF
     return ConversationHandler.END
 
 # --- Language Selection Flow ---
+@log_handler
 async def select_language_entry(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    q=update.callback_query;await q.answer();uid=q.from_user.id;logger.info(f"User {uid} entering language selection.")
-    kb=[[InlineKeyboardButton("English 🇬🇧",callback_data="lang_select_en")],[InlineKeyboardButton("Lietuvių 🇱🇹",callback_data="lang_select_lt")],[InlineKeyboardButton(await _(context,"back_button",user_id=uid,default="⬅️ Back"),callback_data="main_menu_direct_cb_ender")]]
-    await q.edit_message_text(await _(context,"choose_language",user_id=uid),reply_markup=InlineKeyboardMarkup(kb));return SELECT_LANGUAGE_STATE
+    q=update.callback_query;await q.answer();uid=q.from_user.id;logger.info("User %s entering language selection.", uid, extra=SAMPLED)
+    text,reply_markup=language_menu_view(await get_user_language(context,uid))
+    await q.edit_message_text(text,reply_markup=reply_markup);return SELECT_LANGUAGE_STATE
+@log_handler
 async def language_selected_state(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     q=update.callback_query;await q.answer();code=q.data.split('_')[-1];uid=q.from_user.id
-    context.user_data['language_code']=code;await set_user_language_db(uid,code)
+    context.user_data['language_code']=code;await storage.set_user_language(uid,code)
     name="English" if code=="en" else "Lietuvių";await q.edit_message_text(await _(context,"language_set_to",user_id=uid,language_name=name))
     # Short delay or send new message to avoid "message not modified" if text is same
     await display_main_menu(update,context,edit_message=True);return ConversationHandler.END
 
 # --- User Order Flow ---
+@log_handler
 async def order_flow_browse_entry(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
-    logger.info(f"User {update.effective_user.id} entered order_flow_browse_entry CB:{update.callback_query.data}")
+    logger.info("User %s entered order_flow_browse_entry CB:%s", update.effective_user.id, update.callback_query.data, extra=SAMPLED)
     q=update.callback_query;await q.answer();return await order_flow_list_products(update,context,q.from_user.id,True)
 
 async def order_flow_list_products(update:Update,context:ContextTypes.DEFAULT_TYPE,uid:int,edit_message:bool=True)->int:
     query = update.callback_query
-    products = get_products_from_db(available_only=True)
+    products = [product for product in product_search_index.products.values() if not is_sold_out(product[0])] # Served from the catalog cache
     keyboard, text_to_send = [], ""
     if not products:
         text_to_send = await _(context, "no_products_available", user_id=uid)
         keyboard.append([InlineKeyboardButton(await _(context, "back_to_main_menu_button", user_id=uid), callback_data="main_menu_direct_cb_ender")])
     else:
         text_to_send = await _(context, "products_title", user_id=uid)
-        for pid, name, price, _avail in products:
-            keyboard.append([InlineKeyboardButton(f"{name} - {price:.2f} EUR/kg", callback_data=f"order_flow_select_prod_{pid}")])
+        lang_code = await get_user_language(context, uid)
+        for pid, name, price, _avail, _stock in products:
+            label = f"{name} - {price:.2f} EUR/kg"
+            if pid in catalog_stock: label += " " + translate(lang_code, "product_stock_left", stock=f"{catalog_stock[pid]:g}", default=f"({catalog_stock[pid]:g} kg left)")
+            keyboard.append([InlineKeyboardButton(label, callback_data=f"order_flow_select_prod_{pid}")])
         keyboard.append([InlineKeyboardButton(await _(context, "view_cart_button", user_id=uid), callback_data="order_flow_view_cart_state_cb")])
         keyboard.append([InlineKeyboardButton(await _(context, "back_to_main_menu_button", user_id=uid), callback_data="main_menu_direct_cb_ender")])
 
@@ -487,29 +478,35 @@ async def order_flow_list_products(update:Update,context:ContextTypes.DEFAULT_TY
         elif uid: # Fallback if no direct message to edit/reply to
             await context.bot.send_message(chat_id=uid, text=text_to_send, reply_markup=reply_markup)
     except Exception as e:
-        logger.error(f"Error in order_flow_list_products (edit={edit_message}): {e}")
+        logger.error("Error in order_flow_list_products (edit=%s): %s", edit_message, e)
         if uid: # Fallback send if primary send failed
             try:
                 await context.bot.send_message(chat_id=uid, text=text_to_send, reply_markup=reply_markup)
             except Exception as send_e:
-                logger.error(f"Fallback send_message in order_flow_list_products also failed: {send_e}")
+                logger.error("Fallback send_message in order_flow_list_products also failed: %s", send_e)
     return ORDER_FLOW_BROWSING_PRODUCTS
 
+@log_handler
 async def order_flow_product_selected(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
     q=update.callback_query;await q.answer();uid=q.from_user.id
     try:pid=int(q.data.split('_')[-1])
     except (IndexError, ValueError):
-        logger.warning(f"Failed to parse product ID from callback data: {q.data}")
+        logger.warning("Failed to parse product ID from callback data: %s", q.data)
         await q.edit_message_text(await _(context,"generic_error_message",user_id=uid,default="Error selecting product. Please try again."))
         return ORDER_FLOW_BROWSING_PRODUCTS # Go back to browsing
-    prod=get_product_by_id(pid)
+    prod=await storage.get_product(pid)
     if not prod:
         await q.edit_message_text(await _(context,"product_not_found",user_id=uid,default="Product not found."))
         return ORDER_FLOW_BROWSING_PRODUCTS
+    if prod[4] is not None and prod[4] <= 0: # Sold out since the list was shown
+        kb=[[InlineKeyboardButton(await _(context,"browse_products_button",user_id=uid),callback_data="order_flow_browse_return_cb")]]
+        await q.edit_message_text(await _(context,"product_sold_out",user_id=uid,product_name=prod[1],default=f"{prod[1]} is sold out."),reply_markup=InlineKeyboardMarkup(kb))
+        return ORDER_FLOW_BROWSING_PRODUCTS
     context.user_data.update({'current_product_id':pid,'current_product_name':prod[1],'current_product_price':prod[2]})
     await q.edit_message_text(await _(context,"product_selected_prompt",user_id=uid,product_name=prod[1]))
     return ORDER_FLOW_SELECTING_QUANTITY
 
+@log_handler
 async def order_flow_quantity_typed(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
     uid=update.effective_user.id;q_str=update.message.text
     try:qnt=float(q_str);assert qnt>0
@@ -524,6 +521,11 @@ async def order_flow_quantity_typed(update:Update,context:ContextTypes.DEFAULT_T
         return await order_flow_list_products(update,context,uid,False) # False as we reply to update.message
 
     cart=context.user_data.setdefault('cart',[])
+    stock=catalog_stock.get(pid)
+    in_cart=sum(item['quantity'] for item in cart if item['id']==pid)
+    if stock is not None and in_cart+qnt>stock: # Early hint from the catalog cache; checkout makes the binding check
+        await update.message.reply_text(await _(context,"not_enough_stock",user_id=uid,product_name=pname,stock=f"{max(stock-in_cart,0):g}",default=f"Only {max(stock-in_cart,0):g} kg of {pname} left."))
+        return ORDER_FLOW_SELECTING_QUANTITY
     found_item = next((item for item in cart if item['id'] == pid), None)
     if found_item:
         found_item['quantity'] += qnt
@@ -536,14 +538,36 @@ async def order_flow_quantity_typed(update:Update,context:ContextTypes.DEFAULT_T
     # After typing quantity, user is effectively back to browsing state logically, even if UI implies cart view
     return ORDER_FLOW_BROWSING_PRODUCTS
 
+@log_handler
 async def order_flow_view_cart_state_cb(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
     q=update.callback_query;await q.answer();uid=q.from_user.id;
     return await order_flow_display_cart(update,context,uid,True)
 
+@log_handler
 async def order_flow_view_cart_direct_entry(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
     q=update.callback_query;await q.answer();uid=q.from_user.id;context.user_data.setdefault('cart',[])
     await order_flow_display_cart(update,context,uid,True);return ORDER_FLOW_VIEWING_CART
 
+@log_handler
+async def order_flow_repeat_last_order_entry(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
+    # Rebuilds the cart from the user's last order in one query, at current catalog prices; products that are no
+    # longer available or are sold out are skipped, quantities are capped at the stock left
+    q=update.callback_query;uid=q.from_user.id
+    items=await storage.get_last_order_items(uid)
+    if not items:
+        await q.answer(await _(context,"repeat_order_none",user_id=uid,default="You have no previous order to repeat."),show_alert=True)
+        return ConversationHandler.END
+    cart,skipped=[],0
+    for pid,quantity in items:
+        product=product_search_index.products.get(pid) # The catalog cache only holds available products
+        stock=catalog_stock.get(pid)
+        if product is None or (stock is not None and stock<=0): skipped+=1; continue
+        cart.append({'id':pid,'name':product[1],'price':product[2],'quantity':quantity if stock is None else min(quantity,stock)})
+    context.user_data['cart']=cart
+    context.user_data.pop('cart_token',None) # A new cart, so checkout gets a new idempotency key
+    await q.answer(await _(context,"repeat_order_skipped",user_id=uid,count=skipped,default=f"{skipped} products are no longer available.") if skipped else None)
+    return await order_flow_display_cart(update,context,uid,True)
+
 async def order_flow_display_cart(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, edit_message: bool) -> int:
     cart = context.user_data.get('cart', [])
     query = update.callback_query
@@ -575,19 +599,20 @@ async def order_flow_display_cart(update: Update, context: ContextTypes.DEFAULT_
         elif user_id: # Fallback if no direct message context (e.g. if called programmatically without update)
             await context.bot.send_message(chat_id=user_id, text=text_to_send, reply_markup=reply_markup)
     except Exception as e:
-        logger.error(f"Error in order_flow_display_cart (edit={edit_message}): {e}")
+        logger.error("Error in order_flow_display_cart (edit=%s): %s", edit_message, e)
         if user_id:
             try:
                 await context.bot.send_message(chat_id=user_id, text=text_to_send, reply_markup=reply_markup)
             except Exception as send_e:
-                logger.error(f"Fallback send_message in order_flow_display_cart also failed: {send_e}")
+                logger.error("Fallback send_message in order_flow_display_cart also failed: %s", send_e)
     return ORDER_FLOW_VIEWING_CART
 
+@log_handler
 async def order_flow_remove_item_cb(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
     q=update.callback_query;await q.answer();uid=q.from_user.id
     try:idx=int(q.data.split('_')[-1])
     except (IndexError, ValueError):
-        logger.warning(f"Failed to parse item index from callback data: {q.data}")
+        logger.warning("Failed to parse item index from callback data: %s", q.data)
         # Do not reply to q.message here, as display_cart will edit it.
         # Just log and let display_cart show the current state.
         return await order_flow_display_cart(update,context,uid,True)
@@ -603,7 +628,27 @@ async def order_flow_remove_item_cb(update:Update,context:ContextTypes.DEFAULT_T
         pass # Error, cart will be re-rendered showing no change
     return await order_flow_display_cart(update,context,uid,True) # Re-display cart
 
+# --- Checkout Idempotency ---
+# Double taps on "Checkout" are serialized by a per-user lock and deduplicated by an idempotency key
+# (unique in the orders table), so a retry costs one indexed lookup instead of a second order.
+_checkout_locks = weakref.WeakValueDictionary() # user_id -> asyncio.Lock, kept alive only while a checkout holds it
+
+def checkout_idempotency_key(user_id: int, cart: list, user_data: dict) -> str:
+    # The cart token is dropped after every successful checkout, so ordering an identical cart again later
+    # still creates a new order, while repeated taps on the same cart map to the same key.
+    cart_token = user_data.setdefault('cart_token', uuid.uuid4().hex)
+    snapshot = sorted((item['id'], round(item['quantity'], 3), round(item['price'], 2)) for item in cart)
+    return hashlib.sha256(json.dumps([user_id, cart_token, snapshot]).encode()).hexdigest()
+
+@log_handler
 async def order_flow_checkout_cb(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
+    uid=update.callback_query.from_user.id
+    checkout_lock=_checkout_locks.get(uid)
+    if checkout_lock is None: checkout_lock=_checkout_locks[uid]=asyncio.Lock()
+    async with checkout_lock:
+        return await _order_flow_checkout(update,context)
+
+async def _order_flow_checkout(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
     q=update.callback_query;await q.answer();user=q.from_user;uid=user.id;cart=context.user_data.get('cart',[])
     if not cart:
         await q.edit_message_text(await _(context,"cart_empty",user_id=uid))
@@ -613,32 +658,25 @@ async def order_flow_checkout_cb(update:Update,context:ContextTypes.DEFAULT_TYPE
         await q.message.reply_text(await _(context, "what_next_prompt", user_id=uid), reply_markup=InlineKeyboardMarkup(kb))
         return ORDER_FLOW_VIEWING_CART # Or BROWSE_PRODUCTS
 
-    uname=(user.full_name or "N/A");total=sum(i['price']*i['quantity'] for i in cart);oid=save_order_to_db(uid,uname,cart,total)
-    admin_lang_for_notification = ADMIN_IDS[0] if ADMIN_IDS else None # Use first admin's lang or default
+    uname=(user.full_name or "N/A");total=sum(i['price']*i['quantity'] for i in cart)
+    idempotency_key=checkout_idempotency_key(uid,cart,context.user_data)
+    oid=await storage.get_order_id_by_idempotency_key(idempotency_key);created=False
+    if oid is None:
+        try: oid,created=await storage.save_order(uid,uname,cart,total,idempotency_key=idempotency_key)
+        except InsufficientStock as e: # Nothing was saved; the cart stays as it is for the user to adjust
+            short_names=", ".join(item['name'] for item in cart if item['id'] in e.product_ids)
+            await q.edit_message_text(await _(context,"checkout_insufficient_stock",user_id=uid,products=short_names,default=f"Not enough stock left for: {short_names}"))
+            await refresh_product_search_index() # The cached stock was behind the database
+            return await order_flow_display_cart(update,context,uid,False)
 
     if oid:
         await q.edit_message_text(await _(context,"order_placed_success",user_id=uid,order_id=oid,total_price=f"{total:.2f}"))
-        # Admin Notification
-        admin_title=await _(context,"admin_new_order_notification_title",user_id=admin_lang_for_notification,order_id=oid,default=f"🔔 New Order #{oid}")
-        admin_msg_body = await _(context,"admin_order_from",user_id=admin_lang_for_notification,name=uname,username=(f"@{user.username}" if user.username else "N/A"),customer_id=uid,default=f"From:{uname}...")+"\n\n"+await _(context,"admin_order_items_header",user_id=admin_lang_for_notification,default="Items:")+"\n------------------------------------\n"
-        item_lines=[await _(context,"admin_order_item_line_format",user_id=admin_lang_for_notification,index=i+1,item_name=c['name'],quantity=f"{c['quantity']:.2f}",price_per_kg=f"{c['price']:.2f}",item_subtotal=f"{(c['price']*c['quantity']):.2f}",default=f"{i+1}. {c['name']}: ...")for i,c in enumerate(cart)]
-        admin_msg_body+= "\n".join(item_lines)+"\n------------------------------------\n"+await _(context,"admin_order_grand_total",user_id=admin_lang_for_notification,total_price=f"{total:.2f}",default=f"Total:{total:.2f} EUR")
-        full_admin_msg = f"{admin_title}\n{admin_msg_body}"
-
-        if ADMIN_IDS:
-            for admin_id_val in ADMIN_IDS:
-                try:
-                    # Split message if too long
-                    if len(full_admin_msg) > 4096:
-                        for i_part in range(0, len(full_admin_msg), 4096):
-                            await context.bot.send_message(chat_id=admin_id_val, text=full_admin_msg[i_part:i_part+4096])
-                    else:
-                        await context.bot.send_message(chat_id=admin_id_val,text=full_admin_msg)
-                except Exception as e:logger.error(f"Failed to notify admin {admin_id_val} about new order {oid}: {e}")
+        if created: # Admin Notification (skipped when a duplicate tap found the existing order)
+            await notify_admins_of_order(context,oid,{"name":uname,"username":user.username or "N/A","customer_id":uid},cart,total)
 
         # Clear cart and related user_data, preserve language
         lang_code = context.user_data.get('language_code')
-        keys_to_pop=['cart','current_product_id','current_product_name','current_product_price']
+        keys_to_pop=['cart','cart_token','current_product_id','current_product_name','current_product_price']
         for k_pop in keys_to_pop: context.user_data.pop(k_pop,None)
         if lang_code: context.user_data['language_code']=lang_code
 
@@ -656,16 +694,145 @@ async def order_flow_checkout_cb(update:Update,context:ContextTypes.DEFAULT_TYPE
         return ORDER_FLOW_VIEWING_CART
     return ConversationHandler.END
 
+# --- Admin Order Notifications ---
+# A new order is rendered once per distinct admin language and the same chunks are sent to every admin using it.
+# The templates are resolved once per language (again after a locale reload), not looked up once per cart line.
+ADMIN_ORDER_TEMPLATES = { # name -> (translation key, default text)
+    "title": ("admin_new_order_notification_title", "🔔 New Order #{order_id}"),
+    "customer": ("admin_order_from", "From: {name} (@{username}, ID: {customer_id})"),
+    "items_header": ("admin_order_items_header", "Items:"),
+    "item_line": ("admin_order_item_line_format", "{index}. {item_name}: {quantity} kg x {price_per_kg:.2f} EUR/kg = {item_subtotal:.2f} EUR"),
+    "grand_total": ("admin_order_grand_total", "Total: {total_price:.2f} EUR"),
+}
+ADMIN_ORDER_SEPARATOR = "------------------------------------"
+_admin_order_templates = {} # lang_code -> (translations dict they were resolved from, {name: template})
+
+def admin_order_templates(lang_code: str) -> dict:
+    cached = _admin_order_templates.get(lang_code)
+    if cached and cached[0] is translations: return cached[1]
+    templates = {name: translation_template(lang_code, key, default) for name, (key, default) in ADMIN_ORDER_TEMPLATES.items()}
+    _admin_order_templates[lang_code] = (translations, templates)
+    return templates
+
+def _format_admin_order(templates: dict, order_id: int, customer: dict, cart: list, total: float) -> str:
+    item_line = templates["item_line"]
+    lines = [templates["title"].format(order_id=order_id), templates["customer"].format(**customer), "", templates["items_header"], ADMIN_ORDER_SEPARATOR]
+    lines.extend(item_line.format(index=index, item_name=item['name'], quantity=f"{item['quantity']:.2f}", price_per_kg=item['price'], item_subtotal=item['price'] * item['quantity'])
+                 for index, item in enumerate(cart, start=1))
+    lines += [ADMIN_ORDER_SEPARATOR, templates["grand_total"].format(total_price=total)]
+    return "\n".join(lines)
+
+def render_admin_order_notification(lang_code: str, order_id: int, customer: dict, cart: list, total: float) -> str:
+    # customer: name, username, customer_id
+    try:
+        return _format_admin_order(admin_order_templates(lang_code), order_id, customer, cart, total)
+    except (KeyError, IndexError, ValueError) as e: # A translation with placeholders the code does not supply
+        logger.warning("Admin order notification template for '%s' failed (%s), using the defaults", lang_code, e)
+        return _format_admin_order({name: default for name, (_key, default) in ADMIN_ORDER_TEMPLATES.items()}, order_id, customer, cart, total)
+
+def split_message_on_lines(text: str, limit: int = MessageLimit.MAX_TEXT_LENGTH) -> list:
+    # Chunks of at most limit characters, cut between lines: only the newline at each cut is dropped, so blank lines
+    # survive and "\n".join(chunks) == text. Only a single line longer than limit is cut inside.
+    chunks, current = [], None # current: the chunk being built, None until its first line
+    for line in text.split("\n"):
+        if len(line) > limit:
+            if current is not None: chunks.append(current)
+            pieces = [line[start:start + limit] for start in range(0, len(line), limit)]
+            chunks.extend(pieces[:-1]); line, current = pieces[-1], None # The last piece starts the next chunk
+        if current is None: current = line
+        elif len(current) + 1 + len(line) <= limit: current += "\n" + line
+        else: chunks.append(current); current = line
+    chunks.append(current)
+    return chunks
+
+async def notify_admins_of_order(context: ContextTypes.DEFAULT_TYPE, order_id: int, customer: dict, cart: list, total: float) -> None:
+    if not ADMIN_IDS: return
+    admin_languages = await asyncio.gather(*(storage.get_user_language(admin_id) for admin_id in ADMIN_IDS))
+    rendered = {} # lang_code -> message chunks, shared by every admin with that language
+    for admin_id, lang_code in zip(ADMIN_IDS, admin_languages):
+        lang_code = lang_code or DEFAULT_LANGUAGE
+        if lang_code not in rendered:
+            rendered[lang_code] = split_message_on_lines(render_admin_order_notification(lang_code, order_id, customer, cart, total))
+        try:
+            for chunk in rendered[lang_code]: await context.bot.send_message(chat_id=admin_id, text=chunk)
+        except Exception as e: logger.error("Failed to notify admin %s about new order %s: %s", admin_id, order_id, e)
+
+@log_handler
 async def my_orders_direct_cb(update:Update,context:ContextTypes.DEFAULT_TYPE):
-    q=update.callback_query;await q.answer();uid=q.from_user.id;orders=get_user_orders_from_db(uid)
+    q=update.callback_query;await q.answer();uid=q.from_user.id;orders=await storage.get_user_orders(uid)
     txt=await _(context,"my_orders_title",user_id=uid,default="Orders:")+"\n\n" if orders else await _(context,"no_orders_yet",user_id=uid)
     if orders:
         for oid,date_str,total_val,status_str,items_str in orders:
             # Ensure items_str is treated as a simple string if it's already concatenated by DB
-            txt+=await _(context,"order_details_format",user_id=uid,order_id=oid,date=date_str,status=status_str.capitalize(),total=f"{total_val:.2f}",items=items_str.replace(chr(10), ", ") if items_str else "N/A",default="Order...")
+            status_txt=await _(context,f"order_status_{status_str}",user_id=uid,default=status_str.capitalize())
+            txt+=await _(context,"order_details_format",user_id=uid,order_id=oid,date=date_str,status=status_txt,total=f"{total_val:.2f}",items=items_str.replace(chr(10), ", ") if items_str else "N/A",default="Order...")
     kb=[[InlineKeyboardButton(await _(context,"back_to_main_menu_button",user_id=uid),callback_data="main_menu_direct_cb_ender")]]
     await q.edit_message_text(text=txt,reply_markup=InlineKeyboardMarkup(kb))
 
+# --- Inline Product Search ---
+# Typing "@<bot> pomid" in any chat (inline mode must be enabled in @BotFather) lists matching products.
+# Results come from an in-memory index that is rebuilt whenever storage reports a catalog change,
+# plus every CATALOG_REFRESH_SECONDS so worker processes also pick up changes made in other processes.
+INLINE_SEARCH_LIMIT = 20
+INLINE_SEARCH_CACHE_SECONDS = 30
+CATALOG_REFRESH_SECONDS = int(os.getenv("CATALOG_REFRESH_SECONDS", "300"))
+PRODUCT_DEEP_LINK_PATTERN = r"^/start product_(\d+)$" # Sent by the "Order" button under an inline result
+product_search_index = ProductSearchIndex([])
+catalog_stock = {} # product_id -> kg left, for available products whose stock is tracked; the catalog cache for stock reads
+
+async def refresh_product_search_index() -> None:
+    global product_search_index, catalog_stock
+    products = await storage.get_products(available_only=True)
+    # Swapped together with no await in between
+    product_search_index, catalog_stock = ProductSearchIndex(products), {product[0]: product[4] for product in products if product[4] is not None}
+
+async def update_catalog_stock(levels: dict) -> None:
+    # Stock listener: an order in this process left these levels, no need to rebuild the index for them
+    catalog_stock.update(levels)
+
+def is_sold_out(product_id: int) -> bool:
+    stock = catalog_stock.get(product_id)
+    return stock is not None and stock <= 0
+
+async def refresh_catalog_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    await refresh_product_search_index()
+
+async def backfill_sales_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # One-off: folds orders placed before the sales rollups existed into them; a no-op once done
+    folded = await storage.backfill_daily_sales()
+    if folded: logger.info("Sales rollup backfill folded in %s orders", folded)
+
+@log_handler
+async def inline_product_search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    iq = update.inline_query; uid = iq.from_user.id
+    results = []
+    for pid, name, price, _avail, _stock in product_search_index.search(iq.query, limit=INLINE_SEARCH_LIMIT):
+        if is_sold_out(pid): continue
+        price_txt = f"{price:.2f}"
+        order_button = InlineKeyboardButton(await _(context, "inline_search_order_button", user_id=uid, default="🛒 Order"),
+                                            url=f"https://t.me/{context.bot.username}?start=product_{pid}")
+        results.append(InlineQueryResultArticle(
+            id=str(pid), title=name,
+            description=await _(context, "inline_search_result_description", user_id=uid, price=price_txt, default=f"{price_txt} EUR/kg"),
+            input_message_content=InputTextMessageContent(await _(context, "inline_search_result_text", user_id=uid, product_name=name, price=price_txt, default=f"{name} - {price_txt} EUR/kg")),
+            reply_markup=InlineKeyboardMarkup([[order_button]])))
+    # Results are localized, so Telegram must not share its cache between users
+    await iq.answer(results, cache_time=INLINE_SEARCH_CACHE_SECONDS, is_personal=True)
+
+@log_handler
+async def order_flow_deep_link_entry(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    user = update.effective_user; uid = user.id
+    await ensure_user_exists(uid, user.first_name or "", user.username or "", context)
+    pid = int(context.matches[0].group(1)) if context.matches else None
+    prod = await storage.get_product(pid) if pid is not None else None
+    if not prod or not prod[3] or (prod[4] is not None and prod[4] <= 0): # Unknown, no longer available or sold out
+        await update.message.reply_text(await _(context, "product_not_found", user_id=uid, default="Product not found."))
+        await display_main_menu(update, context, edit_message=False)
+        return ConversationHandler.END
+    context.user_data.update({'current_product_id':pid,'current_product_name':prod[1],'current_product_price':prod[2]})
+    await update.message.reply_text(await _(context, "product_selected_prompt", user_id=uid, product_name=prod[1]))
+    return ORDER_FLOW_SELECTING_QUANTITY
+
 # --- Admin Panel and Flows ---
 async def display_admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE, edit_message: bool = False) -> int:
     user = update.effective_user;
@@ -680,29 +847,21 @@ async def display_admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE
         return ConversationHandler.END # End conv if unauthorized
 
     context.chat_data['user_id_for_translation'] = user_id # For _() to use admin's lang
-    kb = [
-        [InlineKeyboardButton(await _(context,"admin_add_product_button",user_id=user_id),callback_data="admin_add_prod_entry_cb")],
-        [InlineKeyboardButton(await _(context,"admin_manage_products_button",user_id=user_id),callback_data="admin_manage_prod_list_entry_cb")],
-        [InlineKeyboardButton(await _(context,"admin_view_orders_button",user_id=user_id),callback_data="admin_view_orders_direct_cb")],
-        [InlineKeyboardButton(await _(context,"admin_shopping_list_button",user_id=user_id),callback_data="admin_shop_list_direct_cb")],
-        [InlineKeyboardButton(await _(context,"admin_clear_orders_button", user_id=user_id, default="🧹 Clear Completed Orders"), callback_data="admin_clear_orders_entry_cb")],
-        [InlineKeyboardButton(await _(context,"admin_exit_button",user_id=user_id),callback_data="main_menu_direct_cb_ender")]
-    ]
-    title = await _(context,"admin_panel_title",user_id=user_id)
+    title, reply_markup = admin_panel_view(await get_user_language(context, user_id))
     target_msg_obj = update.callback_query.message if edit_message and update.callback_query else update.message
-    reply_markup = InlineKeyboardMarkup(kb)
 
     try:
         if edit_message and target_msg_obj: await target_msg_obj.edit_text(title,reply_markup=reply_markup)
         elif update.message : await update.message.reply_text(title,reply_markup=reply_markup) # From /admin command
         elif user_id: await context.bot.send_message(chat_id=user_id, text=title,reply_markup=reply_markup) # Fallback
     except Exception as e:
-        logger.warning(f"Display admin panel error (edit={edit_message}): {e}")
+        logger.warning("Display admin panel error (edit=%s): %s", edit_message, e)
         if user_id and not (edit_message and target_msg_obj) and not update.message :
             try: await context.bot.send_message(chat_id=user_id, text=title,reply_markup=reply_markup)
-            except Exception as send_e: logger.error(f"Fallback display_admin_panel send error: {send_e}")
+            except Exception as send_e: logger.error("Fallback display_admin_panel send error: %s", send_e)
     return ADMIN_MAIN_PANEL_STATE # State for conversation if used in one
 
+@log_handler
 async def admin_command_entry(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     # Clear admin-specific transient data when entering admin panel via /admin command
     context.user_data.pop('editing_pid', None)
@@ -710,23 +869,27 @@ async def admin_command_entry(update: Update, context: ContextTypes.DEFAULT_TYPE
     context.user_data.pop('admin_product_options_message_to_edit', None)
     return await display_admin_panel(update,context, edit_message=False) # False as it's from a command
 
+@log_handler
 async def admin_panel_return_direct_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
-    logger.info(f"admin_panel_return_direct_cb triggered by user {query.from_user.id if query else 'Unknown'} with data: {query.data if query else 'N/A'}")
+    logger.info("admin_panel_return_direct_cb triggered by user %s with data: %s", query.from_user.id if query else 'Unknown', query.data if query else 'N/A', extra=SAMPLED)
     if query: await query.answer()
     # Clear transient admin data when returning to main admin panel
     context.user_data.pop('editing_pid', None)
     context.user_data.pop('new_pname', None)
     context.user_data.pop('admin_product_options_message_to_edit', None)
     return_state = await display_admin_panel(update,context,True) # True: edit the message
-    logger.info(f"display_admin_panel in admin_panel_return_direct_cb returned state:{return_state}")
+    logger.info("display_admin_panel in admin_panel_return_direct_cb returned state:%s", return_state, extra=SAMPLED)
     return return_state
 
 # Admin Add Product
+@log_handler
 async def admin_add_prod_entry_cb(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
     q=update.callback_query;await q.answer();uid=q.from_user.id;await q.edit_message_text(await _(context,"admin_enter_product_name",user_id=uid));return ADMIN_ADD_PROD_NAME
+@log_handler
 async def admin_add_prod_name_state(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
     uid=update.effective_user.id;pname=update.message.text;context.user_data['new_pname']=pname;await update.message.reply_text(await _(context,"admin_enter_product_price",user_id=uid,product_name=pname));return ADMIN_ADD_PROD_PRICE
+@log_handler
 async def admin_add_prod_price_state(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
     user_id=update.effective_user.id; name=context.user_data.get('new_pname')
     try: price_str = update.message.text; price=float(price_str); assert price>0
@@ -740,7 +903,7 @@ async def admin_add_prod_price_state(update:Update,context:ContextTypes.DEFAULT_
         return ConversationHandler.END
 
     format_kwargs={'user_id':user_id,'product_name':name}
-    msg_key="admin_product_added" if add_product_to_db(name,price) else "admin_product_add_failed"
+    msg_key="admin_product_added" if await storage.add_product(name,price) else "admin_product_add_failed"
     if msg_key=="admin_product_added": format_kwargs['price']=f"{price:.2f}"
     await update.message.reply_text(await _(context,msg_key,**format_kwargs))
 
@@ -749,24 +912,27 @@ async def admin_add_prod_price_state(update:Update,context:ContextTypes.DEFAULT_
     return ConversationHandler.END
 
 # Admin Manage Products
+@log_handler
 async def admin_manage_prod_list_entry_cb(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
     q=update.callback_query;await q.answer();uid=q.from_user.id
     context.user_data.pop('editing_pid',None) # Clear any previous editing ID
     context.user_data.pop('admin_product_options_message_to_edit', None) # Clear message ref
 
-    prods=get_products_from_db(False);kb,txt=[],""
+    prods=await storage.get_products(False);kb,txt=[],""
     if not prods:
         txt=await _(context,"admin_no_products_to_manage",user_id=uid)
         kb.append([InlineKeyboardButton(await _(context,"admin_back_to_admin_panel_button",user_id=uid),callback_data="admin_panel_return_direct_cb")])
     else:
         txt=await _(context,"admin_select_product_to_manage",user_id=uid)
-        for pid,name,price,avail in prods:
+        for pid,name,price,avail,stock in prods:
             stat_key="admin_status_available" if avail else "admin_status_unavailable"
             stat=await _(context,stat_key,user_id=uid,default="Available" if avail else "Unavailable")
-            kb.append([InlineKeyboardButton(f"{name} - {price:.2f} EUR ({stat})",callback_data=f"admin_manage_select_prod_{pid}")])
+            stock_txt=f" · {stock:g} kg" if stock is not None else ""
+            kb.append([InlineKeyboardButton(f"{name} - {price:.2f} EUR ({stat}){stock_txt}",callback_data=f"admin_manage_select_prod_{pid}")])
         kb.append([InlineKeyboardButton(await _(context,"admin_back_to_admin_panel_button",user_id=uid),callback_data="admin_panel_return_direct_cb")])
     await q.edit_message_text(text=txt,reply_markup=InlineKeyboardMarkup(kb));return ADMIN_MANAGE_PROD_LIST
 
+@log_handler
 async def admin_manage_prod_selected_cb(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
     # This can be called by a real callback or a mock update
     q = update.callback_query
@@ -777,23 +943,49 @@ async def admin_manage_prod_selected_cb(update:Update,context:ContextTypes.DEFAU
     except (IndexError, ValueError):
         await q.message.edit_text(await _(context,"generic_error_message",user_id=uid,default="Error parsing product ID."))
         return ADMIN_MANAGE_PROD_LIST
-    prod=get_product_by_id(pid)
+    prod=await storage.get_product(pid)
     if not prod:
         await q.message.edit_text(await _(context,"product_not_found",user_id=uid,default="Product not found."))
         return ADMIN_MANAGE_PROD_LIST # Go back to list
 
     context.user_data['editing_pid']=pid
-    pname,pprice,pavail=prod[1],prod[2],prod[3]
-    avail_key="admin_set_unavailable_button" if pavail else "admin_set_available_button"
-    kb=[
-        [InlineKeyboardButton(await _(context,"admin_change_price_button",user_id=uid,price=f"{pprice:.2f}"),callback_data="admin_manage_edit_price_entry_cb")],
-        [InlineKeyboardButton(await _(context,avail_key,user_id=uid),callback_data=f"admin_manage_toggle_avail_cb_{1-pavail}")], # Toggle 0 to 1, 1 to 0
-        [InlineKeyboardButton(await _(context,"admin_delete_product_button",user_id=uid),callback_data="admin_manage_delete_confirm_cb")],
-        [InlineKeyboardButton(await _(context,"admin_back_to_product_list_button",user_id=uid),callback_data="admin_manage_prod_list_refresh_cb")]
-    ]
-    await q.message.edit_text(await _(context,"admin_managing_product",user_id=uid,product_name=pname),reply_markup=InlineKeyboardMarkup(kb))
+    text,reply_markup=admin_product_options_view(await get_user_language(context,uid),prod)
+    await q.message.edit_text(text,reply_markup=reply_markup)
     return ADMIN_MANAGE_PROD_OPTIONS
 
+@log_handler
+async def admin_manage_edit_stock_entry_cb(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
+    q=update.callback_query;await q.answer();uid=q.from_user.id;edit_pid=context.user_data.get('editing_pid')
+    prod=await storage.get_product(edit_pid) if edit_pid else None
+    if not prod:
+        await q.message.edit_text(await _(context,"product_not_found",user_id=uid,default="Product not found."))
+        return await admin_manage_prod_list_entry_cb(update, context)
+    current=f"{prod[4]:g} kg" if prod[4] is not None else await _(context,"admin_stock_not_tracked",user_id=uid,default="not tracked")
+    await q.message.edit_text(await _(context,"admin_enter_stock",user_id=uid,product_name=prod[1],stock=current,default=f"Enter the stock in kg for {prod[1]} (current: {current}), or - to stop tracking it:"))
+    return ADMIN_MANAGE_PROD_EDIT_STOCK
+
+@log_handler
+async def admin_manage_edit_stock_state(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
+    uid=update.effective_user.id;edit_pid=context.user_data.get('editing_pid');raw=update.message.text.strip()
+    if not edit_pid:
+        await update.message.reply_text(await _(context,"generic_error_message",user_id=uid,default="Error: Product ID missing. Session may have expired."))
+        return await display_admin_panel(update,context,edit_message=False)
+    try:
+        stock=None if raw=="-" else float(raw.replace(",","."))
+        assert stock is None or stock>=0
+    except (ValueError, AssertionError):
+        await update.message.reply_text(await _(context,"admin_invalid_stock",user_id=uid,default="Invalid stock. Enter a number of kg (0 or more), or - to stop tracking."))
+        return ADMIN_MANAGE_PROD_EDIT_STOCK
+    ok=await storage.set_product_stock(edit_pid,stock)
+    msg_key="admin_stock_updated" if ok else "admin_stock_update_failed"
+    await update.message.reply_text(await _(context,msg_key,user_id=uid,product_id=edit_pid,default="Stock updated." if ok else "Stock update failed."))
+    prod=await storage.get_product(edit_pid)
+    if not prod: return await display_admin_panel(update,context,edit_message=False)
+    text,reply_markup=admin_product_options_view(await get_user_language(context,uid),prod) # Fresh options menu below the confirmation
+    await update.message.reply_text(text,reply_markup=reply_markup)
+    return ADMIN_MANAGE_PROD_OPTIONS
+
+@log_handler
 async def admin_manage_edit_price_entry_cb(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
     q=update.callback_query;await q.answer();uid=q.from_user.id;edit_pid=context.user_data.get('editing_pid')
     if not edit_pid:
@@ -804,26 +996,26 @@ async def admin_manage_edit_price_entry_cb(update:Update,context:ContextTypes.DE
         return await admin_manage_prod_list_entry_cb(update, context)
 
 
-    prod=get_product_by_id(edit_pid)
+    prod=await storage.get_product(edit_pid)
     if not prod:
         await q.message.edit_text(await _(context,"product_not_found",user_id=uid,default="Product not found for price edit."))
         q.data = "admin_manage_prod_list_refresh_cb"
         return await admin_manage_prod_list_entry_cb(update, context)
 
-    # Store the message object that is being edited (the product options menu)
-    # so we can update it after the user provides the new price.
-    context.user_data['admin_product_options_message_to_edit'] = q.message
+    # Remember which message holds the product options menu so it can be redrawn after the user sends the new price
+    context.user_data['admin_product_options_message_to_edit'] = (q.message.chat_id, q.message.message_id)
 
-    await q.message.edit_text(await _(context,"admin_enter_new_price",user_id=uid,product_name=prod[1],current_price=f"{prod[2]:.2f}"))
+    await q.message.edit_text(await _(context,"admin_enter_new_price",user_id=uid,product_name=prod[1],current_price=prod[2]))
     return ADMIN_MANAGE_PROD_EDIT_PRICE
 
+@log_handler
 async def admin_manage_edit_price_state(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_id = update.effective_user.id
     new_price_str = update.message.text # User's input for the new price
     editing_pid = context.user_data.get('editing_pid')
 
-    # Retrieve the original options menu message we stored
-    original_options_message: Message | None = context.user_data.pop('admin_product_options_message_to_edit', None)
+    # (chat_id, message_id) of the options menu we are going to redraw
+    options_message = context.user_data.pop('admin_product_options_message_to_edit', None)
 
     if not editing_pid:
         await update.message.reply_text(await _(context, "generic_error_message", user_id=user_id, default="Error: Product ID missing for price update. Session may have expired."))
@@ -835,52 +1027,35 @@ async def admin_manage_edit_price_state(update: Update, context: ContextTypes.DE
     except (ValueError, AssertionError):
         await update.message.reply_text(await _(context, "admin_invalid_price", user_id=user_id))
         # If validation fails, re-store the message reference so the next attempt can use it
-        if original_options_message:
-             context.user_data['admin_product_options_message_to_edit'] = original_options_message
+        if options_message:
+             context.user_data['admin_product_options_message_to_edit'] = options_message
         return ADMIN_MANAGE_PROD_EDIT_PRICE # Stay in this state
 
     # Update DB
-    success = update_product_in_db(editing_pid, price=new_price)
+    success = await storage.update_product(editing_pid, price=new_price)
     msg_key = "admin_price_updated" if success else "admin_price_update_failed"
     # Reply to the user's price message to confirm the action
     await update.message.reply_text(await _(context, msg_key, user_id=user_id, product_id=editing_pid))
 
-    if not original_options_message:
-        logger.error("Critical: 'admin_product_options_message_to_edit' not found in user_data. Cannot refresh admin options menu.")
+    prod = await storage.get_product(editing_pid)
+    if not options_message or not prod:
+        if not options_message: logger.error("Critical: 'admin_product_options_message_to_edit' not found in user_data. Cannot refresh admin options menu.")
         # Inform user and go to main admin panel
         await update.message.reply_text(await _(context, "admin_error_refreshing_menu", user_id=user_id, default="Price updated, but menu couldn't refresh automatically. Please navigate back."))
         return await display_admin_panel(update, context, edit_message=False)
 
-    # Now, refresh the product options menu (which is 'original_options_message')
-    # We create a mock Update object with a mock CallbackQuery
-    # This mock CallbackQuery will use 'original_options_message' as its 'message' attribute
-    class MockCallbackQueryForProductOptions:
-        def __init__(self, effective_user_obj, message_to_act_on: Message, product_id_for_data: int):
-            self.from_user = effective_user_obj
-            self.message = message_to_act_on # This is the crucial part: the message to be edited
-            self.data = f"admin_manage_select_prod_{product_id_for_data}"
-            self.id = "mock_callback_query_id" # Needs an ID for answer()
-        async def answer(self): # PTB expects this to be awaitable
-            pass
-
-    mock_cb_query = MockCallbackQueryForProductOptions(
-        effective_user_obj=update.effective_user,
-        message_to_act_on=original_options_message,
-        product_id_for_data=editing_pid
-    )
-
-    mock_update_obj = Update(update_id=update.update_id, callback_query=mock_cb_query)
-    # For PTB<20, effective_user might need to be on Update. For PTB 20+, it's derived.
-    # Ensure effective_user is available for context processing in the next handler.
-    if not hasattr(mock_update_obj, 'effective_user') or not mock_update_obj.effective_user:
-        mock_update_obj.effective_user = update.effective_user
-
-
-    # Call admin_manage_prod_selected_cb with the mock update.
-    # This will make admin_manage_prod_selected_cb edit the 'original_options_message'.
-    return await admin_manage_prod_selected_cb(mock_update_obj, context)
+    # Redraw the options menu (now showing the new price) in the message it was in
+    text, reply_markup = admin_product_options_view(await get_user_language(context, user_id), prod)
+    chat_id, message_id = options_message
+    try:
+        await context.bot.edit_message_text(text, chat_id=chat_id, message_id=message_id, reply_markup=reply_markup)
+    except TelegramError as e: # E.g. the menu message was deleted meanwhile
+        logger.warning("Could not redraw product options menu: %s", e)
+        await update.message.reply_text(text, reply_markup=reply_markup)
+    return ADMIN_MANAGE_PROD_OPTIONS
 
 
+@log_handler
 async def admin_manage_toggle_avail_cb(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
     q=update.callback_query;await q.answer();uid=q.from_user.id;edit_pid=context.user_data.get('editing_pid')
     if not edit_pid:
@@ -895,7 +1070,7 @@ async def admin_manage_toggle_avail_cb(update:Update,context:ContextTypes.DEFAUL
         q.data=f"admin_manage_select_prod_{edit_pid}" # Re-select current product
         return await admin_manage_prod_selected_cb(update,context)
 
-    ok=update_product_in_db(edit_pid,is_available=new_avail)
+    ok=await storage.update_product(edit_pid,is_available=new_avail)
     st_key="admin_status_available_text" if new_avail==1 else "admin_status_unavailable_text"
     st_txt=await _(context,st_key,user_id=uid,default="available" if new_avail==1 else "unavailable")
     msg_key="admin_product_set_status" if ok else "admin_status_update_failed"
@@ -909,6 +1084,7 @@ async def admin_manage_toggle_avail_cb(update:Update,context:ContextTypes.DEFAUL
     q.data=f"admin_manage_select_prod_{edit_pid}"
     return await admin_manage_prod_selected_cb(update,context)
 
+@log_handler
 async def admin_manage_delete_confirm_cb(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
     q=update.callback_query;await q.answer();uid=q.from_user.id;edit_pid=context.user_data.get('editing_pid')
     if not edit_pid:
@@ -916,7 +1092,7 @@ async def admin_manage_delete_confirm_cb(update:Update,context:ContextTypes.DEFA
         q.data = "admin_manage_prod_list_refresh_cb"
         return await admin_manage_prod_list_entry_cb(update, context)
 
-    prod=get_product_by_id(edit_pid)
+    prod=await storage.get_product(edit_pid)
     if not prod:
         await q.message.edit_text(await _(context,"product_not_found",user_id=uid,default="Product not found for deletion."))
         q.data = "admin_manage_prod_list_refresh_cb"
@@ -926,6 +1102,7 @@ async def admin_manage_delete_confirm_cb(update:Update,context:ContextTypes.DEFA
     await q.message.edit_text(await _(context,"admin_confirm_delete_prompt",user_id=uid,product_name=prod[1]),reply_markup=InlineKeyboardMarkup(kb))
     return ADMIN_MANAGE_PROD_DELETE_CONFIRM
 
+@log_handler
 async def admin_manage_delete_do_cb(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
     q=update.callback_query;await q.answer();uid=q.from_user.id;edit_pid=context.user_data.get('editing_pid')
     if not edit_pid:
@@ -933,7 +1110,7 @@ async def admin_manage_delete_do_cb(update:Update,context:ContextTypes.DEFAULT_T
         q.data = "admin_manage_prod_list_refresh_cb"
         return await admin_manage_prod_list_entry_cb(update, context)
 
-    deleted = delete_product_from_db(edit_pid)
+    deleted = await storage.delete_product(edit_pid)
     msg_key="admin_product_deleted" if deleted else "admin_product_delete_failed"
     # Edit the message to confirm deletion (this replaces the Yes/No confirmation)
     await q.message.edit_text(await _(context,msg_key,user_id=uid,product_id=edit_pid))
@@ -950,22 +1127,146 @@ async def admin_manage_delete_do_cb(update:Update,context:ContextTypes.DEFAULT_T
     return await admin_manage_prod_list_entry_cb(update,context)
 
 
+# Admin Bulk Catalog Import/Export
+# One upload replaces a long series of add/edit conversations: rows are matched to products by name,
+# diffed against the current catalog in a single pass and applied in one transaction.
+CATALOG_IMPORT_MAX_BYTES = 5 * 1024 * 1024
+EXPORT_SPOOL_MAX_BYTES = 1024 * 1024 # Generated files spill from memory to a temp file beyond this size
+CATALOG_COLUMNS = ["name", "price_per_kg", "is_available"]
+_AVAILABLE_WORDS = {"1", "true", "yes", "y", "taip"}
+_UNAVAILABLE_WORDS = {"0", "false", "no", "n", "ne"}
+
+def _parse_availability(raw) -> int | None:
+    if raw is None: return None
+    if isinstance(raw, bool): return int(raw) # JSON true/false
+    text = str(raw).strip().lower()
+    if not text: return None # Blank keeps the current availability
+    if text in _AVAILABLE_WORDS: return 1
+    if text in _UNAVAILABLE_WORDS: return 0
+    raise ValueError(f"Invalid availability {raw!r}")
+
+def _iter_catalog_rows(file_name: str, data: bytes):
+    # Yields (row number, row dict). CSV is read row by row; the delimiter (',' ';' or tab) is sniffed.
+    if file_name.lower().endswith(".json"):
+        yield from enumerate(json.loads(data.decode("utf-8-sig")), start=1)
+        return
+    text_stream = io.TextIOWrapper(io.BytesIO(data), encoding="utf-8-sig", newline="")
+    sample = text_stream.read(4096); text_stream.seek(0)
+    try: dialect = csv.Sniffer().sniff(sample, delimiters=",;\t")
+    except csv.Error: dialect = csv.excel
+    reader = csv.DictReader(text_stream, dialect=dialect)
+    for row in reader: yield reader.line_num, row
+
+def diff_catalog(current: dict, rows) -> dict:
+    # current: casefolded name -> (id, price_per_kg, is_available)
+    diff = {"inserts": [], "price_updates": [], "availability_updates": [], "unchanged": 0, "invalid": []}
+    seen_names = set()
+    for row_no, row in rows:
+        try:
+            name = str(row.get("name") or "").strip()
+            name_key = name.casefold()
+            if not name or name_key in seen_names: raise ValueError("Missing or repeated name")
+            raw_price = row.get("price_per_kg", row.get("price"))
+            price = float(str(raw_price).replace(",", ".")) if raw_price not in (None, "") else None
+            if price is not None and not price > 0: raise ValueError("Price must be positive")
+            available = _parse_availability(row.get("is_available"))
+        except (ValueError, TypeError, AttributeError):
+            diff["invalid"].append(row_no); continue
+        seen_names.add(name_key)
+        existing = current.get(name_key)
+        if existing is None:
+            if price is None: diff["invalid"].append(row_no); continue
+            diff["inserts"].append((name, price, 1 if available is None else available))
+            continue
+        pid, current_price, current_available = existing
+        changed = False
+        if price is not None and round(price, 2) != round(current_price, 2):
+            diff["price_updates"].append((price, pid)); changed = True
+        if available is not None and available != current_available:
+            diff["availability_updates"].append((available, pid)); changed = True
+        if not changed: diff["unchanged"] += 1
+    return diff
+
+@log_handler
+async def admin_import_catalog_entry_cb(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
+    q=update.callback_query;await q.answer();uid=q.from_user.id
+    if not(ADMIN_IDS and uid in ADMIN_IDS):
+        await q.edit_message_text(await _(context,"admin_unauthorized",user_id=uid)); return ConversationHandler.END
+    text,reply_markup=admin_prompt_view(await get_user_language(context,uid),"admin_import_catalog_prompt","Send a CSV or JSON file with columns name, price_per_kg, is_available.")
+    await q.edit_message_text(text,reply_markup=reply_markup)
+    return ADMIN_IMPORT_CATALOG_UPLOAD
+
+@log_handler
+async def admin_import_catalog_not_a_file(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
+    uid=update.effective_user.id
+    await update.message.reply_text(await _(context,"admin_import_catalog_bad_file",user_id=uid,max_mb=CATALOG_IMPORT_MAX_BYTES//(1024*1024),default="Please send a .csv or .json file."))
+    return ADMIN_IMPORT_CATALOG_UPLOAD
+
+@log_handler
+async def admin_import_catalog_file_state(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
+    uid=update.effective_user.id;doc=update.message.document
+    if not(ADMIN_IDS and uid in ADMIN_IDS):
+        await update.message.reply_text(await _(context,"admin_unauthorized",user_id=uid)); return ConversationHandler.END
+    file_name=doc.file_name or ""
+    if not file_name.lower().endswith((".csv",".json")) or (doc.file_size or 0)>CATALOG_IMPORT_MAX_BYTES:
+        return await admin_import_catalog_not_a_file(update,context)
+    data=bytes(await (await doc.get_file()).download_as_bytearray())
+    current={name.casefold():(pid,price,avail) async for pid,name,price,avail,_stock in storage.iter_products()}
+    try: diff=diff_catalog(current,_iter_catalog_rows(file_name,data))
+    except (UnicodeDecodeError, json.JSONDecodeError, csv.Error, TypeError) as e:
+        logger.warning("Unreadable catalog upload %s from admin %s: %s", file_name, uid, e)
+        return await admin_import_catalog_not_a_file(update,context)
+
+    ok=True
+    if diff["inserts"] or diff["price_updates"] or diff["availability_updates"]:
+        ok=await storage.apply_catalog_changes(diff["inserts"],diff["price_updates"],diff["availability_updates"])
+    if ok:
+        msg=await _(context,"admin_import_catalog_summary",user_id=uid,inserted=len(diff["inserts"]),price_changes=len(diff["price_updates"]),
+                    availability_changes=len(diff["availability_updates"]),unchanged=diff["unchanged"],invalid=len(diff["invalid"]),default="Catalog import finished.")
+        if diff["invalid"]:
+            shown=diff["invalid"][:20]
+            msg+="\n"+await _(context,"admin_import_catalog_invalid_rows",user_id=uid,count=len(shown),rows=", ".join(map(str,shown)),default=f"Invalid rows: {shown}")
+    else:
+        msg=await _(context,"admin_import_catalog_failed",user_id=uid,default="Catalog import failed, no changes were applied.")
+    logger.info("Admin %s imported %s: %s inserts, %s price changes, %s availability changes, %s invalid rows", uid, file_name,
+                len(diff["inserts"]), len(diff["price_updates"]), len(diff["availability_updates"]), len(diff["invalid"]))
+    await update.message.reply_text(msg)
+    await display_admin_panel(update,context,edit_message=False)
+    return ConversationHandler.END
+
+@log_handler
+async def admin_export_catalog_direct_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q=update.callback_query;await q.answer();uid=q.from_user.id
+    if not(ADMIN_IDS and uid in ADMIN_IDS):
+        await q.edit_message_text(await _(context,"admin_unauthorized",user_id=uid)); return
+    with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_BYTES) as spool:
+        text_out=io.TextIOWrapper(spool,encoding="utf-8-sig",newline="") # BOM so spreadsheet apps detect UTF-8
+        writer=csv.writer(text_out);writer.writerow(CATALOG_COLUMNS);count=0
+        async for _pid,name,price,avail,_stock in storage.iter_products():
+            writer.writerow([name,f"{price:.2f}",avail]);count+=1
+        text_out.flush();text_out.detach();spool.seek(0) # detach() keeps the spool open for sending
+        await context.bot.send_document(chat_id=uid,document=spool,filename=f"catalog_{datetime.now():%Y%m%d_%H%M}.csv",
+                                        caption=await _(context,"admin_export_catalog_caption",user_id=uid,count=count,default=f"Catalog export: {count} products"))
+
 # Admin Clear Orders Flow
+@log_handler
 async def admin_clear_completed_orders_entry_cb(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
-    q=update.callback_query;await q.answer();uid=q.from_user.id; logger.info(f"User {uid} entered admin_clear_completed_orders_entry_cb")
+    q=update.callback_query;await q.answer();uid=q.from_user.id; logger.info("User %s entered admin_clear_completed_orders_entry_cb", uid)
     confirm_txt=await _(context,"admin_clear_orders_confirm_prompt",user_id=uid,default="Are you sure you want to delete ALL COMPLETED orders? This cannot be undone.");
     yes_txt=await _(context,"admin_clear_orders_yes_button",user_id=uid,default="YES, Delete Completed Orders");
     no_txt=await _(context,"admin_clear_orders_no_button",user_id=uid,default="NO, Cancel")
     kb=[[InlineKeyboardButton(yes_txt,callback_data="admin_clear_orders_do_confirm")],[InlineKeyboardButton(no_txt,callback_data="admin_panel_return_direct_cb")]]
     await q.edit_message_text(text=confirm_txt,reply_markup=InlineKeyboardMarkup(kb));return ADMIN_CLEAR_ORDERS_CONFIRM
 
+@log_handler
 async def admin_clear_orders_do_confirm_cb(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
-    q=update.callback_query;await q.answer();uid=q.from_user.id; logger.info(f"User {uid} confirmed clear orders.")
+    q=update.callback_query;await q.answer();uid=q.from_user.id; logger.info("User %s confirmed clear orders.", uid)
     if not(ADMIN_IDS and uid in ADMIN_IDS): # Double check auth
         await q.edit_message_text(await _(context,"admin_unauthorized",user_id=uid))
         return ConversationHandler.END # End conv if somehow unauthorized
 
-    deleted_count=delete_completed_orders_from_db()
+    deleted_count=await storage.delete_completed_orders()
+    if deleted_count > 0: context.job_queue.run_once(db_vacuum_job, when=60) # Give the freed pages back to the disk soon
     if deleted_count > 0:msg=await _(context,"admin_orders_cleared_success",user_id=uid,count=deleted_count,default=f"{deleted_count} completed orders cleared.")
     elif deleted_count == 0:msg=await _(context,"admin_orders_cleared_none",user_id=uid,default="No completed orders found to clear.")
     else:msg=await _(context,"admin_orders_cleared_error",user_id=uid,default="Error clearing completed orders.")
@@ -977,13 +1278,22 @@ async def admin_clear_orders_do_confirm_cb(update:Update,context:ContextTypes.DE
     return ConversationHandler.END # This conversation ends, display_admin_panel returns a state but it's ignored here.
 
 # Direct Admin Actions
+async def report_age_note(context: ContextTypes.DEFAULT_TYPE, uid: int) -> str:
+    # Heavy reports may come from the storage's read-only snapshot; tells the admin how far behind it is
+    age = storage.report_data_age()
+    if age is None: return ""
+    return await _(context, "admin_report_data_age", user_id=uid, age=f"{age:.0f}", max_age=f"{REPORT_SNAPSHOT_MAX_AGE_SECONDS:g}",
+                   default="🕒 Data from {age}s ago (refreshed when older than {max_age}s)") + "\n\n"
+
+@log_handler
 async def admin_view_orders_direct_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q=update.callback_query;await q.answer();uid=q.from_user.id
-    logger.info(f"Admin {uid} viewing all orders.")
-    orders=get_all_orders_from_db()
+    logger.info("Admin %s viewing all orders.", uid)
+    orders=await storage.get_all_orders()
     text_parts = []
     header = await _(context,"admin_all_orders_title",user_id=uid, default="📦 All Customer Orders:\n\n")
     text_parts.append(header)
+    text_parts.append(await report_age_note(context, uid))
 
     if not orders:
         text_parts.append(await _(context,"admin_no_orders_found",user_id=uid))
@@ -994,13 +1304,13 @@ async def admin_view_orders_direct_cb(update: Update, context: ContextTypes.DEFA
             text_parts.append(order_entry)
 
     full_text = "".join(text_parts)
-    kb=[[InlineKeyboardButton(await _(context,"admin_back_to_admin_panel_button",user_id=uid),callback_data="admin_panel_return_direct_cb")]]
-    reply_markup = InlineKeyboardMarkup(kb)
+    reply_markup = admin_back_markup(await get_user_language(context,uid))
 
     try:
         if len(full_text) > 4096:
             # Send in chunks if too long for one message
-            await q.edit_message_text(text=full_text[:4000]+"...\n(Truncated)", reply_markup=reply_markup)
+            truncated_hint = await _(context, "admin_orders_truncated_hint", user_id=uid, default="(Truncated - use /export_orders for the full list)")
+            await q.edit_message_text(text=full_text[:4000]+"...\n"+truncated_hint, reply_markup=reply_markup)
             # for i in range(0, len(full_text), 4096):
             #     chunk = full_text[i:i+4096]
             #     # Only add keyboard to the last chunk if sent as multiple new messages
@@ -1009,7 +1319,7 @@ async def admin_view_orders_direct_cb(update: Update, context: ContextTypes.DEFA
         else:
             await q.edit_message_text(text=full_text,reply_markup=reply_markup)
     except Exception as e:
-        logger.error(f"Error admin_view_orders: {e}")
+        logger.error("Error admin_view_orders: %s", e)
         error_msg = await _(context, "generic_error_message", user_id=uid, default="Error displaying orders. List might be too long or an error occurred.")
         try: # Try to edit to an error message
             await q.edit_message_text(text=error_msg, reply_markup=reply_markup) # Keep back button
@@ -1018,19 +1328,20 @@ async def admin_view_orders_direct_cb(update: Update, context: ContextTypes.DEFA
             elif uid: await context.bot.send_message(chat_id=uid, text=error_msg)
 
 
+@log_handler
 async def admin_shop_list_direct_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q=update.callback_query;await q.answer();uid=q.from_user.id
-    logger.info(f"Admin {uid} viewing shopping list.")
-    slist=get_shopping_list_from_db()
+    logger.info("Admin %s viewing shopping list.", uid)
+    slist=await storage.get_shopping_list()
     text=await _(context,"admin_shopping_list_title",user_id=uid, default="Shopping List:")+"\n\n" if slist else await _(context,"admin_shopping_list_empty",user_id=uid)
     if slist:
         for name,qty in slist: text+=await _(context,"admin_shopping_list_item_format",user_id=uid,name=name,total_quantity=f"{qty:.2f}", default=f"- {name}:{qty}kg\n")
-    kb=[[InlineKeyboardButton(await _(context,"admin_back_to_admin_panel_button",user_id=uid),callback_data="admin_panel_return_direct_cb")]]
-    reply_markup = InlineKeyboardMarkup(kb)
+    text=await report_age_note(context, uid)+text
+    reply_markup = admin_back_markup(await get_user_language(context,uid))
     try:
         await q.edit_message_text(text=text,reply_markup=reply_markup)
     except Exception as e:
-        logger.error(f"Error admin_shop_list: {e}")
+        logger.error("Error admin_shop_list: %s", e)
         error_msg = await _(context, "generic_error_message", user_id=uid, default="Error displaying shopping list.")
         try:
             await q.edit_message_text(text=error_msg, reply_markup=reply_markup)
@@ -1039,7 +1350,367 @@ async def admin_shop_list_direct_cb(update: Update, context: ContextTypes.DEFAUL
             elif uid: await context.bot.send_message(chat_id=uid, text=error_msg)
 
 
+# Admin Order Export
+# Rows go straight from the batched DB cursor into a spooled (optionally gzipped) CSV, which is then streamed
+# to Telegram from its file handle, so memory stays bounded by EXPORT_SPOOL_MAX_BYTES plus one fetch batch.
+ORDER_EXPORT_COLUMNS = ["order_id", "order_date", "customer_id", "customer_name", "status", "order_total_eur",
+                        "product_id", "product_name", "quantity_kg", "price_per_kg_eur"]
+ORDER_STATUSES = tuple(ORDER_STATUS_TRANSITIONS)
+
+def parse_order_export_args(args: list) -> dict:
+    # /export_orders [from YYYY-MM-DD] [to YYYY-MM-DD] [status] [gz]; the end date is inclusive
+    options = {"date_from": None, "date_to": None, "status": None, "compress": False}
+    dates = []
+    for arg in args:
+        token = arg.strip().lower()
+        if token in ("gz", "gzip"): options["compress"] = True
+        elif token in ORDER_STATUSES: options["status"] = token
+        else: dates.append(datetime.strptime(token, "%Y-%m-%d").date()) # ValueError -> usage message
+    if len(dates) > 2: raise ValueError("At most two dates")
+    if dates: options["date_from"] = dates[0].isoformat()
+    if len(dates) == 2: options["date_to"] = (dates[1] + timedelta(days=1)).isoformat()
+    return options
+
+ORDER_EXPORT_BATCH_ROWS = 1000 # Rows handed to the writer thread at a time
+
+def write_orders_csv(binary_out, compress: bool, row_batches) -> int:
+    # Blocking CSV and gzip encoding of an iterable of row lists; send_orders_export runs it in a worker thread
+    target = gzip.GzipFile(fileobj=binary_out, mode="wb") if compress else binary_out
+    text_out = io.TextIOWrapper(target, encoding="utf-8-sig", newline="")
+    writer = csv.writer(text_out); writer.writerow(ORDER_EXPORT_COLUMNS); row_count = 0
+    for rows in row_batches:
+        writer.writerows(rows); row_count += len(rows)
+    text_out.flush(); text_out.detach() # detach() keeps binary_out open
+    if compress: target.close() # Writes the gzip trailer; binary_out itself stays open
+    return row_count
+
+async def _order_row_batches(**filters):
+    batch = []
+    async for row in storage.iter_order_rows(batch_size=ORDER_EXPORT_BATCH_ROWS, **filters):
+        batch.append(row)
+        if len(batch) >= ORDER_EXPORT_BATCH_ROWS: yield batch; batch = []
+    if batch: yield batch
+
+def _iterate_from_thread(async_iterator, loop):
+    # Blocking iterator for a worker thread over an async iterator that stays on the event loop (the storage's
+    # connections belong to it); each item is fetched there and handed over
+    async def next_item(): return await anext(async_iterator, None)
+    while (item := asyncio.run_coroutine_threadsafe(next_item(), loop).result()) is not None:
+        yield item
+
+async def send_orders_export(context: ContextTypes.DEFAULT_TYPE, chat_id: int, uid: int, date_from: str = None, date_to: str = None, status: str = None, compress: bool = False) -> None:
+    with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_BYTES) as spool:
+        batches = _order_row_batches(date_from=date_from, date_to=date_to, status=status)
+        try: row_count = await asyncio.to_thread(write_orders_csv, spool, compress, _iterate_from_thread(batches, asyncio.get_running_loop()))
+        finally: await batches.aclose()
+        spool.seek(0)
+        filename = f"orders_{datetime.now():%Y%m%d_%H%M}.csv" + (".gz" if compress else "")
+        caption = await _(context, "admin_export_orders_caption", user_id=uid, rows=row_count, default=f"Order export: {row_count} item rows")
+        # read_file_handle=False lets the HTTP client stream the file instead of loading it into memory
+        await context.bot.send_document(chat_id=chat_id, document=InputFile(spool, filename=filename, read_file_handle=False), caption=caption)
+    logger.info("Admin %s exported %s order item rows (from=%s to=%s status=%s gz=%s)", uid, row_count, date_from, date_to, status, compress)
+
+@log_handler
+async def admin_export_orders_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    if not (ADMIN_IDS and uid in ADMIN_IDS):
+        await update.message.reply_text(await _(context, "admin_unauthorized", user_id=uid)); return
+    try: options = parse_order_export_args(context.args or [])
+    except ValueError:
+        await update.message.reply_text(await _(context, "admin_export_orders_usage", user_id=uid, default="Usage: /export_orders [YYYY-MM-DD] [YYYY-MM-DD] [status] [gz]"))
+        return
+    await send_orders_export(context, update.effective_chat.id, uid, **options)
+
+@log_handler
+async def admin_export_orders_direct_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q=update.callback_query;await q.answer();uid=q.from_user.id
+    if not (ADMIN_IDS and uid in ADMIN_IDS):
+        await q.edit_message_text(await _(context, "admin_unauthorized", user_id=uid)); return
+    await send_orders_export(context, uid, uid, compress=True) # Everything; /export_orders narrows it down
+
+# Admin Sales Report
+# Answered from the daily rollups (storage.get_daily_sales_totals / get_product_sales), never from raw orders
+SALES_REPORT_PRESETS = ("today", "yesterday", "7d", "30d", "month")
+SALES_REPORT_TOP_PRODUCTS = 30 # Keeps the report within one message
+
+def sales_report_period(preset: str, today) -> tuple:
+    # (first day, last day), both inclusive
+    if preset == "yesterday": return today - timedelta(days=1), today - timedelta(days=1)
+    if preset == "7d": return today - timedelta(days=6), today
+    if preset == "30d": return today - timedelta(days=29), today
+    if preset == "month": return today.replace(day=1), today
+    return today, today
+
+async def render_sales_report(context: ContextTypes.DEFAULT_TYPE, uid: int, first_day, last_day) -> str:
+    date_from, date_to = first_day.isoformat(), (last_day + timedelta(days=1)).isoformat()
+    daily_totals = await storage.get_daily_sales_totals(date_from, date_to)
+    product_sales = await storage.get_product_sales(date_from, date_to)
+    text = await _(context, "admin_sales_report_header", user_id=uid, date_from=first_day.isoformat(), date_to=last_day.isoformat(),
+                   orders=sum(row[1] for row in daily_totals), revenue=f"{sum(row[2] for row in daily_totals):.2f}", default="Sales report\n")
+    if not product_sales:
+        return text + await _(context, "admin_sales_report_empty", user_id=uid, default="No sales in this period.")
+    for pid, name, quantity_kg, revenue, order_count in product_sales[:SALES_REPORT_TOP_PRODUCTS]:
+        text += await _(context, "admin_sales_report_product_line", user_id=uid, name=name or f"#{pid}", quantity=f"{quantity_kg:.2f}",
+                        revenue=f"{revenue:.2f}", orders=order_count, default=f"- {name}: {quantity_kg:.2f} kg\n")
+    return text
+
+@view
+def admin_sales_report_result_kb(lang_code: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(translate(lang_code,"admin_sales_report_other_period_button",default="🔁 Other Period"),callback_data="admin_sales_report_entry_cb")],
+        [InlineKeyboardButton(translate(lang_code,"admin_back_to_admin_panel_button"),callback_data="admin_panel_return_direct_cb")]
+    ])
+
+@view
+def admin_sales_report_menu_view(lang_code: str) -> tuple[str, InlineKeyboardMarkup]:
+    preset_buttons=[InlineKeyboardButton(translate(lang_code,f"admin_sales_report_preset_{preset}",default=preset),callback_data=f"admin_sales_report_preset_{preset}") for preset in SALES_REPORT_PRESETS]
+    return translate(lang_code,"admin_sales_report_choose_period",default="Choose a period for the sales report:"),InlineKeyboardMarkup([preset_buttons[:2],preset_buttons[2:],
+        [InlineKeyboardButton(translate(lang_code,"admin_sales_report_custom_button",default="📅 Custom Range"),callback_data="admin_sales_report_custom_cb")],
+        [InlineKeyboardButton(translate(lang_code,"admin_back_to_admin_panel_button"),callback_data="admin_panel_return_direct_cb")]])
+
+@log_handler
+async def admin_sales_report_entry_cb(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
+    q=update.callback_query;await q.answer();uid=q.from_user.id
+    if not(ADMIN_IDS and uid in ADMIN_IDS):
+        await q.edit_message_text(await _(context,"admin_unauthorized",user_id=uid)); return ConversationHandler.END
+    text,reply_markup=admin_sales_report_menu_view(await get_user_language(context,uid))
+    await q.edit_message_text(text,reply_markup=reply_markup)
+    return ADMIN_SALES_REPORT_MENU
+
+@log_handler
+async def admin_sales_report_preset_cb(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
+    q=update.callback_query;await q.answer();uid=q.from_user.id
+    first_day,last_day=sales_report_period(context.matches[0].group(1),datetime.now().date())
+    await q.edit_message_text(await render_sales_report(context,uid,first_day,last_day),reply_markup=admin_sales_report_result_kb(await get_user_language(context,uid)))
+    return ADMIN_SALES_REPORT_MENU
+
+@log_handler
+async def admin_sales_report_custom_cb(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
+    q=update.callback_query;await q.answer();uid=q.from_user.id
+    text,reply_markup=admin_prompt_view(await get_user_language(context,uid),"admin_sales_report_custom_prompt","Send two dates: YYYY-MM-DD YYYY-MM-DD")
+    await q.edit_message_text(text,reply_markup=reply_markup)
+    return ADMIN_SALES_REPORT_RANGE
+
+@log_handler
+async def admin_sales_report_range_state(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
+    uid=update.effective_user.id
+    try:
+        first_day,last_day=[datetime.strptime(part,"%Y-%m-%d").date() for part in update.message.text.split()]
+        if first_day>last_day: first_day,last_day=last_day,first_day
+    except ValueError: # Wrong date format or not exactly two dates
+        await update.message.reply_text(await _(context,"admin_sales_report_invalid_range",user_id=uid,default="Invalid dates. Example: 2024-05-01 2024-05-31"))
+        return ADMIN_SALES_REPORT_RANGE
+    await update.message.reply_text(await render_sales_report(context,uid,first_day,last_day),reply_markup=admin_sales_report_result_kb(await get_user_language(context,uid)))
+    return ADMIN_SALES_REPORT_MENU
+
+# Admin Broadcast
+# Recipients are streamed from storage in keyset batches and messaged one by one at BROADCAST_RATE_PER_SECOND
+# (Telegram allows about 30 messages per second per bot). The cursor and counts are checkpointed in the broadcasts
+# table, so after a restart resume_broadcasts_job continues where the last checkpoint left off; the claim lease
+# keeps two processes from sending the same broadcast.
+BROADCAST_RATE_PER_SECOND = float(os.getenv("BROADCAST_RATE_PER_SECOND", "25"))
+BROADCAST_CHECKPOINT_EVERY = 25 # Recipients between checkpoints; at most this many get the message twice after a crash
+BROADCAST_PROGRESS_EVERY = 500 # Recipients between progress updates to the admin
+BROADCAST_LEASE_SECONDS = 60 # A running broadcast with no checkpoint for this long is considered abandoned
+
+class SendPacer:
+    # Spaces out sends from every task that shares it, so broadcasts and order notifications together stay under one rate
+    def __init__(self, rate_per_second: float):
+        self.interval = 1 / rate_per_second
+        self._next_send_at = 0.0
+
+    async def wait(self) -> None:
+        now = asyncio.get_running_loop().time()
+        send_at = max(self._next_send_at, now)
+        self._next_send_at = send_at + self.interval # Reserved before sleeping, so concurrent callers queue up behind it
+        await asyncio.sleep(send_at - now)
+
+bulk_send_pacer = SendPacer(BROADCAST_RATE_PER_SECOND)
+
+def schedule_broadcast(job_queue, broadcast_id: int, admin_id: int) -> None:
+    # Bound to the admin so the job's context.user_data is theirs (for their language)
+    job_queue.run_once(run_broadcast_job, when=0, data=broadcast_id, chat_id=admin_id, user_id=admin_id, name=f"broadcast_{broadcast_id}")
+
+async def send_bulk_message(bot, chat_id: int, text: str) -> str:
+    # Returns "delivered", "blocked" or "failed"
+    for _attempt in range(2):
+        try:
+            await bot.send_message(chat_id=chat_id, text=text)
+            return "delivered"
+        except RetryAfter as e: # Flood limit hit anyway: wait as told and retry once
+            retry_after = e.retry_after
+            await asyncio.sleep(retry_after.total_seconds() if isinstance(retry_after, timedelta) else retry_after)
+        except Forbidden:
+            return "blocked"
+        except TelegramError as e:
+            logger.warning("Broadcast message to %s failed: %s", chat_id, e)
+            return "failed"
+    return "failed"
+
+async def run_broadcast_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    broadcast_id = context.job.data
+    if not await storage.claim_broadcast(broadcast_id, BROADCAST_LEASE_SECONDS): return # Finished, or being sent elsewhere
+    broadcast = await storage.get_broadcast(broadcast_id)
+    if not broadcast: return
+    _id, admin_id, message_text, _status, cursor_user_id, delivered, blocked, failed = broadcast
+    counts = {"delivered": delivered, "blocked": blocked, "failed": failed}
+    admin_lang = await get_user_language(context, admin_id)
+    progress_message = None
+
+    async def report_progress(key: str) -> None:
+        nonlocal progress_message
+        text = translate(admin_lang, key, broadcast_id=broadcast_id, **counts)
+        try:
+            if progress_message: await progress_message.edit_text(text)
+            else: progress_message = await context.bot.send_message(chat_id=admin_id, text=text)
+        except TelegramError as e: logger.warning("Could not report broadcast %s progress: %s", broadcast_id, e)
+
+    logger.info("Broadcast %s starting after user %s", broadcast_id, cursor_user_id)
+    await report_progress("admin_broadcast_progress")
+    rendered = {} # language_code -> message text, rendered once per language
+    processed = 0
+    async for user_id, lang_code in storage.iter_broadcast_recipients(cursor_user_id):
+        lang_code = lang_code or DEFAULT_LANGUAGE
+        if lang_code not in rendered:
+            rendered[lang_code] = translate(lang_code, "broadcast_message_format", message=message_text, default=message_text)
+        await bulk_send_pacer.wait()
+        outcome = await send_bulk_message(context.bot, user_id, rendered[lang_code])
+        if outcome == "blocked": await storage.mark_user_blocked(user_id)
+        counts[outcome] += 1
+        cursor_user_id = user_id
+        processed += 1
+        if processed % BROADCAST_CHECKPOINT_EVERY == 0: await storage.save_broadcast_progress(broadcast_id, cursor_user_id, **counts)
+        if processed % BROADCAST_PROGRESS_EVERY == 0: await report_progress("admin_broadcast_progress")
+    await storage.save_broadcast_progress(broadcast_id, cursor_user_id, status="done", **counts)
+    await report_progress("admin_broadcast_finished")
+    logger.info("Broadcast %s finished: %s delivered, %s blocked, %s failed", broadcast_id, counts["delivered"], counts["blocked"], counts["failed"])
+
+async def resume_broadcasts_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Broadcasts still marked running were interrupted (restart or crashed worker) unless their lease is fresh,
+    # in which case run_broadcast_job's claim simply fails
+    for broadcast_id in await storage.get_running_broadcast_ids():
+        broadcast = await storage.get_broadcast(broadcast_id)
+        if broadcast: schedule_broadcast(context.job_queue, broadcast_id, broadcast[1])
+
+@log_handler
+async def admin_broadcast_entry_cb(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
+    q=update.callback_query;await q.answer();uid=q.from_user.id
+    if not(ADMIN_IDS and uid in ADMIN_IDS):
+        await q.edit_message_text(await _(context,"admin_unauthorized",user_id=uid)); return ConversationHandler.END
+    text,reply_markup=admin_prompt_view(await get_user_language(context,uid),"admin_broadcast_prompt","Send the message to broadcast to all users.")
+    await q.edit_message_text(text,reply_markup=reply_markup)
+    return ADMIN_BROADCAST_TEXT
+
+@log_handler
+async def admin_broadcast_text_state(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
+    uid=update.effective_user.id;context.user_data['broadcast_text']=update.message.text
+    preview=translate(await get_user_language(context,uid),"broadcast_message_format",message=update.message.text,default=update.message.text)
+    kb=[[InlineKeyboardButton(await _(context,"admin_broadcast_send_button",user_id=uid,default="✅ Send to All"),callback_data="admin_broadcast_confirm_cb")],
+        [InlineKeyboardButton(await _(context,"admin_back_to_admin_panel_button",user_id=uid),callback_data="admin_panel_return_direct_cb")]]
+    await update.message.reply_text(await _(context,"admin_broadcast_preview",user_id=uid,preview=preview,default=preview),reply_markup=InlineKeyboardMarkup(kb))
+    return ADMIN_BROADCAST_CONFIRM
+
+@log_handler
+async def admin_broadcast_confirm_cb(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
+    q=update.callback_query;await q.answer();uid=q.from_user.id
+    message_text=context.user_data.pop('broadcast_text',None)
+    if not(ADMIN_IDS and uid in ADMIN_IDS) or not message_text:
+        await q.edit_message_text(await _(context,"generic_error_message",user_id=uid,default="Error, please start over.")); return ConversationHandler.END
+    broadcast_id=await storage.create_broadcast(uid,message_text)
+    if broadcast_id is None:
+        await q.edit_message_text(await _(context,"generic_error_message",user_id=uid,default="Error, please start over.")); return ConversationHandler.END
+    schedule_broadcast(context.job_queue,broadcast_id,uid)
+    logger.info("Admin %s started broadcast %s", uid, broadcast_id)
+    await q.edit_message_text(await _(context,"admin_broadcast_started",user_id=uid,broadcast_id=broadcast_id,default=f"Broadcast #{broadcast_id} started."))
+    return ConversationHandler.END
+
+# Order Status Updates
+# Admins move orders along ORDER_STATUS_TRANSITIONS in bulk (one UPDATE per action). Customers are told through a
+# queue: changes are grouped per customer and flushed in batches through bulk_send_pacer, so confirming hundreds of
+# orders sends at most one message per customer per run instead of one send per order.
+ORDER_STATUS_ACTIONS = ("confirmed", "completed", "cancelled")
+ORDER_SELECTION_MAX_IDS = 1000
+ORDER_NOTIFY_INTERVAL_SECONDS = 2
+ORDER_NOTIFY_BATCH_SIZE = 20 # Customers messaged per run
+pending_status_notifications = {} # user_id -> [(order_id, status)]; dict order makes it first come, first served
+
+def parse_order_selection(text: str) -> dict:
+    # "12 15 20-24" -> order ids; "2024-05-01 [2024-05-31]" -> order_date range (inclusive); "all" -> no filter
+    tokens = text.replace(",", " ").lower().split()
+    if tokens == ["all"]: return {}
+    if 1 <= len(tokens) <= 2 and all(len(token) == 10 and token.count("-") == 2 for token in tokens):
+        days = sorted(datetime.strptime(token, "%Y-%m-%d").date() for token in tokens)
+        return {"date_from": days[0].isoformat(), "date_to": (days[-1] + timedelta(days=1)).isoformat()}
+    order_ids = set()
+    for token in tokens:
+        first, _sep, last = token.partition("-")
+        first, last = int(first), int(last or first)
+        # Size and direction are checked before the range is expanded, so a typo cannot build a huge set
+        if last < first: raise ValueError("Reversed range")
+        if last - first + 1 > ORDER_SELECTION_MAX_IDS: raise ValueError("Too many orders selected")
+        order_ids.update(range(first, last + 1))
+        if len(order_ids) > ORDER_SELECTION_MAX_IDS: raise ValueError("Too many orders selected")
+    if not order_ids: raise ValueError("Nothing selected")
+    return {"order_ids": sorted(order_ids)}
+
+def queue_order_status_notifications(changed_orders: list, new_status: str) -> None:
+    for order_id, user_id, _total in changed_orders:
+        pending_status_notifications.setdefault(user_id, []).append((order_id, new_status))
+
+async def flush_order_status_notifications_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    for user_id in list(itertools.islice(pending_status_notifications, ORDER_NOTIFY_BATCH_SIZE)):
+        updates = pending_status_notifications.pop(user_id)
+        lang_code = await storage.get_user_language(user_id) or DEFAULT_LANGUAGE
+        lines = [translate(lang_code, "order_status_update_line", order_id=order_id, status=translate(lang_code, f"order_status_{status}", default=status), default=f"#{order_id}: {status}")
+                 for order_id, status in updates]
+        text = translate(lang_code, "order_status_update_title", default="Order update:") + "\n" + "\n".join(lines)
+        await bulk_send_pacer.wait()
+        if await send_bulk_message(context.bot, user_id, text) == "blocked": await storage.mark_user_blocked(user_id)
+
+@log_handler
+async def admin_order_status_entry_cb(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
+    q=update.callback_query;await q.answer();uid=q.from_user.id
+    if not(ADMIN_IDS and uid in ADMIN_IDS):
+        await q.edit_message_text(await _(context,"admin_unauthorized",user_id=uid)); return ConversationHandler.END
+    kb=[[InlineKeyboardButton(await _(context,f"admin_order_status_action_{status}",user_id=uid,default=status),callback_data=f"admin_order_status_to_{status}")] for status in ORDER_STATUS_ACTIONS]
+    kb.append([InlineKeyboardButton(await _(context,"admin_back_to_admin_panel_button",user_id=uid),callback_data="admin_panel_return_direct_cb")])
+    await q.edit_message_text(await _(context,"admin_order_status_choose_action",user_id=uid,default="Choose a status change:"),reply_markup=InlineKeyboardMarkup(kb))
+    return ADMIN_ORDER_STATUS_ACTION
+
+@log_handler
+async def admin_order_status_action_cb(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
+    q=update.callback_query;await q.answer();uid=q.from_user.id
+    context.user_data['order_status_target']=context.matches[0].group(1)
+    kb=[[InlineKeyboardButton(await _(context,"admin_back_to_admin_panel_button",user_id=uid),callback_data="admin_panel_return_direct_cb")]]
+    await q.edit_message_text(await _(context,"admin_order_status_select_prompt",user_id=uid,default="Send order ids (12 15 20-24), a date range (2024-05-01 2024-05-31) or 'all'."),reply_markup=InlineKeyboardMarkup(kb))
+    return ADMIN_ORDER_STATUS_SELECTION
+
+@log_handler
+async def admin_order_status_selection_state(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
+    uid=update.effective_user.id;new_status=context.user_data.get('order_status_target')
+    if not(ADMIN_IDS and uid in ADMIN_IDS) or new_status not in ORDER_STATUS_ACTIONS:
+        await update.message.reply_text(await _(context,"generic_error_message",user_id=uid,default="Error, please start over.")); return ConversationHandler.END
+    try: selection=parse_order_selection(update.message.text)
+    except ValueError:
+        await update.message.reply_text(await _(context,"admin_order_status_invalid_selection",user_id=uid,max_ids=ORDER_SELECTION_MAX_IDS,default="Invalid selection."))
+        return ADMIN_ORDER_STATUS_SELECTION
+    changed=await storage.transition_orders(new_status,**selection)
+    if changed is None:
+        await update.message.reply_text(await _(context,"admin_status_update_failed_orders",user_id=uid,default="Failed to update orders."))
+    else:
+        queue_order_status_notifications(changed,new_status)
+        status_txt=await _(context,f"order_status_{new_status}",user_id=uid,default=new_status)
+        msg=await _(context,"admin_order_status_done",user_id=uid,count=len(changed),status=status_txt,default=f"{len(changed)} orders updated.")
+        if "order_ids" in selection and len(changed)<len(selection["order_ids"]):
+            msg+="\n"+await _(context,"admin_order_status_skipped",user_id=uid,count=len(selection["order_ids"])-len(changed),default="Some orders were skipped.")
+        await update.message.reply_text(msg)
+        logger.info("Admin %s moved %s orders to %s (%s)", uid, len(changed), new_status, selection)
+    context.user_data.pop('order_status_target',None)
+    await display_admin_panel(update,context,edit_message=False)
+    return ConversationHandler.END
+
 # General Cancel Handler
+@log_handler
 async def general_cancel_command_handler(update:Update,context:ContextTypes.DEFAULT_TYPE)->int:
     uid = update.effective_user.id if update.effective_user else None
     cancel_txt = await _(context, "action_cancelled", user_id=uid, default="Action cancelled.")
@@ -1054,13 +1725,13 @@ async def general_cancel_command_handler(update:Update,context:ContextTypes.DEFA
             await update.message.reply_text(cancel_txt, reply_markup=ReplyKeyboardRemove())
             message_sent_or_edited = True
     except Exception as e:
-        logger.warning(f"Cancel handler error on edit/reply: {e}")
+        logger.warning("Cancel handler error on edit/reply: %s", e)
 
     if not message_sent_or_edited and update.effective_chat: # Fallback to send new message
         try:
             await context.bot.send_message(chat_id=update.effective_chat.id, text=cancel_txt, reply_markup=ReplyKeyboardRemove())
         except Exception as e:
-            logger.error(f"Fallback cancel send error: {e}")
+            logger.error("Fallback cancel send error: %s", e)
 
     # Clear transient user_data, preserving essentials
     lang_code = context.user_data.get('language_code')
@@ -1087,22 +1758,313 @@ async def general_cancel_command_handler(update:Update,context:ContextTypes.DEFA
 IKB = InlineKeyboardButton
 IM = InlineKeyboardMarkup
 
-def main() -> None:
+def configure_runtime() -> bool:
+    # Shared by the single-process mode and by every worker process; returns False if the bot cannot start
     global ADMIN_IDS
-    if not TELEGRAM_TOKEN: logger.critical("TELEGRAM_TOKEN missing!"); return
-    if not ADMIN_TELEGRAM_ID: logger.critical("ADMIN_TELEGRAM_ID missing!"); return
+    if not TELEGRAM_TOKEN: logger.critical("TELEGRAM_TOKEN missing!"); return False
+    if not ADMIN_TELEGRAM_ID: logger.critical("ADMIN_TELEGRAM_ID missing!"); return False
     try: ADMIN_IDS = [int(aid.strip()) for aid in ADMIN_TELEGRAM_ID.split(',') if aid.strip()]
-    except ValueError: logger.critical("Admin IDs invalid! Must be comma-separated numbers."); return
+    except ValueError: logger.critical("Admin IDs invalid! Must be comma-separated numbers."); return False
     if not ADMIN_IDS: logger.warning("ADMIN_TELEGRAM_ID is set but parsed to an empty list. No admins configured.")
 
 
-    load_translations();
+    with startup_phase("locales"): load_translations()
     if not translations.get("en") or not translations.get("lt"):
         logger.critical("Core translations (en/lt) missing after load attempt! Bot cannot function correctly.")
-        return
-    init_db()
+        return False
+    return True
+
+async def init_storage_schema() -> None:
+    await storage.open(init_schema=True)
+    await storage.close()
+
+# --- Database Maintenance ---
+# Backups, statistics and incremental vacuum for the SQLite file (the storage methods are no-ops on PostgreSQL).
+# Intervals are in hours; 0 disables that job. Only one process schedules these (see build_application).
+DB_BACKUP_DIR = os.getenv("DB_BACKUP_DIR") or os.path.join(os.path.dirname(os.path.abspath(DB_NAME)), "backups")
+DB_BACKUP_INTERVAL_HOURS = float(os.getenv("DB_BACKUP_INTERVAL_HOURS", "24"))
+DB_OPTIMIZE_INTERVAL_HOURS = float(os.getenv("DB_OPTIMIZE_INTERVAL_HOURS", "24"))
+DB_VACUUM_INTERVAL_HOURS = float(os.getenv("DB_VACUUM_INTERVAL_HOURS", "24"))
+# Opt-in one-off for a database created before auto_vacuum was set, which the vacuum job skips. It is a full VACUUM
+# that locks the file while rewriting it, so it only runs at startup, before any update is polled.
+DB_CONVERT_AUTO_VACUUM = os.getenv("DB_CONVERT_AUTO_VACUUM", "0").lower() in ("1", "true", "yes")
+
+async def _run_db_maintenance(name: str, operation) -> None:
+    started_at = time.perf_counter()
+    result = await operation()
+    if result is not None:
+        logger.info("DB maintenance %s took %.0f ms: %s", name, (time.perf_counter() - started_at) * 1000, result)
+
+async def db_backup_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    await _run_db_maintenance("backup", lambda: storage.backup(DB_BACKUP_DIR))
+
+async def db_optimize_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    await _run_db_maintenance("optimize", storage.optimize)
+
+async def db_vacuum_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    await _run_db_maintenance("incremental vacuum", storage.incremental_vacuum)
+
+async def convert_storage_auto_vacuum() -> None:
+    logger.info("Converting the database to incremental auto_vacuum before starting...")
+    await _run_db_maintenance("auto_vacuum conversion", storage.convert_auto_vacuum)
+
+def schedule_db_maintenance(job_queue) -> None:
+    # Staggered first runs so the jobs never start together
+    for callback, interval_hours, first_seconds in ((db_optimize_job, DB_OPTIMIZE_INTERVAL_HOURS, 300),
+                                                    (db_vacuum_job, DB_VACUUM_INTERVAL_HOURS, 600),
+                                                    (db_backup_job, DB_BACKUP_INTERVAL_HOURS, 900)):
+        if interval_hours > 0:
+            job_queue.run_repeating(callback, interval=interval_hours * 3600, first=first_seconds, name=callback.__name__)
+
+# --- Inbound Flood Protection ---
+# flood_guard runs in handler group -2, before every other handler, and raises ApplicationHandlerStop for the updates
+# it sheds, so they never reach a handler, the database or the Bot API. Each user has a token bucket of FLOOD_BURST
+# updates refilled at FLOOD_RATE_PER_SECOND. A callback tap identical to the user's previous one (same button on the
+# same message) within FLOOD_DUPLICATE_WINDOW_SECONDS is merged into it instead of being handled again. A user who
+# keeps hitting an empty bucket is muted for FLOOD_MUTE_SECONDS. Admins are never throttled. Inline queries do not
+# use the bucket: Telegram sends one per keystroke and they are answered from memory (see inline_product_search).
+# Shed callback taps are still answered, so the client's spinner stops at once.
+FLOOD_RATE_PER_SECOND = float(os.getenv("FLOOD_RATE_PER_SECOND", "2"))
+FLOOD_BURST = float(os.getenv("FLOOD_BURST", "8"))
+FLOOD_DUPLICATE_WINDOW_SECONDS = 1.0
+FLOOD_MUTE_AFTER_DROPS = 15 # Within FLOOD_MUTE_WINDOW_SECONDS
+FLOOD_MUTE_WINDOW_SECONDS = 10
+FLOOD_MUTE_SECONDS = int(os.getenv("FLOOD_MUTE_SECONDS", "60"))
+flood_counters = {"dropped": 0, "merged": 0, "muted": 0, "mutes": 0}
+
+class FloodBucket:
+    __slots__ = ("tokens", "updated_at", "last_callback", "last_callback_at", "drops", "drops_since", "muted_until")
+
+    def __init__(self, now: float):
+        self.tokens, self.updated_at = FLOOD_BURST, now
+        self.last_callback, self.last_callback_at = None, 0.0
+        self.drops, self.drops_since = 0, now
+        self.muted_until = 0.0
+
+    def take(self, now: float) -> bool:
+        self.tokens = min(FLOOD_BURST, self.tokens + (now - self.updated_at) * FLOOD_RATE_PER_SECOND)
+        self.updated_at = now
+        if self.tokens < 1: return False
+        self.tokens -= 1
+        return True
+
+    def is_idle(self, now: float) -> bool:
+        # A full bucket with no mute behaves exactly like a new one, so it can be dropped
+        return now >= self.muted_until and self.tokens + (now - self.updated_at) * FLOOD_RATE_PER_SECOND >= FLOOD_BURST
+
+flood_buckets = {} # user_id -> FloodBucket
 
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+async def _answer_shed_callback(query) -> None:
+    try: await query.answer()
+    except TelegramError as e: logger.debug("Could not answer shed callback query: %s", e)
+
+async def flood_guard(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user = update.effective_user
+    if not user or user.id in ADMIN_IDS: return
+    now = time.monotonic()
+    bucket = flood_buckets.get(user.id)
+    if bucket is None: bucket = flood_buckets[user.id] = FloodBucket(now)
+    query = update.callback_query
+    if now < bucket.muted_until:
+        flood_counters["muted"] += 1
+        if query: await _answer_shed_callback(query)
+        raise ApplicationHandlerStop
+    if update.inline_query: return
+    if query:
+        tap = (query.message.message_id if query.message else query.inline_message_id, query.data)
+        if tap == bucket.last_callback and now - bucket.last_callback_at < FLOOD_DUPLICATE_WINDOW_SECONDS:
+            flood_counters["merged"] += 1 # The first tap is still being handled; this one only needs its own answer
+            await _answer_shed_callback(query)
+            raise ApplicationHandlerStop
+        bucket.last_callback, bucket.last_callback_at = tap, now
+    if bucket.take(now): return
+    flood_counters["dropped"] += 1
+    if now - bucket.drops_since > FLOOD_MUTE_WINDOW_SECONDS: bucket.drops, bucket.drops_since = 0, now
+    bucket.drops += 1
+    if bucket.drops >= FLOOD_MUTE_AFTER_DROPS:
+        bucket.muted_until, bucket.drops = now + FLOOD_MUTE_SECONDS, 0
+        flood_counters["mutes"] += 1
+        logger.warning("Muted user %s for %s s after flooding", user.id, FLOOD_MUTE_SECONDS)
+        notice = await _(context, "flood_muted_notice", user_id=user.id, seconds=FLOOD_MUTE_SECONDS, default=f"Too many requests. Please wait {FLOOD_MUTE_SECONDS} seconds.")
+        try: # The only reply a muted user gets
+            if query: await query.answer(notice, show_alert=True)
+            elif update.effective_chat: await context.bot.send_message(chat_id=update.effective_chat.id, text=notice)
+        except TelegramError as e: logger.debug("Could not send flood notice to %s: %s", user.id, e)
+    elif query: await _answer_shed_callback(query)
+    raise ApplicationHandlerStop
+
+# --- Idle Data Eviction ---
+# user_data/chat_data live in memory for as long as the process runs. A group -1 handler records when each user and
+# chat was last active; evict_idle_data_job drops entries idle for longer than USER_DATA_IDLE_TTL_SECONDS, after
+# moving non-empty carts to storage. A returning user (or any user after a restart) gets their cart back on their
+# first update.
+USER_DATA_IDLE_TTL_SECONDS = int(os.getenv("USER_DATA_IDLE_TTL_SECONDS", str(6 * 3600)))
+IDLE_EVICTION_INTERVAL_SECONDS = 600
+user_last_seen = {} # user_id -> time.monotonic() of their last update in this process
+chat_last_seen = {} # chat_id -> time.monotonic()
+eviction_counters = {"users": 0, "chats": 0, "carts_saved": 0}
+
+async def track_activity(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    now = time.monotonic()
+    if update.effective_chat: chat_last_seen[update.effective_chat.id] = now
+    user = update.effective_user
+    if not user: return
+    first_seen = user.id not in user_last_seen
+    user_last_seen[user.id] = now
+    if first_seen:
+        saved_cart = await storage.pop_saved_cart(user.id)
+        if saved_cart and not context.user_data.get('cart'): context.user_data['cart'] = saved_cart
+
+async def save_live_carts(application: Application, user_ids) -> bool:
+    carts = [(user_id, application.user_data[user_id]['cart']) for user_id in user_ids
+             if user_id in application.user_data and application.user_data[user_id].get('cart')]
+    if not carts: return True
+    if not await storage.save_carts(carts): return False
+    eviction_counters["carts_saved"] += len(carts)
+    return True
+
+async def evict_idle_data_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    application = context.application
+    now = time.monotonic()
+    # Data created outside an update (e.g. by jobs) starts its idle clock here
+    for user_id in application.user_data: user_last_seen.setdefault(user_id, now)
+    for chat_id in application.chat_data: chat_last_seen.setdefault(chat_id, now)
+    cutoff = now - USER_DATA_IDLE_TTL_SECONDS
+    idle_users = [user_id for user_id, seen_at in user_last_seen.items() if seen_at < cutoff]
+    if idle_users and not await save_live_carts(application, idle_users): return # Keep the carts in memory rather than lose them
+    for user_id in idle_users:
+        if user_last_seen.get(user_id, now) >= cutoff: continue # Came back while the carts were being saved
+        del user_last_seen[user_id]
+        if user_id in application.user_data: application.drop_user_data(user_id); eviction_counters["users"] += 1
+    for chat_id in [chat_id for chat_id, seen_at in chat_last_seen.items() if seen_at < cutoff]:
+        del chat_last_seen[chat_id]
+        if chat_id in application.chat_data: application.drop_chat_data(chat_id); eviction_counters["chats"] += 1
+    for user_id in [user_id for user_id, bucket in flood_buckets.items() if bucket.is_idle(now)]: del flood_buckets[user_id]
+    if idle_users: logger.info("Evicted idle data of %s users (%s in memory now)", len(idle_users), len(application.user_data))
+
+def approximate_size(obj, _seen: set = None) -> int:
+    # Deep sys.getsizeof over plain containers; other objects count only their own size
+    seen = set() if _seen is None else _seen
+    if id(obj) in seen: return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict): size += sum(approximate_size(key, seen) + approximate_size(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)): size += sum(approximate_size(item, seen) for item in obj)
+    return size
+
+def current_rss_bytes() -> int | None:
+    try:
+        with open("/proc/self/statm") as statm: return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError): return None # Not Linux
+
+@log_handler
+async def admin_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    if not (ADMIN_IDS and uid in ADMIN_IDS):
+        await update.message.reply_text(await _(context, "admin_unauthorized", user_id=uid)); return
+    application = context.application
+    user_sizes = [approximate_size(data) for data in application.user_data.values()]
+    rss = current_rss_bytes()
+    text = await _(context, "admin_stats_title", user_id=uid, default="📊 Bot statistics (this process)") + "\n\n"
+    text += await _(context, "admin_stats_memory", user_id=uid, rss_mb=f"{rss / 1048576:.1f}" if rss else "n/a",
+                    users=len(user_sizes), avg_kb=f"{(sum(user_sizes) / len(user_sizes) if user_sizes else 0) / 1024:.1f}",
+                    max_kb=f"{max(user_sizes, default=0) / 1024:.1f}", total_kb=f"{sum(user_sizes) / 1024:.1f}",
+                    chats=len(application.chat_data), evicted_users=eviction_counters["users"], evicted_chats=eviction_counters["chats"],
+                    carts_saved=eviction_counters["carts_saved"], ttl_hours=f"{USER_DATA_IDLE_TTL_SECONDS / 3600:g}", default="Memory stats")
+    now = time.monotonic()
+    text += "\n" + await _(context, "admin_stats_flood", user_id=uid, **flood_counters, tracked=len(flood_buckets),
+                           muted_now=sum(1 for bucket in flood_buckets.values() if now < bucket.muted_until),
+                           rate=f"{FLOOD_RATE_PER_SECOND:g}", burst=f"{FLOOD_BURST:g}", default="Flood protection stats")
+    if http_requests:
+        text += "\n" + await _(context, "admin_stats_http_title", user_id=uid, profile=TELEGRAM_HTTP_PROFILE, default="Bot API transport")
+        for request in http_requests.values():
+            stats = request.stats
+            text += "\n" + await _(context, "admin_stats_http_line", user_id=uid, name=request.name, pool_size=request.pool_size, http_version=request.http_version,
+                                   requests=stats["requests"], waited=stats["waited"], pool_timeouts=stats["pool_timeouts"],
+                                   avg_wait_ms=f"{stats['wait_total'] / stats['requests'] * 1000 if stats['requests'] else 0:.1f}",
+                                   max_wait_ms=f"{stats['wait_max'] * 1000:.0f}", default=f"{request.name}: {stats}")
+    await update.message.reply_text(text)
+
+# --- Bot API Transport ---
+# Outgoing calls (sends, edits, answers) and the getUpdates long poll each get their own HTTPXRequest and connection
+# pool, so a burst of sends never queues behind the poll. TELEGRAM_HTTP_PROFILE picks a set of defaults and the
+# TELEGRAM_HTTP_* variables override single values. Requests wait for a free connection on a semaphore sized like
+# the pool, which is where the pool-wait metric shown by /stats is measured.
+TELEGRAM_HTTP_PROFILES = {
+    "default": {"pool_size": 64, "keepalive": 30, "connect_timeout": 5, "read_timeout": 5, "write_timeout": 5, "pool_timeout": 3},
+    "burst": {"pool_size": 256, "keepalive": 60, "connect_timeout": 5, "read_timeout": 10, "write_timeout": 10, "pool_timeout": 10},
+    "small": {"pool_size": 8, "keepalive": 15, "connect_timeout": 10, "read_timeout": 10, "write_timeout": 10, "pool_timeout": 10},
+}
+TELEGRAM_HTTP_PROFILE = os.getenv("TELEGRAM_HTTP_PROFILE", "default")
+TELEGRAM_HTTP2 = os.getenv("TELEGRAM_HTTP2", "0").lower() in ("1", "true", "yes") # Needs the optional h2 package
+GET_UPDATES_READ_TIMEOUT = 5 # Added on top of the long poll timeout by PTB
+
+def telegram_http_settings() -> dict:
+    settings = dict(TELEGRAM_HTTP_PROFILES.get(TELEGRAM_HTTP_PROFILE) or TELEGRAM_HTTP_PROFILES["default"])
+    if TELEGRAM_HTTP_PROFILE not in TELEGRAM_HTTP_PROFILES: logger.warning("Unknown TELEGRAM_HTTP_PROFILE %r, using 'default'", TELEGRAM_HTTP_PROFILE)
+    for name in settings:
+        raw = os.getenv(f"TELEGRAM_HTTP_{name.upper()}")
+        if raw:
+            try: settings[name] = int(raw) if name == "pool_size" else float(raw)
+            except ValueError: logger.warning("Ignoring invalid TELEGRAM_HTTP_%s=%r", name.upper(), raw)
+    return settings
+
+class MeteredHTTPXRequest(HTTPXRequest):
+    def __init__(self, name: str, pool_size: int, keepalive: float, pool_timeout: float, http_version: str = "1.1", **timeouts):
+        super().__init__(connection_pool_size=pool_size, pool_timeout=pool_timeout, http_version=http_version,
+                         httpx_kwargs={"limits": httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size, keepalive_expiry=keepalive)}, **timeouts)
+        self.name, self.pool_size = name, pool_size
+        self._default_pool_timeout = pool_timeout
+        self._slots = asyncio.Semaphore(pool_size)
+        self.stats = {"requests": 0, "waited": 0, "wait_total": 0.0, "wait_max": 0.0, "pool_timeouts": 0}
+
+    async def do_request(self, url: str, method: str, request_data=None, read_timeout=BaseRequest.DEFAULT_NONE, write_timeout=BaseRequest.DEFAULT_NONE,
+                         connect_timeout=BaseRequest.DEFAULT_NONE, pool_timeout=BaseRequest.DEFAULT_NONE) -> tuple[int, bytes]:
+        timeout = self._default_pool_timeout if pool_timeout is BaseRequest.DEFAULT_NONE else pool_timeout
+        started_at = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout)
+        except asyncio.TimeoutError:
+            self.stats["pool_timeouts"] += 1
+            raise TimedOut(f"Pool timeout: all {self.pool_size} {self.name} connections are busy, the request was not sent") from None
+        waited = time.perf_counter() - started_at
+        self.stats["requests"] += 1
+        if waited >= 0.001: self.stats["waited"] += 1
+        self.stats["wait_total"] += waited
+        self.stats["wait_max"] = max(self.stats["wait_max"], waited)
+        try:
+            return await super().do_request(url, method, request_data, read_timeout, write_timeout, connect_timeout, pool_timeout)
+        finally:
+            self._slots.release()
+
+http_requests = {} # name -> MeteredHTTPXRequest of this process, for /stats
+
+def application_builder() -> ApplicationBuilder:
+    settings = telegram_http_settings()
+    http_version = "1.1"
+    if TELEGRAM_HTTP2:
+        if importlib.util.find_spec("h2"): http_version = "2"
+        else: logger.warning("TELEGRAM_HTTP2 is set but the h2 package is not installed (pip install 'python-telegram-bot[http2]'), using HTTP/1.1")
+    timeouts = {name: settings[name] for name in ("connect_timeout", "read_timeout", "write_timeout")}
+    http_requests["api"] = MeteredHTTPXRequest("api", settings["pool_size"], settings["keepalive"], settings["pool_timeout"], http_version, **timeouts)
+    # One connection is enough: only one getUpdates is ever in flight, and it stays off the send pool
+    http_requests["updates"] = MeteredHTTPXRequest("updates", 1, max(settings["keepalive"], 60), settings["pool_timeout"], http_version,
+                                                   **{**timeouts, "read_timeout": GET_UPDATES_READ_TIMEOUT})
+    return Application.builder().token(TELEGRAM_TOKEN).request(http_requests["api"]).get_updates_request(http_requests["updates"])
+
+def build_application(init_schema: bool = True, maintenance_jobs: bool = True) -> Application:
+    async def open_storage(_application: Application) -> None:
+        with startup_phase("storage"): await storage.open(init_schema=init_schema) # Schema DDL only runs when SCHEMA_VERSION changed
+        storage.add_catalog_listener(refresh_product_search_index)
+        storage.add_stock_listener(update_catalog_stock)
+        with startup_phase("catalog"): await refresh_product_search_index() # Prewarms the catalog before the first update
+        log_startup_timing()
+    async def close_storage(application: Application) -> None:
+        await save_live_carts(application, list(application.user_data)) # Restored on each user's next update
+        await storage.close()
+
+    handlers_started_at = time.perf_counter()
+    application = application_builder().post_init(open_storage).post_shutdown(close_storage).build()
 
     # Common fallbacks for most user-facing conversations
     general_conv_fallbacks = [
@@ -1124,10 +2086,13 @@ def main() -> None:
         # per_message=False, per_user=True # Default, good for user_data
     )
 
+    product_deep_link_handler = CommandHandler("start", order_flow_deep_link_entry, filters=filters.Regex(PRODUCT_DEEP_LINK_PATTERN))
     order_conv = ConversationHandler(
         entry_points=[
             CallbackQueryHandler(order_flow_browse_entry, pattern="^order_flow_browse_entry$"),
-            CallbackQueryHandler(order_flow_view_cart_direct_entry, pattern="^order_flow_view_cart_direct_entry$")
+            CallbackQueryHandler(order_flow_view_cart_direct_entry, pattern="^order_flow_view_cart_direct_entry$"),
+            CallbackQueryHandler(order_flow_repeat_last_order_entry, pattern="^order_flow_repeat_last_entry$"),
+            product_deep_link_handler
         ],
         states={
             ORDER_FLOW_BROWSING_PRODUCTS: [
@@ -1143,7 +2108,7 @@ def main() -> None:
                 CallbackQueryHandler(lambda u,c: order_flow_list_products(u,c,u.callback_query.from_user.id, edit_message=True), pattern="^order_flow_browse_return_cb$"),
             ]
         },
-        fallbacks=general_conv_fallbacks
+        fallbacks=[product_deep_link_handler] + general_conv_fallbacks # A deep link restarts the flow on that product
     )
 
     admin_add_prod_conv = ConversationHandler(
@@ -1163,12 +2128,14 @@ def main() -> None:
             ],
             ADMIN_MANAGE_PROD_OPTIONS: [
                 CallbackQueryHandler(admin_manage_edit_price_entry_cb, pattern="^admin_manage_edit_price_entry_cb$"),
+                CallbackQueryHandler(admin_manage_edit_stock_entry_cb, pattern="^admin_manage_edit_stock_entry_cb$"),
                 CallbackQueryHandler(admin_manage_toggle_avail_cb, pattern="^admin_manage_toggle_avail_cb_(0|1)$"),
                 CallbackQueryHandler(admin_manage_delete_confirm_cb, pattern="^admin_manage_delete_confirm_cb$"),
                 # Refresh list by calling list_entry_cb
                 CallbackQueryHandler(admin_manage_prod_list_entry_cb, pattern="^admin_manage_prod_list_refresh_cb$")
             ],
             ADMIN_MANAGE_PROD_EDIT_PRICE: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_manage_edit_price_state)],
+            ADMIN_MANAGE_PROD_EDIT_STOCK: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_manage_edit_stock_state)],
             ADMIN_MANAGE_PROD_DELETE_CONFIRM: [
                 CallbackQueryHandler(admin_manage_delete_do_cb, pattern="^admin_manage_delete_do_cb$"),
                 # If "No" on delete confirm, go back to product options
@@ -1178,6 +2145,48 @@ def main() -> None:
         fallbacks=admin_conv_fallbacks
     )
 
+    admin_import_catalog_conv = ConversationHandler(
+        entry_points=[CallbackQueryHandler(admin_import_catalog_entry_cb, pattern="^admin_import_catalog_entry_cb$")],
+        states={
+            ADMIN_IMPORT_CATALOG_UPLOAD: [
+                MessageHandler(filters.Document.ALL, admin_import_catalog_file_state),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, admin_import_catalog_not_a_file)
+            ]
+        },
+        fallbacks=admin_conv_fallbacks
+    )
+
+    admin_sales_report_conv = ConversationHandler(
+        entry_points=[CallbackQueryHandler(admin_sales_report_entry_cb, pattern="^admin_sales_report_entry_cb$")],
+        states={
+            ADMIN_SALES_REPORT_MENU: [
+                CallbackQueryHandler(admin_sales_report_preset_cb, pattern=f"^admin_sales_report_preset_({'|'.join(SALES_REPORT_PRESETS)})$"),
+                CallbackQueryHandler(admin_sales_report_custom_cb, pattern="^admin_sales_report_custom_cb$"),
+                CallbackQueryHandler(admin_sales_report_entry_cb, pattern="^admin_sales_report_entry_cb$")
+            ],
+            ADMIN_SALES_REPORT_RANGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_sales_report_range_state)]
+        },
+        fallbacks=admin_conv_fallbacks
+    )
+
+    admin_broadcast_conv = ConversationHandler(
+        entry_points=[CallbackQueryHandler(admin_broadcast_entry_cb, pattern="^admin_broadcast_entry_cb$")],
+        states={
+            ADMIN_BROADCAST_TEXT: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_broadcast_text_state)],
+            ADMIN_BROADCAST_CONFIRM: [CallbackQueryHandler(admin_broadcast_confirm_cb, pattern="^admin_broadcast_confirm_cb$")]
+        },
+        fallbacks=admin_conv_fallbacks
+    )
+
+    admin_order_status_conv = ConversationHandler(
+        entry_points=[CallbackQueryHandler(admin_order_status_entry_cb, pattern="^admin_order_status_entry_cb$")],
+        states={
+            ADMIN_ORDER_STATUS_ACTION: [CallbackQueryHandler(admin_order_status_action_cb, pattern=f"^admin_order_status_to_({'|'.join(ORDER_STATUS_ACTIONS)})$")],
+            ADMIN_ORDER_STATUS_SELECTION: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_order_status_selection_state)]
+        },
+        fallbacks=admin_conv_fallbacks
+    )
+
     admin_clear_orders_conv = ConversationHandler(
         entry_points=[CallbackQueryHandler(admin_clear_completed_orders_entry_cb, pattern="^admin_clear_orders_entry_cb$")],
         states={
@@ -1188,24 +2197,132 @@ def main() -> None:
         fallbacks=admin_conv_fallbacks
     )
 
-    application.add_handler(CommandHandler("start", start_command))
+    application.add_handler(TypeHandler(Update, flood_guard), group=-2) # Sheds floods before anything else runs
+    application.add_handler(TypeHandler(Update, track_activity), group=-1) # Before every other handler
+
+    # Plain /start only; "/start product_<id>" deep links are an entry point of order_conv
+    application.add_handler(CommandHandler("start", start_command, filters=~filters.Regex(PRODUCT_DEEP_LINK_PATTERN)))
     application.add_handler(CommandHandler("admin", admin_command_entry))
+    application.add_handler(CommandHandler("export_orders", admin_export_orders_command))
+    application.add_handler(CommandHandler("stats", admin_stats_command))
 
     application.add_handler(lang_conv)
     application.add_handler(order_conv)
     application.add_handler(admin_add_prod_conv)
     application.add_handler(admin_manage_prod_conv)
     application.add_handler(admin_clear_orders_conv)
+    application.add_handler(admin_import_catalog_conv)
+    application.add_handler(admin_sales_report_conv)
+    application.add_handler(admin_broadcast_conv)
+    application.add_handler(admin_order_status_conv)
 
     # Direct callback handlers (not part of conversations)
     application.add_handler(CallbackQueryHandler(my_orders_direct_cb, pattern="^my_orders_direct_cb$"))
     application.add_handler(CallbackQueryHandler(admin_view_orders_direct_cb, pattern="^admin_view_orders_direct_cb$"))
     application.add_handler(CallbackQueryHandler(admin_shop_list_direct_cb, pattern="^admin_shop_list_direct_cb$"))
+    application.add_handler(CallbackQueryHandler(admin_export_catalog_direct_cb, pattern="^admin_export_catalog_direct_cb$"))
+    application.add_handler(CallbackQueryHandler(admin_export_orders_direct_cb, pattern="^admin_export_orders_direct_cb$"))
+    application.add_handler(InlineQueryHandler(inline_product_search))
+
+    application.job_queue.run_repeating(refresh_catalog_job, interval=CATALOG_REFRESH_SECONDS, first=CATALOG_REFRESH_SECONDS)
+    application.job_queue.run_once(backfill_sales_job, when=5)
+    application.job_queue.run_repeating(resume_broadcasts_job, interval=BROADCAST_LEASE_SECONDS, first=10)
+    application.job_queue.run_repeating(flush_order_status_notifications_job, interval=ORDER_NOTIFY_INTERVAL_SECONDS, first=ORDER_NOTIFY_INTERVAL_SECONDS)
+    application.job_queue.run_repeating(evict_idle_data_job, interval=IDLE_EVICTION_INTERVAL_SECONDS, first=IDLE_EVICTION_INTERVAL_SECONDS)
+    if LOCALE_RELOAD_SECONDS > 0:
+        application.job_queue.run_repeating(reload_translations_job, interval=LOCALE_RELOAD_SECONDS, first=LOCALE_RELOAD_SECONDS)
+    if maintenance_jobs: schedule_db_maintenance(application.job_queue)
+    startup_phases["handlers"] = time.perf_counter() - handlers_started_at
 
     # A top-level fallback for unhandled commands or text could be added if needed
     # application.add_handler(MessageHandler(filters.COMMAND | filters.TEXT, unknown_handler))
+    return application
+
+# --- Scale-out Mode ---
+# With BOT_WORKERS > 1 the main process only receives updates (polling, or a webhook if WEBHOOK_URL is set)
+# and forwards them over local multiprocessing queues to BOT_WORKERS worker processes that run the handlers.
+# Updates are routed by user through a consistent hash ring, so each user's user_data and conversation
+# state always live in the same worker.
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))
+WEBHOOK_URL = os.getenv("WEBHOOK_URL") # e.g. https://example.onrender.com/telegram
+WEBHOOK_LISTEN_PORT = int(os.getenv("PORT", "8443"))
+HASH_RING_REPLICAS = 64 # Virtual nodes per worker, smooths the distribution of users
+
+class ConsistentHashRing:
+    def __init__(self, nodes, replicas: int = HASH_RING_REPLICAS):
+        self._ring = sorted((self._hash(f"{node}:{replica}"), node) for node in nodes for replica in range(replicas))
+        self._hashes = [ring_hash for ring_hash, _node in self._ring]
+
+    @staticmethod
+    def _hash(value) -> int:
+        return int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), "big")
+
+    def node_for(self, key):
+        index = bisect.bisect(self._hashes, self._hash(key)) % len(self._hashes)
+        return self._ring[index][1]
+
+def _routing_key(update: Update):
+    if update.effective_user: return update.effective_user.id
+    if update.effective_chat: return update.effective_chat.id
+    return update.update_id
+
+def _run_application(application: Application) -> None:
+    if WEBHOOK_URL:
+        application.run_webhook(listen="0.0.0.0", port=WEBHOOK_LISTEN_PORT, url_path=urlsplit(WEBHOOK_URL).path.lstrip("/"),
+                                webhook_url=WEBHOOK_URL, allowed_updates=Update.ALL_TYPES)
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
+
+async def _worker_loop(worker_index: int, update_queue) -> None:
+    # The receiver already created the schema; database maintenance runs in the first worker only
+    application = build_application(init_schema=False, maintenance_jobs=worker_index == 0)
+    loop = asyncio.get_running_loop()
+    async with application: # initialize() / shutdown(); post_init/post_shutdown are only run by run_polling()
+        await application.post_init(application)
+        await application.start()
+        logger.info("Worker %s ready", worker_index)
+        while True:
+            update_data = await loop.run_in_executor(None, update_queue.get)
+            if update_data is None: break # Shutdown sentinel from the receiver
+            await application.update_queue.put(Update.de_json(update_data, application.bot))
+        await application.stop()
+    await application.post_shutdown(application)
+    logger.info("Worker %s stopped", worker_index)
+
+def _worker_process_main(worker_index: int, update_queue) -> None:
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # Ctrl+C reaches the whole group; workers stop via the receiver's sentinel
+    if not configure_runtime(): return
+    asyncio.run(_worker_loop(worker_index, update_queue))
+
+def run_scaled_out(worker_count: int) -> None:
+    mp_context = multiprocessing.get_context("spawn")
+    update_queues = [mp_context.Queue() for _ in range(worker_count)]
+    workers = [mp_context.Process(target=_worker_process_main, args=(i, update_queues[i]), name=f"bot-worker-{i}", daemon=True)
+               for i in range(worker_count)]
+    asyncio.run(init_storage_schema()) # Once, before any worker touches the database
+    for worker in workers: worker.start()
+    ring = ConsistentHashRing(range(worker_count))
+
+    async def forward_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        update_queues[ring.node_for(_routing_key(update))].put(update.to_dict())
+
+    receiver = application_builder().build()
+    receiver.add_handler(TypeHandler(Update, forward_update))
+    logger.info("Receiver starting with %s worker processes...", worker_count)
+    try:
+        _run_application(receiver)
+    finally:
+        for update_queue in update_queues: update_queue.put(None)
+        for worker in workers: worker.join(timeout=10)
 
+def main() -> None:
+    if not configure_runtime(): return
+    if DB_CONVERT_AUTO_VACUUM: asyncio.run(convert_storage_auto_vacuum())
+    if BOT_WORKERS > 1:
+        run_scaled_out(BOT_WORKERS)
+        return
+    application = build_application()
     logger.info("Bot starting...")
-    application.run_polling()
+    _run_application(application)
 
 if __name__ == "__main__": main()
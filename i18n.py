@@ -0,0 +1,92 @@
+import json
+import logging
+import os
+import pickle
+import string
+
+logger = logging.getLogger(__name__)
+
+# Translation bundles: {lang_code: {key: text}} compiled from locales/<lang_code>.json. Compiling parses and
+# validates every file; the result is cached in one pickle file that stays valid while the mtime and size of
+# every source file match the ones recorded in it, so a restart with unchanged locales skips JSON parsing.
+
+LOCALE_CODES = ("en", "lt")
+REFERENCE_LOCALE = "en" # Other locales are compared against this one for missing keys and placeholders
+_BUNDLE_CACHE_FORMAT = 1
+
+class LocaleError(ValueError):
+    pass
+
+def _placeholders(text: str) -> frozenset:
+    # Names used by str.format(); raises ValueError on unbalanced braces
+    return frozenset(field.split(".")[0].split("[")[0] for _literal, field, _spec, _conversion in string.Formatter().parse(text) if field)
+
+def source_stamps(locale_dir: str, lang_codes=LOCALE_CODES) -> dict:
+    # lang_code -> (mtime_ns, size) of its file, or None if the file is missing
+    stamps = {}
+    for lang_code in lang_codes:
+        try:
+            stat = os.stat(os.path.join(locale_dir, f"{lang_code}.json"))
+            stamps[lang_code] = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            stamps[lang_code] = None
+    return stamps
+
+def compile_locale(locale_dir: str, lang_code: str) -> dict:
+    file_path = os.path.join(locale_dir, f"{lang_code}.json")
+    try:
+        with open(file_path, "r", encoding="utf-8") as f: data = json.load(f)
+    except (OSError, ValueError) as e: # ValueError covers JSONDecodeError and bad UTF-8
+        raise LocaleError(f"{file_path}: {e}") from e
+    if not isinstance(data, dict) or not data:
+        raise LocaleError(f"{file_path}: expected a non-empty JSON object")
+    for key, text in data.items():
+        if not isinstance(text, str):
+            raise LocaleError(f"{file_path}: '{key}' is not a string")
+        try: _placeholders(text)
+        except ValueError as e: raise LocaleError(f"{file_path}: '{key}' has invalid placeholders ({e})") from e
+    return data
+
+def compare_locales(bundle: dict) -> list:
+    # Problems that do not stop a bundle from loading: _() falls back to the default language or the caller's default
+    reference = bundle.get(REFERENCE_LOCALE, {})
+    warnings = []
+    for lang_code, texts in bundle.items():
+        if lang_code == REFERENCE_LOCALE: continue
+        missing = sorted(set(reference) - set(texts))
+        if missing: warnings.append(f"{lang_code} is missing {len(missing)} keys: {', '.join(missing[:10])}")
+        for key in sorted(set(reference) & set(texts)):
+            if _placeholders(texts[key]) != _placeholders(reference[key]):
+                warnings.append(f"{lang_code}.{key} uses different placeholders than {REFERENCE_LOCALE}")
+    return warnings
+
+def compile_bundle(locale_dir: str, lang_codes=LOCALE_CODES) -> dict:
+    # Raises LocaleError if any file is unreadable or invalid; nothing partial is returned
+    bundle = {lang_code: compile_locale(locale_dir, lang_code) for lang_code in lang_codes}
+    for warning in compare_locales(bundle): logger.warning("Locale check: %s", warning)
+    return bundle
+
+def _write_cache(cache_path: str, stamps: dict, bundle: dict) -> None:
+    temp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, "wb") as f: pickle.dump({"format": _BUNDLE_CACHE_FORMAT, "stamps": stamps, "bundle": bundle}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, cache_path) # Readers never see a half-written cache
+    except OSError as e:
+        logger.warning("Could not write locale bundle cache %s: %s", cache_path, e)
+        try: os.remove(temp_path)
+        except OSError: pass
+
+def load_bundle(locale_dir: str, cache_path: str, lang_codes=LOCALE_CODES) -> tuple[dict, dict, bool]:
+    # (bundle, source stamps it was built from, loaded from cache); raises LocaleError like compile_bundle
+    stamps = source_stamps(locale_dir, lang_codes) # Taken before reading, so a concurrent edit invalidates the cache
+    try:
+        with open(cache_path, "rb") as f: cached = pickle.load(f)
+        if cached.get("format") == _BUNDLE_CACHE_FORMAT and cached.get("stamps") == stamps:
+            return cached["bundle"], stamps, True
+    except FileNotFoundError:
+        pass
+    except Exception as e: # A corrupt or foreign cache file is just rebuilt
+        logger.warning("Ignoring unreadable locale bundle cache %s: %s", cache_path, e)
+    bundle = compile_bundle(locale_dir, lang_codes)
+    _write_cache(cache_path, stamps, bundle)
+    return bundle, stamps, False
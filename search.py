@@ -0,0 +1,130 @@
+import bisect
+import functools
+import heapq
+import itertools
+import math
+import unicodedata
+from collections import Counter
+
+# In-memory product search used by the inline query handler. The index is immutable: a catalog change
+# builds a new ProductSearchIndex and the bot swaps the reference, so lookups never take a lock or touch the DB.
+
+SEARCH_CACHE_SIZE = 1024 # Recent folded queries per index; inline queries repeat as the user types
+_EXTRA_FOLDS = str.maketrans({"ł": "l", "đ": "d", "ø": "o", "ß": "ss", "æ": "ae", "œ": "oe"}) # Letters NFKD does not decompose
+
+def fold_text(text: str) -> str:
+    # Lowercase, strip diacritics (ą->a, č->c, ė->e, š->s, ž->z, ...) and turn punctuation into spaces
+    decomposed = unicodedata.normalize("NFKD", text.lower().translate(_EXTRA_FOLDS))
+    stripped = "".join(ch for ch in decomposed if not unicodedata.combining(ch))
+    return " ".join("".join(ch if ch.isalnum() else " " for ch in stripped).split())
+
+def _trigrams(padded_word: str) -> set:
+    return {padded_word[i:i + 3] for i in range(len(padded_word) - 2)}
+
+MIN_WORD_SCORE = 0.5 # Share of a query word's trigrams a catalog word must contain to count as a match
+MAX_WORD_COMBINATIONS = 64 # Multi-word queries with more matched-word combinations than this score every candidate
+
+class ProductSearchIndex:
+    # Trigrams index the (small) vocabulary of distinct folded words rather than the products themselves,
+    # so a query first scores a few hundred words and then expands them through precomputed postings.
+    def __init__(self, products):
+        # products: (id, name, price_per_kg, ...) rows, typically storage.get_products(available_only=True)
+        self.products = {}
+        self._folded_names = {}
+        self._product_words = {}
+        first_word_of = {}
+        word_posting_sets = {}
+        for product in products:
+            product_id, name = product[0], product[1]
+            self.products[product_id] = product
+            folded_name = fold_text(name)
+            self._folded_names[product_id] = folded_name
+            words = folded_name.split()
+            self._product_words[product_id] = frozenset(words)
+            first_word_of[product_id] = words[0] if words else ""
+            for word in words:
+                word_posting_sets.setdefault(word, set()).add(product_id)
+        self._word_posting_sets = {word: frozenset(ids) for word, ids in word_posting_sets.items()}
+        # Within one word, products named by that word come first, then shorter names
+        self._word_postings = {word: tuple(sorted(ids, key=lambda pid: (first_word_of[pid] != word, len(self._folded_names[pid]), self._folded_names[pid])))
+                               for word, ids in word_posting_sets.items()}
+        self._trigram_words = {}
+        self._short_prefix_words = {} # 1-2 character prefixes, for query words too short for trigrams
+        for word in self._word_postings:
+            for gram in _trigrams(f" {word} "):
+                self._trigram_words.setdefault(gram, set()).add(word)
+            for length in (1, 2):
+                if len(word) >= length:
+                    self._short_prefix_words.setdefault(word[:length], set()).add(word)
+        # Products by folded name, for prefix lookups, and the rank of each among equally scored results
+        self._sorted_names = sorted((folded_name, product_id) for product_id, folded_name in self._folded_names.items())
+        self._sorted_name_keys = [folded_name for folded_name, _product_id in self._sorted_names]
+        self._tie_rank = {product_id: rank for rank, product_id in enumerate(sorted(self._folded_names, key=lambda pid: (len(self._folded_names[pid]), -pid)))}
+        self._cached_search = functools.lru_cache(maxsize=SEARCH_CACHE_SIZE)(self._search)
+
+    def __len__(self) -> int:
+        return len(self.products)
+
+    def search(self, query: str, limit: int = 20) -> list:
+        # Returns the matching product rows, best match first
+        folded_query = fold_text(query)
+        if not folded_query: return []
+        return [self.products[product_id] for product_id in self._cached_search(folded_query, limit)]
+
+    def _match_words(self, query_word: str) -> dict:
+        # Catalog word -> match score in (0, 1]
+        if len(query_word) < 3:
+            return dict.fromkeys(self._short_prefix_words.get(query_word, ()), 1.0)
+        # Only the start of a query word is padded: the user may still be typing the rest of it
+        grams = _trigrams(f" {query_word}")
+        counts = Counter()
+        for gram in grams: counts.update(self._trigram_words.get(gram, ()))
+        return {word: count / len(grams) for word, count in counts.items() if count / len(grams) >= MIN_WORD_SCORE}
+
+    def _search(self, folded_query: str, limit: int) -> tuple:
+        word_matches = [self._match_words(word) for word in folded_query.split()]
+        if not all(word_matches): return ()
+        if len(word_matches) == 1:
+            # Walk the matched words best first and take products from their presorted postings until the limit
+            matches = word_matches[0]
+            result, seen = [], set()
+            for word in sorted(matches, key=lambda w: (-matches[w], len(w), w)):
+                for product_id in self._word_postings[word]:
+                    if product_id in seen: continue
+                    seen.add(product_id); result.append(product_id)
+                    if len(result) >= limit: return tuple(result)
+            return tuple(result)
+        # Several words: every query word must match some word of the product, which scores the best match of each
+        # query word, plus 1 if its name starts with the whole query
+        if math.prod(map(len, word_matches)) > MAX_WORD_COMBINATIONS: return self._score_all(folded_query, word_matches, limit)
+        ranked, seen = [], set()
+        # Names starting with the query are found by bisecting the sorted names and scored up front
+        start = bisect.bisect_left(self._sorted_name_keys, folded_query)
+        for folded_name, product_id in itertools.islice(self._sorted_names, start, None):
+            if not folded_name.startswith(folded_query): break
+            if all(not matches.keys().isdisjoint(self._product_words[product_id]) for matches in word_matches):
+                ranked.append(self._ranked(product_id, word_matches, 1.0)); seen.add(product_id)
+        # Then one matched word per query word, best combined score first. A combination's products are the
+        # intersection of its postings, smallest first; products seen in a better combination are skipped, and only
+        # the first `limit` of the rest by tie order can make the result. Stops once no later combination can.
+        combos = sorted(((sum(scores), words) for words, scores in (zip(*combo) for combo in itertools.product(*(matches.items() for matches in word_matches)))),
+                        key=lambda combo: -combo[0])
+        for score, words in combos:
+            if len(ranked) >= limit and score < heapq.nlargest(limit, ranked)[-1][0]: break
+            postings = sorted((self._word_posting_sets[word] for word in words), key=len)
+            products = postings[0].intersection(*postings[1:]).difference(seen)
+            seen.update(products)
+            ranked.extend((score, -len(self._folded_names[product_id]), product_id) for product_id in heapq.nsmallest(limit, products, key=self._tie_rank.__getitem__))
+        return tuple(product_id for _score, _length, product_id in heapq.nlargest(limit, ranked))
+
+    def _ranked(self, product_id: int, word_matches: list, bonus: float = 0.0) -> tuple:
+        product_words = self._product_words[product_id]
+        score = sum(max(matches.get(word, 0.0) for word in product_words) for matches in word_matches) + bonus
+        return score, -len(self._folded_names[product_id]), product_id
+
+    def _score_all(self, folded_query: str, word_matches: list, limit: int) -> tuple:
+        # Many short query words: intersect each word's candidates, smallest first, and score every product left
+        candidate_sets = sorted((frozenset().union(*(self._word_posting_sets[word] for word in matches)) for matches in word_matches), key=len)
+        ranked = [self._ranked(product_id, word_matches, 1.0 if self._folded_names[product_id].startswith(folded_query) else 0.0)
+                  for product_id in candidate_sets[0].intersection(*candidate_sets[1:])]
+        return tuple(product_id for _score, _length, product_id in heapq.nlargest(limit, ranked))
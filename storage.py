@@ -0,0 +1,1439 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import os
+import time
+from abc import ABC, abstractmethod
+from datetime import datetime
+from urllib.request import pathname2url
+
+logger = logging.getLogger(__name__)
+
+# Storage backends for the bot. SQLiteStorage (the default) keeps everything in one local file;
+# PostgresStorage is selected by setting DATABASE_URL=postgresql://... and needs the optional asyncpg package.
+# Every method is a coroutine so handlers can await either backend the same way.
+
+# --- Database Query Tracing (SQLite) ---
+# Set DB_TRACE_QUERIES=1 to log statements slower than DB_SLOW_QUERY_MS (with their parameters)
+# and to capture EXPLAIN QUERY PLAN output the first time each distinct statement runs.
+DB_TRACE_QUERIES = os.getenv("DB_TRACE_QUERIES", "0").lower() in ("1", "true", "yes")
+DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "50"))
+_explained_statements = set() # Statements whose plan has already been captured in this process
+_EXPLAINABLE_PREFIXES = ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE")
+
+def _explain_statement(conn: sqlite3.Connection, sql: str, params) -> None:
+    normalized_sql = " ".join(sql.split())
+    if normalized_sql in _explained_statements: return
+    _explained_statements.add(normalized_sql)
+    if not normalized_sql.upper().startswith(_EXPLAINABLE_PREFIXES): return
+    try:
+        # Uses the base class execute so the EXPLAIN itself is not traced
+        plan_rows = sqlite3.Connection.execute(conn, f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+    except sqlite3.Error as e:
+        logger.warning("EXPLAIN QUERY PLAN failed for statement %r: %s", normalized_sql, e)
+        return
+    plan_lines = [row[3] for row in plan_rows]
+    # INSERT ... VALUES has no plan steps; INSERT ... SELECT and upserts from a SELECT do
+    logger.info("Query plan for %r:\n  %s", normalized_sql, "\n  ".join(plan_lines) or "(no scans or searches)")
+    # 'SCAN <table>' without an index (SQLite >= 3.36 wording; older versions say 'SCAN TABLE') is a full table scan
+    full_scans = [line for line in plan_lines if line.startswith("SCAN ") and "USING" not in line]
+    if full_scans:
+        logger.warning("Full table scan in statement %r: %s", normalized_sql, "; ".join(full_scans))
+
+def _log_if_slow(sql: str, params, started_at: float) -> None:
+    elapsed_ms = (time.perf_counter() - started_at) * 1000
+    if elapsed_ms >= DB_SLOW_QUERY_MS:
+        logger.warning("Slow query (%.1f ms >= %g ms): %r params=%r", elapsed_ms, DB_SLOW_QUERY_MS, " ".join(sql.split()), params)
+
+class TracingCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        _explain_statement(self.connection, sql, parameters)
+        started_at = time.perf_counter()
+        try: return super().execute(sql, parameters)
+        finally: _log_if_slow(sql, parameters, started_at)
+
+    def executemany(self, sql, seq_of_parameters):
+        # Materialized so the first parameter tuple can be explained before the batch consumes them
+        seq_of_parameters = list(seq_of_parameters)
+        if seq_of_parameters: _explain_statement(self.connection, sql, seq_of_parameters[0])
+        started_at = time.perf_counter()
+        try: return super().executemany(sql, seq_of_parameters)
+        finally: _log_if_slow(sql, "<executemany>", started_at)
+
+class TracingConnection(sqlite3.Connection):
+    def cursor(self, factory=TracingCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def _now_str() -> str:
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+# --- SQLite Maintenance ---
+# Scheduled from bot.py. Each operation runs in a worker thread on its own connection so the event loop keeps
+# serving customers: the backup copies DB_BACKUP_PAGES_PER_STEP pages at a time and releases its lock between
+# steps, and the incremental vacuum frees at most DB_VACUUM_PAGES_PER_STEP pages per transaction.
+DB_BACKUP_PAGES_PER_STEP = int(os.getenv("DB_BACKUP_PAGES_PER_STEP", "256"))
+DB_BACKUP_STEP_SLEEP_SECONDS = float(os.getenv("DB_BACKUP_STEP_SLEEP_MS", "20")) / 1000
+DB_BACKUP_KEEP = int(os.getenv("DB_BACKUP_KEEP", "7")) # Newest backup files kept in the backup directory
+DB_VACUUM_PAGES_PER_STEP = int(os.getenv("DB_VACUUM_PAGES_PER_STEP", "500"))
+
+# --- SQLite Report Snapshot ---
+# Heavy admin reports (all orders, shopping list) read from a copy of the database made with the backup API
+# through a read-only connection, so a long aggregation never holds the live file's read lock against
+# checkouts. The copy is refreshed when it is older than REPORT_SNAPSHOT_MAX_AGE_SECONDS or an admin action
+# changed orders; 0 reads the live file (still read-only). REPORT_SNAPSHOT_PATH defaults to <db>-report.db.
+REPORT_SNAPSHOT_MAX_AGE_SECONDS = float(os.getenv("REPORT_SNAPSHOT_MAX_AGE_SECONDS", "60"))
+
+# Shared by both backends; products are LEFT JOINed so items of since-deleted products are still exported
+_ORDER_EXPORT_QUERY = ("SELECT o.id, o.order_date, o.user_id, o.user_name, o.status, o.total_price, oi.product_id, p.name, oi.quantity_kg, oi.price_at_order "
+                       "FROM orders o JOIN order_items oi ON oi.order_id = o.id LEFT JOIN products p ON p.id = oi.product_id "
+                       "{where} ORDER BY o.id, oi.id")
+
+def _order_export_filters(date_from: str, date_to: str, status: str, placeholder: str) -> tuple[str, list]:
+    # placeholder: "?" for SQLite, "$" for PostgreSQL's numbered $1, $2, ...
+    conditions, params = [], []
+    for condition, value in (("o.order_date >= {}", date_from), ("o.order_date < {}", date_to), ("o.status = {}", status)):
+        if value is None: continue
+        params.append(value)
+        conditions.append(condition.format("?" if placeholder == "?" else f"${len(params)}"))
+    return ("WHERE " + " AND ".join(conditions) if conditions else ""), params
+
+
+# --- Sales Rollups ---
+# daily_sales (per day and product) and daily_order_totals (per day) are updated in the same transaction that
+# saves an order, so sales reports read O(days x products) rollup rows instead of scanning orders/order_items.
+# Orders that existed before the rollup tables were created are folded in once by backfill_daily_sales();
+# daily_sales_backfill holds the highest order id that still needs it. Cancelling an order subtracts it again.
+_SALES_UPSERT = ("INSERT INTO daily_sales (sale_date, product_id, quantity_kg, revenue, order_count) {source} "
+                 "ON CONFLICT (sale_date, product_id) DO UPDATE SET quantity_kg = daily_sales.quantity_kg + excluded.quantity_kg, "
+                 "revenue = daily_sales.revenue + excluded.revenue, order_count = daily_sales.order_count + excluded.order_count")
+_ORDER_TOTALS_UPSERT = ("INSERT INTO daily_order_totals (sale_date, order_count, revenue) {source} "
+                        "ON CONFLICT (sale_date) DO UPDATE SET order_count = daily_order_totals.order_count + excluded.order_count, "
+                        "revenue = daily_order_totals.revenue + excluded.revenue")
+# Aggregates the orders matching {where} per day; {sign} is "-" to subtract them. substr() rather than a date
+# function so both backends group the TEXT order_date the same way.
+_ROLLUP_SALES_SOURCE = ("SELECT substr(o.order_date, 1, 10), oi.product_id, {sign}SUM(oi.quantity_kg), {sign}SUM(oi.quantity_kg * oi.price_at_order), {sign}COUNT(DISTINCT o.id) "
+                        "FROM orders o JOIN order_items oi ON oi.order_id = o.id WHERE {where} GROUP BY substr(o.order_date, 1, 10), oi.product_id")
+_ROLLUP_TOTALS_SOURCE = ("SELECT substr(o.order_date, 1, 10), {sign}COUNT(*), {sign}SUM(o.total_price) FROM orders o "
+                         "WHERE {where} GROUP BY substr(o.order_date, 1, 10)")
+
+def _rollup_statements(where: str, sign: str = "") -> list:
+    return [_SALES_UPSERT.format(source=_ROLLUP_SALES_SOURCE.format(where=where, sign=sign)),
+            _ORDER_TOTALS_UPSERT.format(source=_ROLLUP_TOTALS_SOURCE.format(where=where, sign=sign))]
+
+def _backfill_rollup_statements(max_id: int) -> list:
+    return _rollup_statements(f"o.id <= {int(max_id)} AND o.status <> 'cancelled'")
+
+def _cancelled_rollup_statements(order_ids: list) -> list:
+    # Orders still waiting for the backfill were never added, so they are not subtracted either
+    id_list = ", ".join(str(int(order_id)) for order_id in order_ids)
+    return _rollup_statements(f"o.id IN ({id_list}) AND o.id > (SELECT COALESCE(MAX(max_order_id), 0) FROM daily_sales_backfill)", sign="-")
+
+# --- Order Status ---
+# Status -> statuses an order may move to next; completed and cancelled are final
+ORDER_STATUS_TRANSITIONS = {"pending": ("confirmed", "cancelled"), "confirmed": ("completed", "cancelled"), "completed": (), "cancelled": ()}
+
+def _order_transition_query(new_status: str, order_ids: list, date_from: str, date_to: str, placeholder: str) -> tuple[str, list]:
+    # One set-based UPDATE that only touches orders whose current status may move to new_status
+    from_statuses = [status for status, targets in ORDER_STATUS_TRANSITIONS.items() if new_status in targets]
+    if not from_statuses: raise ValueError(f"No order can move to status {new_status!r}")
+    params = []
+    def bind(value) -> str:
+        params.append(value)
+        return "?" if placeholder == "?" else f"${len(params)}"
+    status_mark = bind(new_status)
+    conditions = [f"status IN ({', '.join(bind(status) for status in from_statuses)})"]
+    if order_ids is not None: conditions.append(f"id IN ({', '.join(str(int(order_id)) for order_id in order_ids) or 'NULL'})")
+    if date_from is not None: conditions.append(f"order_date >= {bind(date_from)}")
+    if date_to is not None: conditions.append(f"order_date < {bind(date_to)}")
+    return f"UPDATE orders SET status = {status_mark} WHERE {' AND '.join(conditions)} RETURNING id, user_id, total_price", params
+
+# --- Stock ---
+# products.stock_kg is the quantity left to sell, or NULL when the product's stock is not tracked. Checkout reserves
+# each product with one conditional UPDATE inside the order transaction, so two concurrent checkouts can never both
+# take the last kilograms: the second one matches no row and its whole order is rolled back.
+_STOCK_RESERVE = "UPDATE products SET stock_kg = stock_kg - {quantity} WHERE id = {product_id} AND (stock_kg IS NULL OR stock_kg >= {quantity}) RETURNING stock_kg"
+
+class InsufficientStock(Exception):
+    def __init__(self, product_ids: list):
+        super().__init__(f"Not enough stock for products {product_ids}")
+        self.product_ids = product_ids
+
+def _cart_quantities(cart: list) -> dict:
+    # product_id -> total kg; a cart may list one product more than once
+    quantities = {}
+    for item in cart: quantities[item['id']] = quantities.get(item['id'], 0.0) + item['quantity']
+    return quantities
+
+def _restock_statement(order_ids: list) -> str:
+    # Puts the quantities of cancelled orders back on the products whose stock is tracked
+    id_list = ", ".join(str(int(order_id)) for order_id in order_ids)
+    return (f"UPDATE products SET stock_kg = stock_kg + (SELECT SUM(oi.quantity_kg) FROM order_items oi WHERE oi.product_id = products.id AND oi.order_id IN ({id_list})) "
+            f"WHERE stock_kg IS NOT NULL AND id IN (SELECT product_id FROM order_items WHERE order_id IN ({id_list}))")
+
+# The user's newest order that was not cancelled, via idx_orders_user_id, then its items via idx_order_items_order_id
+_LAST_ORDER_ITEMS_QUERY = ("SELECT product_id, SUM(quantity_kg) FROM order_items WHERE order_id = "
+                           "(SELECT id FROM orders WHERE user_id = {user_id} AND status <> 'cancelled' ORDER BY id DESC LIMIT 1) "
+                           "GROUP BY product_id ORDER BY MIN(id)")
+
+def _sales_rollup_rows(sale_date: str, cart: list) -> list:
+    # (sale_date, product_id, quantity_kg, revenue) for each distinct product of one order
+    per_product = {}
+    for item in cart:
+        quantity_kg, revenue = per_product.get(item['id'], (0.0, 0.0))
+        per_product[item['id']] = (quantity_kg + item['quantity'], revenue + item['quantity'] * item['price'])
+    return [(sale_date, product_id, quantity_kg, revenue) for product_id, (quantity_kg, revenue) in per_product.items()]
+
+
+# Bump whenever init_schema() changes; open() skips the DDL while the stored version matches
+SCHEMA_VERSION = 3
+
+class Storage(ABC):
+    # Rows are returned as plain tuples in the column order documented on each method,
+    # so handlers can unpack them regardless of the backend.
+
+    def __init__(self):
+        self._catalog_listeners = []
+        self._stock_listeners = []
+
+    def add_catalog_listener(self, callback) -> None:
+        # callback: coroutine function awaited after every successful product insert/update/delete
+        self._catalog_listeners.append(callback)
+
+    def add_stock_listener(self, callback) -> None:
+        # callback(levels: {product_id: stock_kg}): coroutine function awaited after an order reserved tracked stock
+        self._stock_listeners.append(callback)
+
+    async def _catalog_changed(self) -> None:
+        for callback in self._catalog_listeners:
+            try: await callback()
+            except Exception as e: logger.error("Catalog listener %s failed: %s", getattr(callback, "__name__", callback), e)
+
+    async def _stock_changed(self, levels: dict) -> None:
+        if not levels: return
+        for callback in self._stock_listeners:
+            try: await callback(levels)
+            except Exception as e: logger.error("Stock listener %s failed: %s", getattr(callback, "__name__", callback), e)
+
+    async def open(self, init_schema: bool = True) -> None:
+        if init_schema and await self.get_schema_version() != SCHEMA_VERSION:
+            await self.init_schema()
+            await self.set_schema_version(SCHEMA_VERSION)
+
+    async def close(self) -> None:
+        pass
+
+    @abstractmethod
+    async def init_schema(self) -> None: ...
+
+    @abstractmethod
+    async def get_schema_version(self) -> int:
+        """Version recorded by the last completed init_schema(), 0 for a new or pre-versioning database."""
+
+    @abstractmethod
+    async def set_schema_version(self, version: int) -> None: ...
+
+    # Maintenance: each returns a dict of what it did for logging, or None when the backend does not need it
+    # (PostgreSQL vacuums and analyzes itself and is backed up with its own tools) or on error
+    async def backup(self, backup_dir: str) -> dict | None:
+        return None
+    async def optimize(self) -> dict | None:
+        return None
+    async def incremental_vacuum(self) -> dict | None:
+        return None
+    async def convert_auto_vacuum(self) -> dict | None:
+        return None
+
+    def report_data_age(self) -> float | None:
+        """Seconds the data of the last get_all_orders/get_shopping_list call lagged live writes; None if it was live."""
+        return None
+
+    # Users
+    @abstractmethod
+    async def get_user_language(self, user_id: int) -> str | None: ...
+    @abstractmethod
+    async def ensure_user(self, user_id: int, first_name: str, username: str, is_admin: bool, default_language: str) -> str | None:
+        """Upserts the user and returns their stored language (default_language if unset), or None on error."""
+    @abstractmethod
+    async def set_user_language(self, user_id: int, lang_code: str) -> None: ...
+    @abstractmethod
+    async def mark_user_blocked(self, user_id: int) -> None:
+        """Called when the user has blocked the bot; broadcasts skip them until ensure_user sees them again."""
+
+    # Products: (id, name, price_per_kg, is_available, stock_kg); stock_kg is None when stock is not tracked
+    @abstractmethod
+    async def add_product(self, name: str, price: float) -> bool: ...
+    @abstractmethod
+    async def get_products(self, available_only: bool = True) -> list: ...
+    @abstractmethod
+    async def get_product(self, product_id: int): ...
+    @abstractmethod
+    async def update_product(self, product_id: int, name: str = None, price: float = None, is_available: int = None) -> bool: ...
+    @abstractmethod
+    async def set_product_stock(self, product_id: int, stock_kg: float | None) -> bool:
+        """Sets the kg left to sell; None stops tracking stock for the product."""
+    @abstractmethod
+    async def delete_product(self, product_id: int) -> bool: ...
+    @abstractmethod
+    def iter_products(self, batch_size: int = 500):
+        """Async generator over all products ordered by name, fetched in batches rather than all at once."""
+    @abstractmethod
+    async def apply_catalog_changes(self, inserts: list, price_updates: list, availability_updates: list) -> bool:
+        """Applies (name, price, is_available) inserts, (price, id) and (is_available, id) updates in one transaction."""
+
+    # Orders
+    @abstractmethod
+    async def save_order(self, user_id: int, user_name: str, cart: list, total_price: float, idempotency_key: str = None) -> tuple[int | None, bool]:
+        """(order_id, created). With an idempotency_key already used by an earlier order, that order's id is returned with created=False.
+        Raises InsufficientStock, saving nothing, if a product has less stock left than the cart asks for (or no longer exists)."""
+    @abstractmethod
+    async def get_order_id_by_idempotency_key(self, idempotency_key: str) -> int | None: ...
+    @abstractmethod
+    async def get_user_orders(self, user_id: int) -> list:
+        """(id, order_date, total_price, status, items) newest first."""
+    @abstractmethod
+    async def get_last_order_items(self, user_id: int) -> list:
+        """(product_id, quantity_kg) of the user's newest order that was not cancelled, in the order they were added."""
+    @abstractmethod
+    async def get_all_orders(self) -> list:
+        """(id, user_id, user_name, order_date, total_price, status, items) newest first."""
+    @abstractmethod
+    def iter_order_rows(self, date_from: str = None, date_to: str = None, status: str = None, batch_size: int = 1000):
+        """Async generator of one row per order item, ordered by order id, read through a batched cursor:
+        (order_id, order_date, user_id, user_name, status, total_price, product_id, product_name, quantity_kg, price_at_order).
+        date_from is inclusive and date_to exclusive ('YYYY-MM-DD' prefixes of order_date)."""
+    @abstractmethod
+    async def delete_completed_orders(self) -> int:
+        """Number of deleted orders, or -1 on error. Sales rollups are kept."""
+    @abstractmethod
+    async def transition_orders(self, new_status: str, order_ids: list = None, date_from: str = None, date_to: str = None) -> list | None:
+        """Moves the selected orders (by id and/or order_date range, date_to exclusive) to new_status in one UPDATE, skipping
+        those whose status does not allow it (ORDER_STATUS_TRANSITIONS). (order_id, user_id, total_price) of the changed
+        orders, or None on error. ValueError if nothing can move to new_status."""
+
+    async def mark_order_completed(self, order_id: int) -> bool:
+        return bool(await self.transition_orders("completed", order_ids=[order_id]))
+
+    # Shopping list: (product name, total kg) over pending/confirmed orders
+    @abstractmethod
+    async def get_shopping_list(self) -> list: ...
+
+    # Saved carts: carts moved out of memory (idle eviction, shutdown) until the user comes back
+    @abstractmethod
+    async def save_carts(self, carts: list) -> bool:
+        """Stores (user_id, cart) pairs, replacing any cart saved earlier for the same user."""
+    @abstractmethod
+    async def pop_saved_cart(self, user_id: int) -> list | None:
+        """Returns and deletes the user's saved cart, or None if there is none."""
+
+    # Broadcasts: (id, admin_id, message_text, status, cursor_user_id, delivered, blocked, failed)
+    @abstractmethod
+    async def create_broadcast(self, admin_id: int, message_text: str) -> int | None: ...
+    @abstractmethod
+    async def get_broadcast(self, broadcast_id: int): ...
+    @abstractmethod
+    async def get_running_broadcast_ids(self) -> list: ...
+    @abstractmethod
+    async def claim_broadcast(self, broadcast_id: int, lease_seconds: float) -> bool:
+        """True if this process may send the broadcast: it is running and nobody has checkpointed it within lease_seconds."""
+    @abstractmethod
+    async def save_broadcast_progress(self, broadcast_id: int, cursor_user_id: int, delivered: int, blocked: int, failed: int, status: str = "running") -> None:
+        """Checkpoints the cursor and counts and renews the claim."""
+    @abstractmethod
+    def iter_broadcast_recipients(self, after_user_id: int = 0, batch_size: int = 500):
+        """Async generator of (telegram_id, language_code) for users who have not blocked the bot, by id, after after_user_id.
+        Each batch is a separate keyset query, so no connection is held open while messages are being sent."""
+
+    # Sales rollups; date_from is inclusive and date_to exclusive ('YYYY-MM-DD')
+    @abstractmethod
+    async def backfill_daily_sales(self) -> int:
+        """Folds orders placed before the rollups existed into them, once. Number of orders folded in, or -1 on error."""
+    @abstractmethod
+    async def get_daily_sales_totals(self, date_from: str, date_to: str) -> list:
+        """(sale_date, order_count, revenue) per day with orders, oldest first."""
+    @abstractmethod
+    async def get_product_sales(self, date_from: str, date_to: str) -> list:
+        """(product_id, product name or None if deleted, quantity_kg, revenue, order_count) by revenue, highest first."""
+
+
+class SQLiteStorage(Storage):
+    def __init__(self, db_path: str, default_language: str = "lt"):
+        super().__init__()
+        self.db_path = db_path
+        self.default_language = default_language
+        self.report_snapshot_path = os.getenv("REPORT_SNAPSHOT_PATH") or f"{os.path.splitext(db_path)[0]}-report.db"
+        self._report_lock = asyncio.Lock()
+        self._report_snapshot_stale = False
+        self._report_age = None
+
+    def connect(self, path: str = None, read_only: bool = False, **kwargs) -> sqlite3.Connection:
+        # Single place every query opens its connection, so tracing applies to all of them
+        target = path or self.db_path
+        if read_only: target = f"file:{pathname2url(os.path.abspath(target))}?mode=ro"
+        if DB_TRACE_QUERIES:
+            return sqlite3.connect(target, uri=read_only, factory=TracingConnection, **kwargs)
+        return sqlite3.connect(target, uri=read_only, **kwargs)
+
+    async def report_connect(self) -> sqlite3.Connection:
+        # Read-only connection for heavy reports: on the snapshot while it is within the staleness bound (refreshing
+        # it first if not), or on the live file when snapshots are off or the refresh failed. Reports run their
+        # queries in a worker thread, so the connection may be used from one other than the thread opening it.
+        if REPORT_SNAPSHOT_MAX_AGE_SECONDS > 0:
+            async with self._report_lock: # Concurrent reports share one refresh
+                try: age = max(0.0, time.time() - os.path.getmtime(self.report_snapshot_path))
+                except OSError: age = None
+                if age is None or age > REPORT_SNAPSHOT_MAX_AGE_SECONDS or self._report_snapshot_stale:
+                    self._report_snapshot_stale = False
+                    age = 0.0 if await asyncio.to_thread(self._refresh_report_snapshot) else None
+            if age is not None:
+                self._report_age = age
+                return self.connect(self.report_snapshot_path, read_only=True, check_same_thread=False)
+        self._report_age = None
+        return self.connect(read_only=True, check_same_thread=False)
+
+    def report_data_age(self) -> float | None:
+        return self._report_age
+
+    @staticmethod
+    def _fetch_all(conn: sqlite3.Connection, sql: str, params=()) -> list:
+        return conn.execute(sql, params).fetchall()
+
+    def _refresh_report_snapshot(self) -> bool:
+        started_at = time.perf_counter()
+        try: _steps, pages = self._copy_database(self.report_snapshot_path)
+        except (sqlite3.Error, OSError) as e:
+            logger.error("Refreshing the report snapshot %s failed: %s", self.report_snapshot_path, e)
+            return False
+        logger.info("Report snapshot refreshed: %s pages in %.0f ms", pages, (time.perf_counter() - started_at) * 1000)
+        return True
+
+    async def init_schema(self) -> None:
+        conn = self.connect()
+        cursor = conn.cursor()
+        # Only takes effect on a new, empty database; incremental_vacuum() converts existing ones
+        cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        sql_create_users_table = f"""
+        CREATE TABLE IF NOT EXISTS users (
+            telegram_id INTEGER PRIMARY KEY, first_name TEXT, username TEXT,
+            is_admin INTEGER DEFAULT 0, language_code TEXT DEFAULT '{self.default_language}'
+        )"""
+        cursor.execute(sql_create_users_table)
+        cursor.execute("CREATE TABLE IF NOT EXISTS products (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE NOT NULL, price_per_kg REAL NOT NULL, is_available INTEGER DEFAULT 1)")
+        cursor.execute("CREATE TABLE IF NOT EXISTS orders (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, user_name TEXT, order_date TEXT NOT NULL, total_price REAL NOT NULL, status TEXT DEFAULT 'pending', FOREIGN KEY (user_id) REFERENCES users (telegram_id))")
+        cursor.execute("CREATE TABLE IF NOT EXISTS order_items (id INTEGER PRIMARY KEY AUTOINCREMENT, order_id INTEGER NOT NULL, product_id INTEGER NOT NULL, quantity_kg REAL NOT NULL, price_at_order REAL NOT NULL, FOREIGN KEY (order_id) REFERENCES orders (id), FOREIGN KEY (product_id) REFERENCES products (id))")
+        cursor.execute("CREATE TABLE IF NOT EXISTS saved_carts (user_id INTEGER PRIMARY KEY, cart_json TEXT NOT NULL, saved_at TEXT NOT NULL)")
+        cursor.execute("CREATE TABLE IF NOT EXISTS broadcasts (id INTEGER PRIMARY KEY AUTOINCREMENT, admin_id INTEGER NOT NULL, message_text TEXT NOT NULL, status TEXT NOT NULL DEFAULT 'running', cursor_user_id INTEGER NOT NULL DEFAULT 0, delivered INTEGER NOT NULL DEFAULT 0, blocked INTEGER NOT NULL DEFAULT 0, failed INTEGER NOT NULL DEFAULT 0, created_at TEXT NOT NULL, heartbeat_at REAL)")
+        # Columns added after the first release; existing databases get them through ALTER TABLE
+        order_columns = {row[1] for row in cursor.execute("PRAGMA table_info(orders)")}
+        if "idempotency_key" not in order_columns:
+            cursor.execute("ALTER TABLE orders ADD COLUMN idempotency_key TEXT")
+        user_columns = {row[1] for row in cursor.execute("PRAGMA table_info(users)")}
+        if "is_blocked" not in user_columns:
+            cursor.execute("ALTER TABLE users ADD COLUMN is_blocked INTEGER NOT NULL DEFAULT 0")
+        product_columns = {row[1] for row in cursor.execute("PRAGMA table_info(products)")}
+        if "stock_kg" not in product_columns:
+            cursor.execute("ALTER TABLE products ADD COLUMN stock_kg REAL")
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_idempotency_key ON orders (idempotency_key)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_orders_order_date ON orders (order_date)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_orders_user_id ON orders (user_id, id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_order_items_order_id ON order_items (order_id)")
+        if not cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'daily_sales'").fetchone():
+            cursor.execute("CREATE TABLE daily_sales (sale_date TEXT NOT NULL, product_id INTEGER NOT NULL, quantity_kg REAL NOT NULL, revenue REAL NOT NULL, order_count INTEGER NOT NULL, PRIMARY KEY (sale_date, product_id))")
+            cursor.execute("CREATE TABLE daily_order_totals (sale_date TEXT PRIMARY KEY, order_count INTEGER NOT NULL, revenue REAL NOT NULL)")
+            cursor.execute("CREATE TABLE IF NOT EXISTS daily_sales_backfill (max_order_id INTEGER NOT NULL)")
+            cursor.execute("INSERT INTO daily_sales_backfill SELECT COALESCE(MAX(id), 0) FROM orders")
+        conn.commit()
+        conn.close()
+
+    async def get_schema_version(self) -> int:
+        conn = self.connect()
+        try: return conn.execute("PRAGMA user_version").fetchone()[0]
+        finally: conn.close()
+
+    async def set_schema_version(self, version: int) -> None:
+        conn = self.connect()
+        try: conn.execute(f"PRAGMA user_version = {int(version)}")
+        finally: conn.close()
+
+    async def backup(self, backup_dir: str) -> dict | None:
+        return await asyncio.to_thread(self._backup, backup_dir)
+
+    def _copy_database(self, target_path: str) -> tuple[int, int]:
+        # Online copy in steps of DB_BACKUP_PAGES_PER_STEP pages; (steps, pages). Raises sqlite3.Error or OSError
+        steps, total_pages = 0, 0
+        def on_step(_status, _remaining, total):
+            nonlocal steps, total_pages
+            steps += 1; total_pages = total
+        source, target = sqlite3.connect(self.db_path), sqlite3.connect(target_path + ".part")
+        try: source.backup(target, pages=DB_BACKUP_PAGES_PER_STEP, progress=on_step, sleep=DB_BACKUP_STEP_SLEEP_SECONDS)
+        finally: target.close(); source.close()
+        os.replace(target_path + ".part", target_path) # A half-written copy never carries the final name
+        return steps, total_pages
+
+    def _backup(self, backup_dir: str) -> dict | None:
+        prefix = os.path.splitext(os.path.basename(self.db_path))[0] + "-"
+        backup_path = os.path.join(backup_dir, f"{prefix}{datetime.now():%Y%m%d-%H%M%S}.db")
+        try:
+            os.makedirs(backup_dir, exist_ok=True)
+            steps, total_pages = self._copy_database(backup_path)
+            backups = sorted(name for name in os.listdir(backup_dir) if name.startswith(prefix) and name.endswith(".db"))
+            for old_backup in backups[:-DB_BACKUP_KEEP]: os.remove(os.path.join(backup_dir, old_backup))
+        except (sqlite3.Error, OSError) as e:
+            logger.error("DB backup to %s failed: %s", backup_dir, e)
+            return None
+        return {"path": backup_path, "pages": total_pages, "steps": steps}
+
+    async def optimize(self) -> dict | None:
+        return await asyncio.to_thread(self._optimize)
+
+    def _optimize(self) -> dict | None:
+        conn = self.connect()
+        try:
+            page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+            # The first run gathers full statistics; later runs let SQLite re-analyze only what changed enough
+            first_run = not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone()
+            conn.execute("ANALYZE" if first_run else "PRAGMA optimize")
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.error("DB optimize failed: %s", e)
+            return None
+        finally:
+            conn.close()
+        return {"mode": "analyze" if first_run else "optimize", "pages": page_count}
+
+    async def incremental_vacuum(self) -> dict | None:
+        return await asyncio.to_thread(self._incremental_vacuum)
+
+    def _incremental_vacuum(self) -> dict | None:
+        conn = self.connect()
+        conn.isolation_level = None # Autocommit: every step below is its own short write transaction
+        freed_pages = 0
+        try:
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2: # 2 = INCREMENTAL
+                # Never converted here: that takes a full VACUUM, which locks the file while customers are ordering
+                logger.warning("DB incremental vacuum skipped: %s was created without auto_vacuum = INCREMENTAL; "
+                               "convert it once with DB_CONVERT_AUTO_VACUUM=1 at the next restart", self.db_path)
+                return None
+            free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            while free_pages > 0:
+                conn.execute(f"PRAGMA incremental_vacuum({DB_VACUUM_PAGES_PER_STEP})").fetchall() # Runs only as far as it is stepped
+                remaining = conn.execute("PRAGMA freelist_count").fetchone()[0]
+                if remaining >= free_pages: break
+                freed_pages += free_pages - remaining; free_pages = remaining
+                time.sleep(DB_BACKUP_STEP_SLEEP_SECONDS) # Lets waiting writers in between steps
+            page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+        except sqlite3.Error as e:
+            logger.error("DB incremental vacuum failed: %s", e)
+            return None
+        finally:
+            conn.close()
+        return {"pages_freed": freed_pages, "pages": page_count}
+
+    async def convert_auto_vacuum(self) -> dict | None:
+        return await asyncio.to_thread(self._convert_auto_vacuum)
+
+    def _convert_auto_vacuum(self) -> dict | None:
+        # One-off for databases created before auto_vacuum was set: only a full VACUUM can switch the mode, and it holds
+        # an exclusive lock while it rewrites the whole file
+        conn = self.connect()
+        conn.isolation_level = None # VACUUM cannot run inside a transaction
+        try:
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2: return None
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+            page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+        except sqlite3.Error as e:
+            logger.error("DB auto_vacuum conversion failed: %s", e)
+            return None
+        finally:
+            conn.close()
+        return {"converted": True, "pages": page_count}
+
+    async def get_user_language(self, user_id: int) -> str | None:
+        conn = self.connect()
+        cursor = conn.cursor()
+        result = None
+        try:
+            cursor.execute("SELECT language_code FROM users WHERE telegram_id = ?", (user_id,))
+            result = cursor.fetchone()
+        except sqlite3.Error as e:
+            logger.error("DB error in get_user_language for user %s: %s", user_id, e)
+        finally:
+            conn.close()
+        return result[0] if result else None
+
+    async def ensure_user(self, user_id: int, first_name: str, username: str, is_admin: bool, default_language: str) -> str | None:
+        conn = self.connect()
+        cursor = conn.cursor()
+        current_lang = default_language # Default if no record or no lang in record
+        try:
+            cursor.execute("SELECT language_code FROM users WHERE telegram_id = ?", (user_id,))
+            user_record = cursor.fetchone()
+            if user_record and user_record[0]: # If user exists and has a language set
+                current_lang = user_record[0]
+
+            # Insert or update user. If user exists, update names and admin status.
+            # Crucially, preserve existing language_code if it's already set, otherwise use current_lang.
+            cursor.execute("""
+                INSERT INTO users (telegram_id, first_name, username, language_code, is_admin)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(telegram_id) DO UPDATE SET
+                    first_name = excluded.first_name,
+                    username = excluded.username,
+                    is_admin = excluded.is_admin,
+                    language_code = COALESCE(users.language_code, excluded.language_code),
+                    is_blocked = 0
+            """, (user_id, first_name, username, current_lang, 1 if is_admin else 0))
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.error("DB error in ensure_user_exists for user %s: %s", user_id, e)
+            return None
+        finally:
+            conn.close()
+        return current_lang
+
+    async def set_user_language(self, user_id: int, lang_code: str) -> None:
+        conn = self.connect()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("UPDATE users SET language_code = ? WHERE telegram_id = ?", (lang_code, user_id))
+            conn.commit()
+        except sqlite3.Error as e: logger.error("DB error in set_user_language_db for user %s: %s", user_id, e)
+        finally: conn.close()
+
+    async def mark_user_blocked(self, user_id: int) -> None:
+        conn = self.connect()
+        try:
+            conn.execute("UPDATE users SET is_blocked = 1 WHERE telegram_id = ?", (user_id,))
+            conn.commit()
+        except sqlite3.Error as e: logger.error("DB error marking user %s as blocked: %s", user_id, e)
+        finally: conn.close()
+
+    async def add_product(self, name: str, price: float) -> bool:
+        conn = self.connect()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("INSERT INTO products (name, price_per_kg) VALUES (?, ?)", (name, price))
+            conn.commit()
+        except sqlite3.IntegrityError:
+            logger.warning("Attempted to add duplicate product name: %s", name)
+            return False
+        except sqlite3.Error as e:
+            logger.error("DB error adding product %s: %s", name, e)
+            return False
+        finally:
+            conn.close()
+        await self._catalog_changed()
+        return True
+
+    async def get_products(self, available_only: bool = True) -> list:
+        conn = self.connect()
+        cursor = conn.cursor()
+        products = []
+        try:
+            query = "SELECT id, name, price_per_kg, is_available, stock_kg FROM products"
+            if available_only:
+                query += " WHERE is_available = 1"
+            query += " ORDER BY name"
+            cursor.execute(query)
+            products = cursor.fetchall()
+        except sqlite3.Error as e:
+            logger.error("DB error getting products: %s", e)
+        finally:
+            conn.close()
+        return products
+
+    async def get_product(self, product_id: int):
+        conn = self.connect()
+        cursor = conn.cursor()
+        product = None
+        try:
+            cursor.execute("SELECT id, name, price_per_kg, is_available, stock_kg FROM products WHERE id = ?", (product_id,))
+            product = cursor.fetchone()
+        except sqlite3.Error as e:
+            logger.error("DB error getting product by ID %s: %s", product_id, e)
+        finally:
+            conn.close()
+        return product
+
+    async def update_product(self, product_id: int, name: str = None, price: float = None, is_available: int = None) -> bool:
+        fields, params = [], []
+        if name is not None: fields.append("name = ?"); params.append(name)
+        if price is not None: fields.append("price_per_kg = ?"); params.append(price)
+        if is_available is not None: fields.append("is_available = ?"); params.append(is_available)
+        if not fields: return False
+
+        conn = self.connect()
+        cursor = conn.cursor()
+        success = False
+        params.append(product_id)
+        query = f"UPDATE products SET {', '.join(fields)} WHERE id = ?"
+        try:
+            cursor.execute(query, tuple(params))
+            conn.commit()
+            if cursor.rowcount > 0: # Check if any row was actually updated
+                success = True
+        except sqlite3.Error as e:
+            logger.error("DB error updating product %s: %s", product_id, e)
+        finally:
+            conn.close()
+        if success: await self._catalog_changed()
+        return success
+
+    async def set_product_stock(self, product_id: int, stock_kg: float | None) -> bool:
+        conn = self.connect()
+        success = False
+        try:
+            success = conn.execute("UPDATE products SET stock_kg = ? WHERE id = ?", (stock_kg, product_id)).rowcount > 0
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.error("DB error setting stock of product %s: %s", product_id, e)
+        finally:
+            conn.close()
+        if success: await self._catalog_changed()
+        return success
+
+    async def delete_product(self, product_id: int) -> bool:
+        conn = self.connect()
+        cursor = conn.cursor()
+        success = False
+        try:
+            cursor.execute("DELETE FROM products WHERE id = ?", (product_id,))
+            conn.commit()
+            if cursor.rowcount > 0:
+                success = True
+        except sqlite3.Error as e:
+            logger.error("DB error deleting product %s: %s", product_id, e)
+        finally:
+            conn.close()
+        if success: await self._catalog_changed()
+        return success
+
+    async def iter_products(self, batch_size: int = 500):
+        conn = self.connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id, name, price_per_kg, is_available, stock_kg FROM products ORDER BY name")
+            while rows := cursor.fetchmany(batch_size):
+                for row in rows: yield row
+        except sqlite3.Error as e:
+            logger.error("DB error iterating products: %s", e)
+        finally:
+            conn.close()
+
+    async def apply_catalog_changes(self, inserts: list, price_updates: list, availability_updates: list) -> bool:
+        conn = self.connect()
+        cursor = conn.cursor()
+        try:
+            conn.execute("BEGIN TRANSACTION")
+            cursor.executemany("INSERT INTO products (name, price_per_kg, is_available) VALUES (?, ?, ?)", inserts)
+            cursor.executemany("UPDATE products SET price_per_kg = ? WHERE id = ?", price_updates)
+            cursor.executemany("UPDATE products SET is_available = ? WHERE id = ?", availability_updates)
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.error("DB error applying catalog changes: %s", e)
+            conn.rollback()
+            return False
+        finally:
+            conn.close()
+        await self._catalog_changed()
+        return True
+
+    async def save_order(self, user_id: int, user_name: str, cart: list, total_price: float, idempotency_key: str = None) -> tuple[int | None, bool]:
+        conn = self.connect()
+        cursor = conn.cursor()
+        order_id, created = None, False
+        order_date = _now_str()
+        try:
+            conn.execute("BEGIN TRANSACTION")
+            # The unique index on idempotency_key turns a concurrent duplicate into a no-op insert
+            cursor.execute("INSERT INTO orders (user_id, user_name, order_date, total_price, status, idempotency_key) VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (idempotency_key) DO NOTHING",
+                           (user_id, user_name, order_date, total_price, 'pending', idempotency_key))
+            if cursor.rowcount == 0:
+                conn.rollback()
+                cursor.execute("SELECT id FROM orders WHERE idempotency_key = ?", (idempotency_key,))
+                row = cursor.fetchone()
+                return (row[0] if row else None), False
+            order_id = cursor.lastrowid
+            stock_levels, short_product_ids = {}, []
+            for product_id, quantity in _cart_quantities(cart).items():
+                row = cursor.execute(_STOCK_RESERVE.format(quantity="?", product_id="?"), (quantity, product_id, quantity)).fetchone()
+                if row is None: short_product_ids.append(product_id)
+                elif row[0] is not None: stock_levels[product_id] = row[0]
+            if short_product_ids:
+                conn.rollback()
+                raise InsufficientStock(short_product_ids)
+            cursor.executemany("INSERT INTO order_items (order_id, product_id, quantity_kg, price_at_order) VALUES (?, ?, ?, ?)",
+                               [(order_id, item['id'], item['quantity'], item['price']) for item in cart])
+            cursor.executemany(_SALES_UPSERT.format(source="VALUES (?, ?, ?, ?, 1)"), _sales_rollup_rows(order_date[:10], cart))
+            cursor.execute(_ORDER_TOTALS_UPSERT.format(source="VALUES (?, 1, ?)"), (order_date[:10], total_price))
+            conn.commit()
+            created = True
+        except sqlite3.Error as e:
+            logger.error("Error saving order for user %s: %s", user_id, e)
+            if conn: conn.rollback()
+            order_id = None
+        finally:
+            if conn: conn.close()
+        if created: await self._stock_changed(stock_levels)
+        return order_id, created
+
+    async def get_order_id_by_idempotency_key(self, idempotency_key: str) -> int | None:
+        conn = self.connect()
+        row = None
+        try:
+            row = conn.execute("SELECT id FROM orders WHERE idempotency_key = ?", (idempotency_key,)).fetchone()
+        except sqlite3.Error as e:
+            logger.error("DB error looking up order by idempotency key: %s", e)
+        finally:
+            conn.close()
+        return row[0] if row else None
+
+    async def get_user_orders(self, user_id: int) -> list:
+        conn = self.connect()
+        cursor = conn.cursor()
+        orders = []
+        try:
+            # Using CHAR(10) for newline in group_concat for better readability if needed directly
+            cursor.execute("SELECT o.id, o.order_date, o.total_price, o.status, group_concat(p.name || ' (' || oi.quantity_kg || 'kg)', CHAR(10)) FROM orders o JOIN order_items oi ON o.id = oi.order_id JOIN products p ON oi.product_id = p.id WHERE o.user_id = ? GROUP BY o.id ORDER BY o.order_date DESC", (user_id,))
+            orders = cursor.fetchall()
+        except sqlite3.Error as e:
+            logger.error("DB error getting orders for user %s: %s", user_id, e)
+        finally:
+            conn.close()
+        return orders
+
+    async def get_last_order_items(self, user_id: int) -> list:
+        conn = self.connect()
+        items = []
+        try:
+            items = conn.execute(_LAST_ORDER_ITEMS_QUERY.format(user_id="?"), (user_id,)).fetchall()
+        except sqlite3.Error as e:
+            logger.error("DB error getting the last order of user %s: %s", user_id, e)
+        finally:
+            conn.close()
+        return items
+
+    async def get_all_orders(self) -> list:
+        conn = await self.report_connect()
+        orders = []
+        try:
+            # The full-history aggregation runs in a worker thread so checkouts in this process are not stalled
+            orders = await asyncio.to_thread(self._fetch_all, conn, "SELECT o.id, o.user_id, o.user_name, o.order_date, o.total_price, o.status, GROUP_CONCAT(p.name || ' (' || oi.quantity_kg || 'kg @ ' || oi.price_at_order || ' EUR)', CHAR(10)) as items_details FROM orders o JOIN order_items oi ON o.id = oi.order_id JOIN products p ON oi.product_id = p.id GROUP BY o.id ORDER BY o.order_date DESC")
+        except sqlite3.Error as e:
+            logger.error("DB error getting all orders: %s", e)
+        finally:
+            conn.close()
+        return orders
+
+    async def get_shopping_list(self) -> list:
+        conn = await self.report_connect()
+        shopping_list = []
+        try:
+            shopping_list = await asyncio.to_thread(self._fetch_all, conn, "SELECT p.name, SUM(oi.quantity_kg) as total_quantity FROM order_items oi JOIN products p ON oi.product_id = p.id JOIN orders o ON oi.order_id = o.id WHERE o.status IN ('pending','confirmed') GROUP BY p.name ORDER BY p.name")
+        except sqlite3.Error as e:
+            logger.error("DB error getting shopping list: %s", e)
+        finally:
+            conn.close()
+        return shopping_list
+
+    async def iter_order_rows(self, date_from: str = None, date_to: str = None, status: str = None, batch_size: int = 1000):
+        where, params = _order_export_filters(date_from, date_to, status, "?")
+        conn = self.connect(check_same_thread=False) # Used by one worker thread at a time, never concurrently
+        try:
+            # The query and every batch run in a worker thread: a full-history export must not stall the event loop
+            cursor = await asyncio.to_thread(conn.execute, _ORDER_EXPORT_QUERY.format(where=where), params)
+            while rows := await asyncio.to_thread(cursor.fetchmany, batch_size):
+                for row in rows: yield row
+        except sqlite3.Error as e:
+            logger.error("DB error exporting orders: %s", e)
+        finally:
+            conn.close()
+
+    async def save_carts(self, carts: list) -> bool:
+        conn = self.connect()
+        saved_at = _now_str()
+        try:
+            conn.executemany("INSERT INTO saved_carts (user_id, cart_json, saved_at) VALUES (?, ?, ?) ON CONFLICT (user_id) DO UPDATE SET cart_json = excluded.cart_json, saved_at = excluded.saved_at",
+                             [(user_id, json.dumps(cart), saved_at) for user_id, cart in carts])
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.error("DB error saving %s carts: %s", len(carts), e)
+            return False
+        finally:
+            conn.close()
+        return True
+
+    async def pop_saved_cart(self, user_id: int) -> list | None:
+        conn = self.connect()
+        row = None
+        try:
+            row = conn.execute("DELETE FROM saved_carts WHERE user_id = ? RETURNING cart_json", (user_id,)).fetchone()
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.error("DB error restoring saved cart for user %s: %s", user_id, e)
+        finally:
+            conn.close()
+        return json.loads(row[0]) if row else None
+
+    async def create_broadcast(self, admin_id: int, message_text: str) -> int | None:
+        conn = self.connect()
+        broadcast_id = None
+        try:
+            cursor = conn.execute("INSERT INTO broadcasts (admin_id, message_text, created_at) VALUES (?, ?, ?)", (admin_id, message_text, _now_str()))
+            conn.commit()
+            broadcast_id = cursor.lastrowid
+        except sqlite3.Error as e:
+            logger.error("DB error creating broadcast: %s", e)
+        finally:
+            conn.close()
+        return broadcast_id
+
+    async def get_broadcast(self, broadcast_id: int):
+        conn = self.connect()
+        row = None
+        try:
+            row = conn.execute("SELECT id, admin_id, message_text, status, cursor_user_id, delivered, blocked, failed FROM broadcasts WHERE id = ?", (broadcast_id,)).fetchone()
+        except sqlite3.Error as e:
+            logger.error("DB error getting broadcast %s: %s", broadcast_id, e)
+        finally:
+            conn.close()
+        return row
+
+    async def get_running_broadcast_ids(self) -> list:
+        conn = self.connect()
+        ids = []
+        try:
+            ids = [row[0] for row in conn.execute("SELECT id FROM broadcasts WHERE status = 'running' ORDER BY id")]
+        except sqlite3.Error as e:
+            logger.error("DB error listing running broadcasts: %s", e)
+        finally:
+            conn.close()
+        return ids
+
+    async def claim_broadcast(self, broadcast_id: int, lease_seconds: float) -> bool:
+        conn = self.connect()
+        claimed = False
+        now = time.time()
+        try:
+            cursor = conn.execute("UPDATE broadcasts SET heartbeat_at = ? WHERE id = ? AND status = 'running' AND (heartbeat_at IS NULL OR heartbeat_at < ?)",
+                                  (now, broadcast_id, now - lease_seconds))
+            conn.commit()
+            claimed = cursor.rowcount > 0
+        except sqlite3.Error as e:
+            logger.error("DB error claiming broadcast %s: %s", broadcast_id, e)
+        finally:
+            conn.close()
+        return claimed
+
+    async def save_broadcast_progress(self, broadcast_id: int, cursor_user_id: int, delivered: int, blocked: int, failed: int, status: str = "running") -> None:
+        conn = self.connect()
+        try:
+            conn.execute("UPDATE broadcasts SET cursor_user_id = ?, delivered = ?, blocked = ?, failed = ?, status = ?, heartbeat_at = ? WHERE id = ?",
+                         (cursor_user_id, delivered, blocked, failed, status, time.time(), broadcast_id))
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.error("DB error saving broadcast %s progress: %s", broadcast_id, e)
+        finally:
+            conn.close()
+
+    async def iter_broadcast_recipients(self, after_user_id: int = 0, batch_size: int = 500):
+        while True:
+            conn = self.connect()
+            try:
+                rows = conn.execute("SELECT telegram_id, language_code FROM users WHERE telegram_id > ? AND is_blocked = 0 ORDER BY telegram_id LIMIT ?", (after_user_id, batch_size)).fetchall()
+            except sqlite3.Error as e:
+                logger.error("DB error reading broadcast recipients: %s", e)
+                return
+            finally:
+                conn.close()
+            for row in rows: yield row
+            if len(rows) < batch_size: return
+            after_user_id = rows[-1][0]
+
+    async def backfill_daily_sales(self) -> int:
+        conn = self.connect()
+        folded = 0
+        try:
+            conn.execute("BEGIN IMMEDIATE") # Takes the write lock first, so concurrent workers cannot both backfill
+            row = conn.execute("SELECT max_order_id FROM daily_sales_backfill").fetchone()
+            if row:
+                max_id = int(row[0])
+                folded = conn.execute("SELECT COUNT(*) FROM orders WHERE id <= ?", (max_id,)).fetchone()[0]
+                for statement in _backfill_rollup_statements(max_id): conn.execute(statement)
+                conn.execute("DELETE FROM daily_sales_backfill")
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.error("DB error backfilling daily sales: %s", e)
+            conn.rollback()
+            folded = -1
+        finally:
+            conn.close()
+        return folded
+
+    async def get_daily_sales_totals(self, date_from: str, date_to: str) -> list:
+        conn = self.connect()
+        rows = []
+        try:
+            rows = conn.execute("SELECT sale_date, order_count, revenue FROM daily_order_totals WHERE sale_date >= ? AND sale_date < ? AND order_count > 0 ORDER BY sale_date", (date_from, date_to)).fetchall()
+        except sqlite3.Error as e:
+            logger.error("DB error getting daily sales totals: %s", e)
+        finally:
+            conn.close()
+        return rows
+
+    async def get_product_sales(self, date_from: str, date_to: str) -> list:
+        conn = self.connect()
+        rows = []
+        try:
+            rows = conn.execute("SELECT ds.product_id, p.name, SUM(ds.quantity_kg), SUM(ds.revenue), SUM(ds.order_count) FROM daily_sales ds LEFT JOIN products p ON p.id = ds.product_id "
+                                "WHERE ds.sale_date >= ? AND ds.sale_date < ? GROUP BY ds.product_id, p.name HAVING SUM(ds.order_count) > 0 ORDER BY SUM(ds.revenue) DESC", (date_from, date_to)).fetchall()
+        except sqlite3.Error as e:
+            logger.error("DB error getting product sales: %s", e)
+        finally:
+            conn.close()
+        return rows
+
+    async def delete_completed_orders(self) -> int:
+        conn = self.connect(); cursor = conn.cursor(); deleted_count = 0
+        try:
+            cursor.execute("SELECT id FROM orders WHERE status = ?", ('completed',))
+            completed_order_ids = [row[0] for row in cursor.fetchall()]
+            if not completed_order_ids: conn.close(); return 0
+
+            conn.execute("BEGIN TRANSACTION")
+            for order_id_val in completed_order_ids:
+                cursor.execute("DELETE FROM order_items WHERE order_id = ?", (order_id_val,))
+                # Make sure to delete from orders table as well
+                cursor.execute("DELETE FROM orders WHERE id = ? AND status = ?", (order_id_val, 'completed'))
+                deleted_count += cursor.rowcount # counts rows deleted from 'orders' table
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.error("DB error deleting completed orders: %s", e)
+            if conn: conn.rollback()
+            deleted_count = -1 # Indicate error
+        finally:
+            if conn: conn.close()
+        if deleted_count > 0: self._report_snapshot_stale = True # The admin expects the next report to reflect it
+        return deleted_count
+
+    async def transition_orders(self, new_status: str, order_ids: list = None, date_from: str = None, date_to: str = None) -> list | None:
+        query, params = _order_transition_query(new_status, order_ids, date_from, date_to, "?")
+        conn = self.connect()
+        changed = None
+        try:
+            conn.execute("BEGIN TRANSACTION")
+            changed = conn.execute(query, params).fetchall()
+            if changed and new_status == "cancelled":
+                for statement in _cancelled_rollup_statements([row[0] for row in changed]): conn.execute(statement)
+                conn.execute(_restock_statement([row[0] for row in changed]))
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.error("DB error moving orders to %s: %s", new_status, e)
+            conn.rollback()
+            changed = None
+        finally:
+            conn.close()
+        if changed: self._report_snapshot_stale = True
+        if changed and new_status == "cancelled": await self._catalog_changed()
+        return changed
+
+
+# --- PostgreSQL Backend ---
+PG_POOL_MIN_SIZE = int(os.getenv("PG_POOL_MIN_SIZE", "1"))
+PG_POOL_MAX_SIZE = int(os.getenv("PG_POOL_MAX_SIZE", "10"))
+
+def _rowcount(status: str) -> int:
+    # asyncpg returns the command tag, e.g. 'UPDATE 3' or 'INSERT 0 1'
+    try: return int(status.rsplit(" ", 1)[-1])
+    except (ValueError, AttributeError): return 0
+
+class PostgresStorage(Storage):
+    def __init__(self, dsn: str, default_language: str = "lt"):
+        super().__init__()
+        self.dsn = dsn
+        self.default_language = default_language
+        self.pool = None
+
+    async def open(self, init_schema: bool = True) -> None:
+        import asyncpg # Optional dependency, only needed when DATABASE_URL points at PostgreSQL
+        self._errors = asyncpg.PostgresError
+        self._unique_violation = asyncpg.UniqueViolationError
+        self.pool = await asyncpg.create_pool(self.dsn, min_size=PG_POOL_MIN_SIZE, max_size=PG_POOL_MAX_SIZE)
+        await super().open(init_schema)
+
+    async def close(self) -> None:
+        if self.pool: await self.pool.close(); self.pool = None
+
+    async def init_schema(self) -> None:
+        # order_date stays TEXT ('YYYY-MM-DD HH:MM:SS') so both backends sort and display it identically.
+        # Like the SQLite schema (which does not enforce foreign keys), orders may reference users/products
+        # that were never registered or were deleted later.
+        async with self.pool.acquire() as conn:
+            await conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS users (
+                    telegram_id BIGINT PRIMARY KEY, first_name TEXT, username TEXT,
+                    is_admin INTEGER DEFAULT 0, language_code TEXT DEFAULT '{self.default_language}'
+                );
+                CREATE TABLE IF NOT EXISTS products (id BIGSERIAL PRIMARY KEY, name TEXT UNIQUE NOT NULL, price_per_kg DOUBLE PRECISION NOT NULL, is_available INTEGER DEFAULT 1);
+                CREATE TABLE IF NOT EXISTS orders (id BIGSERIAL PRIMARY KEY, user_id BIGINT NOT NULL, user_name TEXT, order_date TEXT NOT NULL, total_price DOUBLE PRECISION NOT NULL, status TEXT DEFAULT 'pending');
+                CREATE TABLE IF NOT EXISTS order_items (id BIGSERIAL PRIMARY KEY, order_id BIGINT NOT NULL REFERENCES orders (id), product_id BIGINT NOT NULL, quantity_kg DOUBLE PRECISION NOT NULL, price_at_order DOUBLE PRECISION NOT NULL);
+                ALTER TABLE orders ADD COLUMN IF NOT EXISTS idempotency_key TEXT;
+                ALTER TABLE users ADD COLUMN IF NOT EXISTS is_blocked INTEGER NOT NULL DEFAULT 0;
+                ALTER TABLE products ADD COLUMN IF NOT EXISTS stock_kg DOUBLE PRECISION;
+                CREATE TABLE IF NOT EXISTS saved_carts (user_id BIGINT PRIMARY KEY, cart_json TEXT NOT NULL, saved_at TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS broadcasts (id BIGSERIAL PRIMARY KEY, admin_id BIGINT NOT NULL, message_text TEXT NOT NULL, status TEXT NOT NULL DEFAULT 'running', cursor_user_id BIGINT NOT NULL DEFAULT 0, delivered INTEGER NOT NULL DEFAULT 0, blocked INTEGER NOT NULL DEFAULT 0, failed INTEGER NOT NULL DEFAULT 0, created_at TEXT NOT NULL, heartbeat_at DOUBLE PRECISION);
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_idempotency_key ON orders (idempotency_key);
+                CREATE INDEX IF NOT EXISTS idx_orders_order_date ON orders (order_date);
+                CREATE INDEX IF NOT EXISTS idx_orders_user_id ON orders (user_id, id);
+                CREATE INDEX IF NOT EXISTS idx_order_items_order_id ON order_items (order_id);
+            """)
+            async with conn.transaction():
+                if await conn.fetchval("SELECT to_regclass('daily_sales')") is None:
+                    await conn.execute("""
+                        CREATE TABLE daily_sales (sale_date TEXT NOT NULL, product_id BIGINT NOT NULL, quantity_kg DOUBLE PRECISION NOT NULL, revenue DOUBLE PRECISION NOT NULL, order_count INTEGER NOT NULL, PRIMARY KEY (sale_date, product_id));
+                        CREATE TABLE daily_order_totals (sale_date TEXT PRIMARY KEY, order_count INTEGER NOT NULL, revenue DOUBLE PRECISION NOT NULL);
+                        CREATE TABLE IF NOT EXISTS daily_sales_backfill (max_order_id BIGINT NOT NULL);
+                        INSERT INTO daily_sales_backfill SELECT COALESCE(MAX(id), 0) FROM orders;
+                    """)
+
+    async def get_schema_version(self) -> int:
+        async with self.pool.acquire() as conn:
+            if await conn.fetchval("SELECT to_regclass('schema_version')") is None: return 0
+            return await conn.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+
+    async def set_schema_version(self, version: int) -> None:
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+                await conn.execute("DELETE FROM schema_version")
+                await conn.execute("INSERT INTO schema_version (version) VALUES ($1)", version)
+
+    async def get_user_language(self, user_id: int) -> str | None:
+        try:
+            return await self.pool.fetchval("SELECT language_code FROM users WHERE telegram_id = $1", user_id)
+        except self._errors as e:
+            logger.error("DB error in get_user_language for user %s: %s", user_id, e)
+            return None
+
+    async def ensure_user(self, user_id: int, first_name: str, username: str, is_admin: bool, default_language: str) -> str | None:
+        try:
+            # COALESCE keeps an existing language; RETURNING hands back whichever language is now stored
+            stored_lang = await self.pool.fetchval("""
+                INSERT INTO users (telegram_id, first_name, username, language_code, is_admin)
+                VALUES ($1, $2, $3, $4, $5)
+                ON CONFLICT (telegram_id) DO UPDATE SET
+                    first_name = excluded.first_name,
+                    username = excluded.username,
+                    is_admin = excluded.is_admin,
+                    language_code = COALESCE(users.language_code, excluded.language_code),
+                    is_blocked = 0
+                RETURNING language_code
+            """, user_id, first_name, username, default_language, 1 if is_admin else 0)
+            return stored_lang or default_language
+        except self._errors as e:
+            logger.error("DB error in ensure_user_exists for user %s: %s", user_id, e)
+            return None
+
+    async def set_user_language(self, user_id: int, lang_code: str) -> None:
+        try: await self.pool.execute("UPDATE users SET language_code = $1 WHERE telegram_id = $2", lang_code, user_id)
+        except self._errors as e: logger.error("DB error in set_user_language_db for user %s: %s", user_id, e)
+
+    async def mark_user_blocked(self, user_id: int) -> None:
+        try: await self.pool.execute("UPDATE users SET is_blocked = 1 WHERE telegram_id = $1", user_id)
+        except self._errors as e: logger.error("DB error marking user %s as blocked: %s", user_id, e)
+
+    async def add_product(self, name: str, price: float) -> bool:
+        try:
+            await self.pool.execute("INSERT INTO products (name, price_per_kg) VALUES ($1, $2)", name, price)
+        except self._unique_violation:
+            logger.warning("Attempted to add duplicate product name: %s", name)
+            return False
+        except self._errors as e:
+            logger.error("DB error adding product %s: %s", name, e)
+            return False
+        await self._catalog_changed()
+        return True
+
+    async def get_products(self, available_only: bool = True) -> list:
+        query = "SELECT id, name, price_per_kg, is_available, stock_kg FROM products"
+        if available_only:
+            query += " WHERE is_available = 1"
+        query += " ORDER BY name"
+        try:
+            return [tuple(row) for row in await self.pool.fetch(query)]
+        except self._errors as e:
+            logger.error("DB error getting products: %s", e)
+            return []
+
+    async def get_product(self, product_id: int):
+        try:
+            row = await self.pool.fetchrow("SELECT id, name, price_per_kg, is_available, stock_kg FROM products WHERE id = $1", product_id)
+            return tuple(row) if row else None
+        except self._errors as e:
+            logger.error("DB error getting product by ID %s: %s", product_id, e)
+            return None
+
+    async def update_product(self, product_id: int, name: str = None, price: float = None, is_available: int = None) -> bool:
+        fields, params = [], []
+        for column, value in (("name", name), ("price_per_kg", price), ("is_available", is_available)):
+            if value is not None:
+                params.append(value)
+                fields.append(f"{column} = ${len(params)}")
+        if not fields: return False
+        params.append(product_id)
+        try:
+            status = await self.pool.execute(f"UPDATE products SET {', '.join(fields)} WHERE id = ${len(params)}", *params)
+        except self._errors as e:
+            logger.error("DB error updating product %s: %s", product_id, e)
+            return False
+        if _rowcount(status) == 0: return False
+        await self._catalog_changed()
+        return True
+
+    async def set_product_stock(self, product_id: int, stock_kg: float | None) -> bool:
+        try:
+            status = await self.pool.execute("UPDATE products SET stock_kg = $1 WHERE id = $2", stock_kg, product_id)
+        except self._errors as e:
+            logger.error("DB error setting stock of product %s: %s", product_id, e)
+            return False
+        if _rowcount(status) == 0: return False
+        await self._catalog_changed()
+        return True
+
+    async def delete_product(self, product_id: int) -> bool:
+        try:
+            status = await self.pool.execute("DELETE FROM products WHERE id = $1", product_id)
+        except self._errors as e:
+            logger.error("DB error deleting product %s: %s", product_id, e)
+            return False
+        if _rowcount(status) == 0: return False
+        await self._catalog_changed()
+        return True
+
+    async def iter_products(self, batch_size: int = 500):
+        try:
+            async with self.pool.acquire() as conn, conn.transaction(): # Server-side cursors need a transaction
+                async for row in conn.cursor("SELECT id, name, price_per_kg, is_available, stock_kg FROM products ORDER BY name", prefetch=batch_size):
+                    yield tuple(row)
+        except self._errors as e:
+            logger.error("DB error iterating products: %s", e)
+
+    async def apply_catalog_changes(self, inserts: list, price_updates: list, availability_updates: list) -> bool:
+        try:
+            async with self.pool.acquire() as conn, conn.transaction():
+                await conn.executemany("INSERT INTO products (name, price_per_kg, is_available) VALUES ($1, $2, $3)", inserts)
+                await conn.executemany("UPDATE products SET price_per_kg = $1 WHERE id = $2", price_updates)
+                await conn.executemany("UPDATE products SET is_available = $1 WHERE id = $2", availability_updates)
+        except self._errors as e:
+            logger.error("DB error applying catalog changes: %s", e)
+            return False
+        await self._catalog_changed()
+        return True
+
+    async def save_order(self, user_id: int, user_name: str, cart: list, total_price: float, idempotency_key: str = None) -> tuple[int | None, bool]:
+        try:
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    order_date = _now_str()
+                    order_id = await conn.fetchval("INSERT INTO orders (user_id, user_name, order_date, total_price, status, idempotency_key) VALUES ($1, $2, $3, $4, $5, $6) ON CONFLICT (idempotency_key) DO NOTHING RETURNING id",
+                                                   user_id, user_name, order_date, total_price, 'pending', idempotency_key)
+                    if order_id is not None:
+                        stock_levels, short_product_ids = {}, []
+                        for product_id, quantity in _cart_quantities(cart).items():
+                            row = await conn.fetchrow(_STOCK_RESERVE.format(quantity="$1", product_id="$2"), quantity, product_id)
+                            if row is None: short_product_ids.append(product_id)
+                            elif row[0] is not None: stock_levels[product_id] = row[0]
+                        if short_product_ids: raise InsufficientStock(short_product_ids) # Leaving the block rolls everything back
+                        await conn.executemany("INSERT INTO order_items (order_id, product_id, quantity_kg, price_at_order) VALUES ($1, $2, $3, $4)",
+                                               [(order_id, item['id'], item['quantity'], item['price']) for item in cart])
+                        await conn.executemany(_SALES_UPSERT.format(source="VALUES ($1, $2, $3, $4, 1)"), _sales_rollup_rows(order_date[:10], cart))
+                        await conn.execute(_ORDER_TOTALS_UPSERT.format(source="VALUES ($1, 1, $2)"), order_date[:10], total_price)
+                if order_id is None:
+                    return await conn.fetchval("SELECT id FROM orders WHERE idempotency_key = $1", idempotency_key), False
+        except self._errors as e:
+            logger.error("Error saving order for user %s: %s", user_id, e)
+            return None, False
+        await self._stock_changed(stock_levels)
+        return order_id, True
+
+    async def get_order_id_by_idempotency_key(self, idempotency_key: str) -> int | None:
+        try:
+            return await self.pool.fetchval("SELECT id FROM orders WHERE idempotency_key = $1", idempotency_key)
+        except self._errors as e:
+            logger.error("DB error looking up order by idempotency key: %s", e)
+            return None
+
+    async def get_user_orders(self, user_id: int) -> list:
+        try:
+            rows = await self.pool.fetch("SELECT o.id, o.order_date, o.total_price, o.status, string_agg(p.name || ' (' || oi.quantity_kg || 'kg)', E'\\n') FROM orders o JOIN order_items oi ON o.id = oi.order_id JOIN products p ON oi.product_id = p.id WHERE o.user_id = $1 GROUP BY o.id ORDER BY o.order_date DESC", user_id)
+            return [tuple(row) for row in rows]
+        except self._errors as e:
+            logger.error("DB error getting orders for user %s: %s", user_id, e)
+            return []
+
+    async def get_last_order_items(self, user_id: int) -> list:
+        try:
+            return [tuple(row) for row in await self.pool.fetch(_LAST_ORDER_ITEMS_QUERY.format(user_id="$1"), user_id)]
+        except self._errors as e:
+            logger.error("DB error getting the last order of user %s: %s", user_id, e)
+            return []
+
+    async def get_all_orders(self) -> list:
+        try:
+            rows = await self.pool.fetch("SELECT o.id, o.user_id, o.user_name, o.order_date, o.total_price, o.status, string_agg(p.name || ' (' || oi.quantity_kg || 'kg @ ' || oi.price_at_order || ' EUR)', E'\\n') AS items_details FROM orders o JOIN order_items oi ON o.id = oi.order_id JOIN products p ON oi.product_id = p.id GROUP BY o.id ORDER BY o.order_date DESC")
+            return [tuple(row) for row in rows]
+        except self._errors as e:
+            logger.error("DB error getting all orders: %s", e)
+            return []
+
+    async def get_shopping_list(self) -> list:
+        try:
+            rows = await self.pool.fetch("SELECT p.name, SUM(oi.quantity_kg) AS total_quantity FROM order_items oi JOIN products p ON oi.product_id = p.id JOIN orders o ON oi.order_id = o.id WHERE o.status IN ('pending','confirmed') GROUP BY p.name ORDER BY p.name")
+            return [tuple(row) for row in rows]
+        except self._errors as e:
+            logger.error("DB error getting shopping list: %s", e)
+            return []
+
+    async def iter_order_rows(self, date_from: str = None, date_to: str = None, status: str = None, batch_size: int = 1000):
+        where, params = _order_export_filters(date_from, date_to, status, "$")
+        try:
+            async with self.pool.acquire() as conn, conn.transaction(): # Server-side cursors need a transaction
+                async for row in conn.cursor(_ORDER_EXPORT_QUERY.format(where=where), *params, prefetch=batch_size):
+                    yield tuple(row)
+        except self._errors as e:
+            logger.error("DB error exporting orders: %s", e)
+
+    async def save_carts(self, carts: list) -> bool:
+        try:
+            await self.pool.executemany("INSERT INTO saved_carts (user_id, cart_json, saved_at) VALUES ($1, $2, $3) ON CONFLICT (user_id) DO UPDATE SET cart_json = excluded.cart_json, saved_at = excluded.saved_at",
+                                        [(user_id, json.dumps(cart), _now_str()) for user_id, cart in carts])
+            return True
+        except self._errors as e:
+            logger.error("DB error saving %s carts: %s", len(carts), e)
+            return False
+
+    async def pop_saved_cart(self, user_id: int) -> list | None:
+        try:
+            cart_json = await self.pool.fetchval("DELETE FROM saved_carts WHERE user_id = $1 RETURNING cart_json", user_id)
+        except self._errors as e:
+            logger.error("DB error restoring saved cart for user %s: %s", user_id, e)
+            return None
+        return json.loads(cart_json) if cart_json else None
+
+    async def create_broadcast(self, admin_id: int, message_text: str) -> int | None:
+        try:
+            return await self.pool.fetchval("INSERT INTO broadcasts (admin_id, message_text, created_at) VALUES ($1, $2, $3) RETURNING id", admin_id, message_text, _now_str())
+        except self._errors as e:
+            logger.error("DB error creating broadcast: %s", e)
+            return None
+
+    async def get_broadcast(self, broadcast_id: int):
+        try:
+            row = await self.pool.fetchrow("SELECT id, admin_id, message_text, status, cursor_user_id, delivered, blocked, failed FROM broadcasts WHERE id = $1", broadcast_id)
+            return tuple(row) if row else None
+        except self._errors as e:
+            logger.error("DB error getting broadcast %s: %s", broadcast_id, e)
+            return None
+
+    async def get_running_broadcast_ids(self) -> list:
+        try:
+            return [row[0] for row in await self.pool.fetch("SELECT id FROM broadcasts WHERE status = 'running' ORDER BY id")]
+        except self._errors as e:
+            logger.error("DB error listing running broadcasts: %s", e)
+            return []
+
+    async def claim_broadcast(self, broadcast_id: int, lease_seconds: float) -> bool:
+        now = time.time()
+        try:
+            status = await self.pool.execute("UPDATE broadcasts SET heartbeat_at = $1 WHERE id = $2 AND status = 'running' AND (heartbeat_at IS NULL OR heartbeat_at < $3)",
+                                             now, broadcast_id, now - lease_seconds)
+            return _rowcount(status) > 0
+        except self._errors as e:
+            logger.error("DB error claiming broadcast %s: %s", broadcast_id, e)
+            return False
+
+    async def save_broadcast_progress(self, broadcast_id: int, cursor_user_id: int, delivered: int, blocked: int, failed: int, status: str = "running") -> None:
+        try:
+            await self.pool.execute("UPDATE broadcasts SET cursor_user_id = $1, delivered = $2, blocked = $3, failed = $4, status = $5, heartbeat_at = $6 WHERE id = $7",
+                                    cursor_user_id, delivered, blocked, failed, status, time.time(), broadcast_id)
+        except self._errors as e:
+            logger.error("DB error saving broadcast %s progress: %s", broadcast_id, e)
+
+    async def iter_broadcast_recipients(self, after_user_id: int = 0, batch_size: int = 500):
+        while True:
+            try:
+                rows = await self.pool.fetch("SELECT telegram_id, language_code FROM users WHERE telegram_id > $1 AND is_blocked = 0 ORDER BY telegram_id LIMIT $2", after_user_id, batch_size)
+            except self._errors as e:
+                logger.error("DB error reading broadcast recipients: %s", e)
+                return
+            for row in rows: yield tuple(row)
+            if len(rows) < batch_size: return
+            after_user_id = rows[-1][0]
+
+    async def backfill_daily_sales(self) -> int:
+        try:
+            async with self.pool.acquire() as conn, conn.transaction():
+                # The row lock taken by DELETE makes a concurrent backfill see no row and do nothing
+                max_id = await conn.fetchval("DELETE FROM daily_sales_backfill RETURNING max_order_id")
+                if max_id is None: return 0
+                for statement in _backfill_rollup_statements(max_id): await conn.execute(statement)
+                return await conn.fetchval("SELECT COUNT(*) FROM orders WHERE id <= $1", max_id)
+        except self._errors as e:
+            logger.error("DB error backfilling daily sales: %s", e)
+            return -1
+
+    async def get_daily_sales_totals(self, date_from: str, date_to: str) -> list:
+        try:
+            rows = await self.pool.fetch("SELECT sale_date, order_count, revenue FROM daily_order_totals WHERE sale_date >= $1 AND sale_date < $2 AND order_count > 0 ORDER BY sale_date", date_from, date_to)
+            return [tuple(row) for row in rows]
+        except self._errors as e:
+            logger.error("DB error getting daily sales totals: %s", e)
+            return []
+
+    async def get_product_sales(self, date_from: str, date_to: str) -> list:
+        try:
+            rows = await self.pool.fetch("SELECT ds.product_id, p.name, SUM(ds.quantity_kg), SUM(ds.revenue), SUM(ds.order_count) FROM daily_sales ds LEFT JOIN products p ON p.id = ds.product_id "
+                                         "WHERE ds.sale_date >= $1 AND ds.sale_date < $2 GROUP BY ds.product_id, p.name HAVING SUM(ds.order_count) > 0 ORDER BY SUM(ds.revenue) DESC", date_from, date_to)
+            return [tuple(row) for row in rows]
+        except self._errors as e:
+            logger.error("DB error getting product sales: %s", e)
+            return []
+
+    async def delete_completed_orders(self) -> int:
+        try:
+            async with self.pool.acquire() as conn, conn.transaction():
+                await conn.execute("DELETE FROM order_items WHERE order_id IN (SELECT id FROM orders WHERE status = 'completed')")
+                return _rowcount(await conn.execute("DELETE FROM orders WHERE status = 'completed'"))
+        except self._errors as e:
+            logger.error("DB error deleting completed orders: %s", e)
+            return -1
+
+    async def transition_orders(self, new_status: str, order_ids: list = None, date_from: str = None, date_to: str = None) -> list | None:
+        query, params = _order_transition_query(new_status, order_ids, date_from, date_to, "$")
+        try:
+            async with self.pool.acquire() as conn, conn.transaction():
+                changed = [tuple(row) for row in await conn.fetch(query, *params)]
+                if changed and new_status == "cancelled":
+                    for statement in _cancelled_rollup_statements([row[0] for row in changed]): await conn.execute(statement)
+                    await conn.execute(_restock_statement([row[0] for row in changed]))
+        except self._errors as e:
+            logger.error("DB error moving orders to %s: %s", new_status, e)
+            return None
+        if changed and new_status == "cancelled": await self._catalog_changed()
+        return changed
+
+
+def create_storage(db_path: str, default_language: str = "lt") -> Storage:
+    database_url = os.getenv("DATABASE_URL", "")
+    if database_url.startswith(("postgres://", "postgresql://")):
+        return PostgresStorage(database_url, default_language)
+    return SQLiteStorage(db_path, default_language)
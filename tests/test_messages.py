@@ -0,0 +1,31 @@
+import random
+
+import pytest
+
+from bot import split_message_on_lines
+
+@pytest.mark.parametrize("text", [
+    "",
+    "one line",
+    "\n\nleading blank lines",
+    "trailing blank lines\n\n",
+    "a\n\nb\n\n\nc",
+    "\n".join(["header", "", "1. apples", "2. pears", "", "", "total"] * 5),
+])
+@pytest.mark.parametrize("limit", [20, 27, 4096])
+def test_split_round_trips(text, limit):
+    chunks = split_message_on_lines(text, limit)
+    assert "\n".join(chunks) == text
+    assert all(len(chunk) <= limit for chunk in chunks)
+
+def test_split_round_trips_random_text():
+    rng = random.Random(7)
+    for _ in range(500):
+        text = "\n".join("x" * rng.choice((0, 0, 1, 3, 10)) for _ in range(rng.randint(1, 30)))
+        chunks = split_message_on_lines(text, 10)
+        assert "\n".join(chunks) == text
+        assert all(len(chunk) <= 10 for chunk in chunks)
+
+def test_split_cuts_only_overlong_lines():
+    assert split_message_on_lines("ab\n" + "x" * 10 + "\ncd", 4) == ["ab", "xxxx", "xxxx", "xx", "cd"]
+    assert split_message_on_lines("x" * 8, 4) == ["xxxx", "xxxx"] # No empty chunk after an exact multiple